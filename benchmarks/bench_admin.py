@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# run with: python -m benchmarks.bench_admin [--counselors N] [--batch-size B] ...
+#
+# imports a roster CSV with the admin add command against an on-disk database,
+# as when enrolling a whole organisation's counselors at once.
+
+import argparse
+import base64
+import json
+from pathlib import Path
+import tempfile
+import time
+
+from click.testing import CliRunner
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import cryptography.hazmat.primitives.serialization as serial
+from sqlalchemy.orm import sessionmaker
+
+from hyperdome.server import database, models
+from hyperdome.server.scripts.cli import admin
+
+
+def write_roster(count: int, path: Path):
+    keys = (
+        Ed25519PrivateKey.generate()
+        .public_key()
+        .public_bytes(serial.Encoding.Raw, serial.PublicFormat.Raw)
+        for _ in range(count)
+    )
+    path.write_text(
+        "name,key\n"
+        + "".join(
+            f"counselor-{number},{base64.urlsafe_b64encode(key).decode()}\n"
+            for number, key in enumerate(keys)
+        )
+    )
+
+
+def run(args: argparse.Namespace) -> dict:
+    directory = tempfile.TemporaryDirectory()
+    path = Path(directory.name)
+    roster = path / "roster.csv"
+    write_roster(args.counselors, roster)
+    seconds = []
+    for _ in range(args.rounds):
+        (path / "hyperdome_server.db").unlink(missing_ok=True)
+        database.engine = database.make_engine(
+            f"sqlite:///{path / 'hyperdome_server.db'}"
+        )
+        database.SessionLocal = sessionmaker(bind=database.engine)
+        models.counselor_keys.stamp = path / "changed"
+        start = time.perf_counter()
+        result = CliRunner().invoke(
+            admin,
+            ["add", "--csv", str(roster), "--batch-size", str(args.batch_size)],
+        )
+        seconds.append(time.perf_counter() - start)
+        database.engine.dispose()
+        if result.exit_code != 0:
+            raise RuntimeError(result.output)
+    directory.cleanup()
+
+    return {
+        "config": {
+            name: getattr(args, name) for name in ("counselors", "batch_size", "rounds")
+        },
+        "seconds": min(seconds),
+        "counselors_per_second": args.counselors / min(seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="bulk counselor imports with the hyperdome admin command"
+    )
+    parser.add_argument("--counselors", type=int, default=10_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="imports into a fresh database"
+    )
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(
+        f"{args.counselors} counselors in {result['seconds']:.2f} s, "
+        f"{result['counselors_per_second']:.0f} per second"
+    )
+    if args.save:
+        args.save.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# run with: python -m benchmarks.bench_matching
+
+import secrets
+import timeit
+
+from hyperdome.server.matching import STRATEGIES, CounselorPool
+
+POOL_SIZES = (10, 100, 1_000, 10_000)
+ROUNDS = 20_000
+
+
+def set_choice_match(pool: set[str]):
+    """
+    matching as done before counselor pools, copying the set every time
+    """
+    chosen = secrets.choice(tuple(pool))
+    pool.remove(chosen)
+    pool.add(chosen)
+
+
+def pool_match(pool: CounselorPool):
+    chosen = pool.choose()
+    pool.discard(chosen)
+    pool.add(chosen)
+
+
+def bench(size: int) -> dict[str, float]:
+    """
+    nanoseconds per match, including taking the counselor out and putting it back
+    """
+    ids = [secrets.token_urlsafe(16) for _ in range(size)]
+    results = {}
+
+    legacy = set(ids)
+    seconds = timeit.timeit(lambda: set_choice_match(legacy), number=ROUNDS)
+    results["set_choice"] = seconds / ROUNDS * 1e9
+
+    for name, pool_type in STRATEGIES.items():
+        pool = pool_type()
+        for counselor_id in ids:
+            pool.add(counselor_id)
+        seconds = timeit.timeit(lambda: pool_match(pool), number=ROUNDS)
+        results[name] = seconds / ROUNDS * 1e9
+    return results
+
+
+def main():
+    names = ["set_choice", *STRATEGIES]
+    print(f"{'pool size':>10}" + "".join(f"{name:>26}" for name in names))
+    for size in POOL_SIZES:
+        results = bench(size)
+        print(f"{size:>10}" + "".join(f"{results[name]:>23.0f} ns" for name in names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# run with: python -m benchmarks.bench_ratchet [--messages N] [--size BYTES] [--save FILE]
+#
+# messages per second through a chat session's encryptor and decryptor,
+# compared with the ratchet as it was before, which built an HKDF for every key
+
+import argparse
+import json
+from pathlib import Path
+import secrets
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from hyperdome.common import encryption
+from hyperdome.common.encryption import MessageDecryptor, MessageEncryptor
+
+WINDOWS = (1, 8, 32)
+
+
+class HKDFRatchet(encryption.KeyRatchet):
+    """
+    the ratchet step as done before, constructing an HKDF for every key
+    """
+
+    def _derive_window(self):
+        new_key_bytes = HKDF(
+            hashes.BLAKE2b(64),
+            64,
+            encryption.RATCHET_SALT,
+            encryption.RATCHET_INFO,
+            default_backend(),
+        ).derive(self._kdf_key)
+        self._kdf_key = new_key_bytes[32:]
+        self._next_keys.append(new_key_bytes[:32])
+
+
+def per_second(count: int, run) -> float:
+    start = time.perf_counter()
+    run()
+    return count / (time.perf_counter() - start)
+
+
+def bench(messages: int, size: int, window: int | None) -> dict[str, float]:
+    """
+    messages per second encrypted and decrypted in order, and keys per second
+    from the ratchet alone, with the HKDF ratchet when window is None
+    """
+    key_material = secrets.token_bytes(32)
+    encryptor = MessageEncryptor(key_material, window or 1)
+    decryptor = MessageDecryptor(key_material, window or 1)
+    ratchet = encryption.KeyRatchet(key_material, window or 1)
+    if window is None:
+        for user in (encryptor, decryptor):
+            user._ratchet = HKDFRatchet(key_material)
+        ratchet = HKDFRatchet(key_material)
+    plaintext = secrets.token_bytes(size)
+
+    sent = []
+    results = {
+        "encrypt": per_second(
+            messages,
+            lambda: sent.extend(encryptor.encrypt(plaintext) for _ in range(messages)),
+        ),
+        "decrypt": per_second(
+            messages, lambda: [decryptor.decrypt(message) for message in sent]
+        ),
+        "keys": per_second(messages, lambda: [ratchet.key for _ in range(messages)]),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="messages per second through the chat key ratchet"
+    )
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--size", type=int, default=256, help="plaintext bytes")
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"hkdf": bench(args.messages, args.size, None)}
+    for window in WINDOWS:
+        results[f"window {window}"] = bench(args.messages, args.size, window)
+
+    print(f"{'ratchet':>10}{'encrypt/s':>14}{'decrypt/s':>14}{'keys/s':>14}")
+    for name, result in results.items():
+        print(
+            f"{name:>10}"
+            + "".join(
+                f"{result[kind]:>14.0f}" for kind in ("encrypt", "decrypt", "keys")
+            )
+        )
+    if args.save:
+        args.save.write_text(
+            json.dumps(
+                {"messages": args.messages, "size": args.size} | results, indent=2
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# run with: python -m benchmarks.bench_server [--counselors N] [--guests M] ...
+#
+# drives the server app in process through httpx's ASGI transport, with no tor or
+# network involved, so results show the cost of the server itself.
+# echo counselors sign in, guests queue for them, trade messages and leave.
+
+import argparse
+import asyncio
+import base64
+from collections import defaultdict
+import json
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import cryptography.hazmat.primitives.serialization as serial
+import httpx
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import sessionmaker
+
+from hyperdome.server import models
+from hyperdome.server.database import (
+    Base,
+    get_async_db,
+    make_async_engine,
+    make_async_session,
+    make_engine,
+)
+from hyperdome.server.router import ChatRouter
+import hyperdome.server.web as web
+
+# seconds long polls are held for, short so the run winds down quickly
+LONG_POLL_SECONDS = 1.0
+# seconds between counselor checks for new guests
+COUNSELOR_POLL_SECONDS = 0.01
+
+
+class Recorder:
+    """
+    latencies in seconds of every request made, by endpoint
+    """
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.requests = 0
+        self.refused = 0
+
+    async def request(
+        self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs
+    ) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        self.requests += 1
+        while response.status_code in (429, 503):
+            # shed by the server, back off as long as it asks like a client would
+            self.refused += 1
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+            response = await client.request(method, url, **kwargs)
+            self.requests += 1
+        response.raise_for_status()
+        return response
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """
+    count and p50/p95/p99 of samples, in milliseconds
+    """
+    if len(samples) < 2:
+        samples = samples * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "p50": cuts[49] * 1e3,
+        "p95": cuts[94] * 1e3,
+        "p99": cuts[98] * 1e3,
+    }
+
+
+def make_counselors(
+    count: int, path: Path
+) -> tuple[AsyncEngine, list[tuple[str, Ed25519PrivateKey]]]:
+    """
+    register counselors in a fresh database file at path and have the app use it
+    returns the engine the app was given, to be disposed of after the run
+    """
+    engine = make_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    counselors = []
+    with sessionmaker(bind=engine)() as session:
+        for number in range(count):
+            key = Ed25519PrivateKey.generate()
+            raw = key.public_key().public_bytes(
+                serial.Encoding.Raw, serial.PublicFormat.Raw
+            )
+            name = f"counselor-{number}"
+            session.add(models.Counselor(name=name, key=raw))
+            counselors.append((name, key))
+        session.commit()
+    engine.dispose()
+
+    async_engine = make_async_engine(f"sqlite+aiosqlite:///{path}")
+    AsyncSession = make_async_session(async_engine)
+
+    async def get_bench_db():
+        async with AsyncSession() as session:
+            yield session
+
+    web.app.dependency_overrides[get_async_db] = get_bench_db
+    return async_engine, counselors
+
+
+async def chat_as_counselor(
+    client: httpx.AsyncClient, recorder: Recorder, chat_id: str, guest_key: str
+):
+    """
+    echo every message back to the guest until the chat ends
+    """
+    while True:
+        response = await recorder.request(
+            client,
+            "collect_messages",
+            "GET",
+            f"/collect_messages/{chat_id}",
+            params={"wait": LONG_POLL_SECONDS},
+        )
+        body = response.json()
+        for message in body["messages"]:
+            await recorder.request(
+                client,
+                "send_message",
+                "POST",
+                "/send_message",
+                data={"message": message, "user_id": guest_key},
+            )
+        if body["chat_status"] == "NO_CHAT":
+            return
+
+
+async def run_counselor(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    name: str,
+    key: Ed25519PrivateKey,
+    capacity: int,
+    done: asyncio.Event,
+):
+    pub_key = f"{name}-session-key"
+    signature = base64.urlsafe_b64encode(key.sign(pub_key.encode())).decode()
+    response = await recorder.request(
+        client,
+        "counselor_signin",
+        "POST",
+        "/counselor_signin",
+        data={
+            "username": name,
+            "pub_key": pub_key,
+            "signature": signature,
+            "capacity": capacity,
+        },
+    )
+    counselor_id = response.json()
+    chats = []
+    while not done.is_set():
+        response = await recorder.request(
+            client,
+            "poll_connected_guest",
+            "GET",
+            f"/poll_connected_guest/{counselor_id}",
+        )
+        for new_guest in response.json():
+            chats.append(
+                asyncio.create_task(
+                    chat_as_counselor(
+                        client, recorder, new_guest["chat_id"], new_guest["guest_key"]
+                    )
+                )
+            )
+        await asyncio.sleep(COUNSELOR_POLL_SECONDS)
+    await recorder.request(
+        client,
+        "counselor_signout",
+        "POST",
+        "/counselor_signout",
+        data={"user_id": counselor_id},
+    )
+    await asyncio.gather(*chats)
+
+
+async def run_guest(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    number: int,
+    messages: int,
+    message_interval: float,
+    flows: list[float],
+):
+    """
+    wait for a counselor, send messages, and wait for each to be echoed back
+    the time from joining the waiting room to the first echo is recorded as a flow
+    """
+    guest_key = f"guest-{number}"
+    start = time.perf_counter()
+    chat_id = ""
+    while not chat_id:
+        response = await recorder.request(
+            client,
+            "waiting_room",
+            "POST",
+            "/waiting_room",
+            params={"wait": LONG_POLL_SECONDS},
+            data={"pub_key": guest_key},
+        )
+        chat_id = response.json()["chat_id"]
+    for sequence in range(messages):
+        message = f"{guest_key}-{sequence}"
+        await recorder.request(
+            client,
+            "send_message",
+            "POST",
+            "/send_message",
+            data={"message": message, "user_id": chat_id},
+        )
+        received = []
+        while message not in received:
+            response = await recorder.request(
+                client,
+                "collect_messages",
+                "GET",
+                f"/collect_messages/{guest_key}",
+                params={"wait": LONG_POLL_SECONDS},
+            )
+            received += response.json()["messages"]
+        if sequence == 0:
+            flows.append(time.perf_counter() - start)
+        await asyncio.sleep(message_interval)
+    await recorder.request(
+        client,
+        "counseling_complete",
+        "POST",
+        "/counseling_complete",
+        data={"user_id": guest_key},
+    )
+
+
+async def run(args: argparse.Namespace) -> dict:
+    web.router = ChatRouter()
+    database = tempfile.TemporaryDirectory()
+    async_engine, counselors = make_counselors(
+        args.counselors, Path(database.name) / "bench.db"
+    )
+    recorder = Recorder()
+    flows: list[float] = []
+    done = asyncio.Event()
+    message_interval = 1 / args.message_rate if args.message_rate else 0.0
+    arrival_interval = 1 / args.arrival_rate if args.arrival_rate else 0.0
+
+    transport = httpx.ASGITransport(app=web.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://hyperdome"
+    ) as client:
+        counselor_tasks = [
+            asyncio.create_task(
+                run_counselor(client, recorder, name, key, args.capacity, done)
+            )
+            for name, key in counselors
+        ]
+        start = time.perf_counter()
+        guest_tasks = []
+        for number in range(args.guests):
+            guest_tasks.append(
+                asyncio.create_task(
+                    run_guest(
+                        client, recorder, number, args.messages, message_interval, flows
+                    )
+                )
+            )
+            await asyncio.sleep(arrival_interval)
+        await asyncio.gather(*guest_tasks)
+        elapsed = time.perf_counter() - start
+        done.set()
+        await asyncio.gather(*counselor_tasks)
+    web.app.dependency_overrides.clear()
+    await async_engine.dispose()
+    database.cleanup()
+
+    return {
+        "config": {
+            name: getattr(args, name)
+            for name in (
+                "counselors",
+                "capacity",
+                "guests",
+                "messages",
+                "arrival_rate",
+                "message_rate",
+            )
+        },
+        "seconds": elapsed,
+        "refused": recorder.refused,
+        "throughput": {
+            "requests_per_second": recorder.requests / elapsed,
+            "messages_per_second": 2 * args.guests * args.messages / elapsed,
+        },
+        "latency": {
+            endpoint: summarize(samples)
+            for endpoint, samples in sorted(recorder.latencies.items())
+        },
+        "flow": summarize(flows),
+    }
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    describe every p95 latency or throughput worse than baseline by more than tolerance
+    """
+    found = []
+    latencies = {**result["latency"], "match to first message": result["flow"]}
+    expected = {**baseline["latency"], "match to first message": baseline["flow"]}
+    for name, summary in latencies.items():
+        if name in expected and summary["p95"] > expected[name]["p95"] * (
+            1 + tolerance
+        ):
+            found.append(
+                f"{name} p95 {summary['p95']:.2f} ms, baseline {expected[name]['p95']:.2f} ms"
+            )
+    for name, rate in result["throughput"].items():
+        if rate < baseline["throughput"][name] * (1 - tolerance):
+            found.append(
+                f"{name} {rate:.0f}, baseline {baseline['throughput'][name]:.0f}"
+            )
+    return found
+
+
+def report(result: dict):
+    print(
+        f"{result['seconds']:.2f} s, "
+        + ", ".join(f"{rate:.0f} {name}" for name, rate in result["throughput"].items())
+        + f", {result.get('refused', 0)} refused"
+    )
+    print(f"{'endpoint':>24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = {**result["latency"], "match to first message": result["flow"]}
+    for name, summary in rows.items():
+        print(
+            f"{name:>24}{summary['count']:>8}"
+            + "".join(f"{summary[cut]:>10.2f}" for cut in ("p50", "p95", "p99"))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="in-process load test of the hyperdome server API"
+    )
+    parser.add_argument("--counselors", type=int, default=10)
+    parser.add_argument("--capacity", type=int, default=2, help="guests per counselor")
+    parser.add_argument("--guests", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=10, help="sent by each guest")
+    parser.add_argument(
+        "--arrival-rate",
+        type=float,
+        default=0,
+        help="guests per second, 0 for all at once",
+    )
+    parser.add_argument(
+        "--message-rate",
+        type=float,
+        default=0,
+        help="messages per second per guest, 0 for as fast as echoes return",
+    )
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction a result may be worse than the baseline before failing",
+    )
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.save:
+        args.save.write_text(json.dumps(result, indent=2))
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if found := regressions(result, baseline, args.tolerance):
+            print("regressions against baseline:", *found, sep="\n  ")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# run with: python -m benchmarks.bench_signin [--counselors N] [--concurrency C] ...
+#
+# a shift change: every counselor signs in at once against an on-disk database,
+# through the app in process. --cold empties the key cache before each round
+# so every sign-in goes to the database.
+
+import argparse
+import asyncio
+import base64
+import json
+from pathlib import Path
+import tempfile
+import time
+
+import httpx
+
+from hyperdome.server import models
+from hyperdome.server.router import ChatRouter
+import hyperdome.server.web as web
+
+from .bench_server import make_counselors, summarize
+
+
+async def run(args: argparse.Namespace) -> dict:
+    database = tempfile.TemporaryDirectory()
+    async_engine, counselors = make_counselors(
+        args.counselors, Path(database.name) / "bench.db"
+    )
+    slots = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+
+    async def sign_in(client: httpx.AsyncClient, name: str, key) -> None:
+        pub_key = f"{name}-session-key"
+        signature = base64.urlsafe_b64encode(key.sign(pub_key.encode())).decode()
+        async with slots:
+            start = time.perf_counter()
+            response = await client.post(
+                "/counselor_signin",
+                data={"username": name, "pub_key": pub_key, "signature": signature},
+            )
+            latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=web.app)
+    elapsed = 0.0
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://hyperdome"
+    ) as client:
+        for _ in range(args.rounds):
+            web.router = ChatRouter()
+            if args.cold:
+                models.counselor_keys.clear()
+            start = time.perf_counter()
+            await asyncio.gather(*(sign_in(client, *c) for c in counselors))
+            elapsed += time.perf_counter() - start
+    web.app.dependency_overrides.clear()
+    await async_engine.dispose()
+    database.cleanup()
+
+    return {
+        "config": {
+            name: getattr(args, name)
+            for name in ("counselors", "concurrency", "rounds", "cold")
+        },
+        "signins_per_second": len(latencies) / elapsed,
+        "latency": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="concurrent counselor sign-ins against the hyperdome server"
+    )
+    parser.add_argument("--counselors", type=int, default=500)
+    parser.add_argument(
+        "--concurrency", type=int, default=100, help="sign-ins in flight at once"
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=3,
+        help="times every counselor signs in, within the sign-in rate limit",
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="query the database for every sign-in"
+    )
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    latency = result["latency"]
+    print(
+        f"{result['signins_per_second']:.0f} sign-ins per second, "
+        + ", ".join(f"{cut} {latency[cut]:.2f} ms" for cut in ("p50", "p95", "p99"))
+    )
+    if args.save:
+        args.save.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
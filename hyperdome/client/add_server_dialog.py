@@ -19,11 +19,13 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import base64
 import logging
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from ..common.common import resource_path
-from ..common.old_encryption import LockBox
+from ..common.encryption import CounselorKeyring
 from ..common.server import Server
 from hyperdome.client import api
 
@@ -138,13 +140,19 @@ class AddServerDialog(QtWidgets.QDialog):
         self.done(0)
 
     def signup(self):
-        signer = LockBox()
-        signer.make_signing_key()
-        self.server.key = signer.export_key(b"123")  # TODO: use user provided password
+        keyring = CounselorKeyring()
+        # TODO: use user provided password
+        self.server.key = keyring.export_private_key(b"123").decode()
         passcode = self.counselor_password_input.text()
-        signature = signer.sign_message(passcode.encode())
+        signature = base64.urlsafe_b64encode(keyring.sign(passcode.encode())).decode()
+        pub_key = keyring.public_signing_key.public_bytes(
+            Encoding.Raw, PublicFormat.Raw
+        )
         self.client.signup_counselor(
-            self.set_server, passcode, signer.public_signing_key, signature
+            self.set_server,
+            passcode,
+            base64.urlsafe_b64encode(pub_key).decode(),
+            signature,
         )
 
     @QtCore.pyqtSlot(Exception)
@@ -19,19 +19,40 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import base64
 import json
-from typing import ParamSpec, Callable, Concatenate
+import random
+from urllib.parse import urlencode
+from typing import Any, ParamSpec, Callable, Concatenate
 import autologging
 from PyQt5.QtNetwork import (
     QNetworkAccessManager,
     QNetworkReply,
     QNetworkRequest,
 )
-from PyQt5.QtCore import QUrl, pyqtSlot
+from PyQt5.QtCore import QTimer, QUrl, pyqtSlot
+from PyQt5.QtWebSockets import QWebSocket
 
+from ..common.encryption import CounselorKeyring
 from ..common.server import Server
 
 
+# seconds the server may hold a collect_messages request waiting for a message
+LONG_POLL_SECONDS = 25
+
+# milliseconds a queued message waits for others to be sent along with it
+OUTBOX_COALESCE_MS = 50
+# most bytes of messages sent in a single batch, well under the server's request limit
+MAX_BATCH_BYTES = 48 << 10
+# most messages sent in a single batch, as accepted by the server
+MAX_BATCH_MESSAGES = 100
+
+# retries of a request refused by an overloaded server before giving up
+MAX_RETRIES = 5
+# most seconds of extra backoff after the first refusal, doubling on each retry
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
 FnParams = ParamSpec("FnParams")
 CallbackParams = ParamSpec("CallbackParams")
 
@@ -59,6 +80,124 @@ def response_handler(reply: QNetworkReply):
     return decorator
 
 
+def json_response_handler(reply: QNetworkReply):
+    def decorator(fn: Callable[[Any], None]):
+        @pyqtSlot()
+        def wrapper() -> None:
+            fn(json.loads(bytes(reply.readAll())))
+
+        reply.finished.connect(wrapper)
+
+    return decorator
+
+
+class Outbox:
+    """
+    messages waiting to be sent to one chat
+
+    messages queued within OUTBOX_COALESCE_MS of each other, or while a batch
+    is still in flight, are sent together in the next batch, so a burst of
+    messages costs one round trip instead of one each
+    each message's callback runs once its batch is delivered, or its on_error
+    if the batch couldn't be
+    """
+
+    def __init__(
+        self, send: Callable[[Callable[[bool], None], list[str]], None]
+    ) -> None:
+        self.send = send
+        self.pending: list[tuple[str, Callable[[], None], Callable[[], None]]] = []
+        self.in_flight = False
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(OUTBOX_COALESCE_MS)
+        self.timer.timeout.connect(self.flush)
+
+    def put(
+        self, message: str, callback: Callable[[], None], on_error: Callable[[], None]
+    ):
+        self.pending.append((message, callback, on_error))
+        if not self.in_flight and not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        """
+        send as many pending messages as fit in one batch, in the order they were queued
+        """
+        if self.in_flight or not self.pending:
+            return
+        size = 0
+        count = 0
+        for message, _, _ in self.pending[:MAX_BATCH_MESSAGES]:
+            size += len(message.encode())
+            if count and size > MAX_BATCH_BYTES:
+                break
+            count += 1
+        batch, self.pending = self.pending[:count], self.pending[count:]
+        self.in_flight = True
+
+        def sent(delivered: bool):
+            self.in_flight = False
+            for _, callback, on_error in batch:
+                if delivered:
+                    callback()
+                else:
+                    on_error()
+            # anything queued meanwhile has already waited long enough
+            self.flush()
+
+        self.send(sent, [message for message, _, _ in batch])
+
+
+def retry_delay(reply: QNetworkReply, attempt: int) -> float | None:
+    """
+    seconds to wait before retrying a request the server refused while overloaded,
+    None if it wasn't refused or has been retried enough
+    """
+    status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+    if status not in (429, 503) or attempt >= MAX_RETRIES:
+        return None
+    try:
+        hint = float(bytes(reply.rawHeader(b"Retry-After")).decode())
+    except ValueError:
+        hint = 0.0
+    backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    # never sooner than asked, and spread out so refused clients don't return at once
+    return hint + random.uniform(0, backoff)
+
+
+def backoff_response_handler(send: Callable[[], QNetworkReply], attempt: int = 0):
+    """
+    like json_response_handler, but issues the request itself with send
+    so it can be sent again after a jittered delay when the server sheds load
+    fn gets None if the request failed for good
+    """
+
+    def decorator(fn: Callable[[Any], None]):
+        reply = send()
+
+        @pyqtSlot()
+        def wrapper() -> None:
+            if (delay := retry_delay(reply, attempt)) is not None:
+                QTimer.singleShot(
+                    round(delay * 1000),
+                    lambda: backoff_response_handler(send, attempt + 1)(fn),
+                )
+                return
+            try:
+                body = json.loads(bytes(reply.readAll()))
+            except ValueError:
+                body = None
+            if reply.error() != QNetworkReply.NoError:
+                # refusals carry a body too, it isn't a reply to the request
+                body = None
+            fn(body)
+
+        reply.finished.connect(wrapper)
+
+    return decorator
+
+
 @autologging.traced
 @autologging.logged
 class HyperdomeClientApi:
@@ -74,6 +213,7 @@ class HyperdomeClientApi:
     def __init__(self, server: Server, session: QNetworkAccessManager) -> None:
         self.session = session
         self.server = server
+        self.outboxes: dict[str, Outbox] = {}
 
     def signout_counselor(self, callback: Callable[..., None], user_id: str):
         request = QNetworkRequest(QUrl(f"{self.server.url}/counselor_signout"))
@@ -91,16 +231,59 @@ class HyperdomeClientApi:
         def handle_response(body: str):
             callback()
 
-    def send_message(self, callback: Callable[[], None], uid: str, message: str):
+    def send_message(
+        self,
+        callback: Callable[[], None],
+        on_error: Callable[[], None],
+        uid: str,
+        message: str,
+    ):
         """
         Send message to server provided using session for given user
+        on_error is called instead of callback if the message couldn't be delivered
         """
         request = QNetworkRequest(QUrl(f"{self.server.url}/send_message"))
         data = json.dumps({"message": message, "user_id": uid}).encode()
 
-        @response_handler(self.session.post(request, data))
-        def handler(body: str):
-            callback()
+        @backoff_response_handler(lambda: self.session.post(request, data))
+        def handler(body: str | None):
+            if body is None:
+                on_error()
+            else:
+                callback()
+
+    def send_messages(
+        self, callback: Callable[[bool], None], uid: str, messages: list[str]
+    ):
+        """
+        Send an ordered batch of messages for given user in one request
+        callback is told whether the batch was delivered
+        """
+        request = QNetworkRequest(QUrl(f"{self.server.url}/send_messages"))
+        request.setHeader(QNetworkRequest.ContentTypeHeader, "application/json")
+        data = json.dumps({"messages": messages, "user_id": uid}).encode()
+
+        @backoff_response_handler(lambda: self.session.post(request, data))
+        def handler(body: str | None):
+            callback(body is not None)
+
+    def queue_message(
+        self,
+        callback: Callable[[], None],
+        on_error: Callable[[], None],
+        uid: str,
+        message: str,
+    ):
+        """
+        Queue a message for given user, to be sent in a batch with any others
+        queued around the same time
+        on_error is called instead of callback if the message couldn't be delivered
+        """
+        if uid not in self.outboxes:
+            self.outboxes[uid] = Outbox(
+                lambda sent, messages: self.send_messages(sent, uid, messages)
+            )
+        self.outboxes[uid].put(message, callback, on_error)
 
     def get_uid(self, callback: Callable[[str], None]):
         """
@@ -112,22 +295,51 @@ class HyperdomeClientApi:
         def handler(body: str):
             callback(body)
 
-    def get_messages(self, callback: Callable[[str], None], uid: str):
+    def get_messages(
+        self,
+        callback: Callable[[list[str], str], None],
+        on_error: Callable[[], None],
+        uid: str,
+        wait: int = 0,
+    ):
         """
         collect new messages waiting on server for active session
+        with wait set the server holds the request until a message arrives
+        callback gets the messages and the chat's status, NO_CHAT once it has ended
+        on_error is called instead if the messages couldn't be collected
         """
-        request = QNetworkRequest(QUrl(f"{self.server.url}/collect_messages/{uid}"))
+        request = QNetworkRequest(
+            QUrl(f"{self.server.url}/collect_messages/{uid}?wait={wait}")
+        )
 
-        @response_handler(self.session.get(request))
-        def handler(body: str):
-            callback(body)
+        @backoff_response_handler(lambda: self.session.get(request))
+        def handler(body: dict | None):
+            if body is None:
+                on_error()
+            else:
+                callback(body["messages"], body["chat_status"])
+
+    def open_chat(
+        self, callback: Callable[[str], None], on_error: Callable[[], None], uid: str
+    ) -> QWebSocket:
+        """
+        open a websocket that pushes chat frames for an active session as they arrive
+        on_error is called if the socket can't be used so callers can fall back to polling
+        """
+        socket = QWebSocket()
+        socket.textMessageReceived.connect(callback)
+        socket.error.connect(lambda _: on_error())
+        socket.open(QUrl(f"{self.server.url.replace('http', 'ws', 1)}/chat/{uid}"))
+        return socket
 
     def start_chat(
         self,
-        callback: Callable[[str], None],
+        callback: Callable[[str, str], None],
         uid: str,
         pub_key: str,
         signature: str = "",
+        on_position: Callable[[int], bool] = lambda _: True,
+        on_error: Callable[[], None] = lambda: None,
     ):
 
         if self.server.is_counselor:
@@ -147,17 +359,41 @@ class HyperdomeClientApi:
                 )
             )
             def handler(body: str):
-                callback(body)
+                callback(body, "")
 
         else:
-            request = QNetworkRequest(QUrl(f"{self.server.url}/request_counselor"))
-            data = json.dumps({"guest_id": uid, "pub_key": pub_key}).encode()
+            self.wait_for_counselor(callback, pub_key, on_position, on_error)
 
-            @response_handler(self.session.post(request, data))
-            def handler(body: str):
-                callback(body)
+    def wait_for_counselor(
+        self,
+        callback: Callable[[str, str], None],
+        pub_key: str,
+        on_position: Callable[[int], bool] = lambda _: True,
+        on_error: Callable[[], None] = lambda: None,
+    ):
+        """
+        hold a place in the server's waiting room until a counselor is assigned
+        callback is given the counselor's key and the chat id to send messages to
+        on_position is given the place in line after each check in,
+        and returns whether to keep waiting
+        on_error is called if a check in fails
+        """
+        request = QNetworkRequest(
+            QUrl(f"{self.server.url}/waiting_room?wait={LONG_POLL_SECONDS}")
+        )
+        request.setHeader(
+            QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded"
+        )
+        data = urlencode({"pub_key": pub_key}).encode()
 
-        callback("")
+        @backoff_response_handler(lambda: self.session.post(request, data))
+        def handler(body: dict | None):
+            if body is None:
+                on_error()
+            elif body["counselor_key"]:
+                callback(body["counselor_key"], body["chat_id"])
+            elif on_position(body["position"]):
+                self.wait_for_counselor(callback, pub_key, on_position, on_error)
 
     def probe_server(self, callback: Callable[[], None]):
         request = QNetworkRequest(QUrl(f"{self.server.url}/probe"))
@@ -166,11 +402,16 @@ class HyperdomeClientApi:
         def handler(body: str):
             callback()
 
-    def get_guest_pub_key(self, callback: Callable[[str], None], uid: str):
+    def get_new_guests(
+        self, callback: Callable[[list[dict[str, str]]], None], uid: str
+    ):
+        """
+        collect the guest keys and chat ids of guests assigned since the last call
+        """
         request = QNetworkRequest(QUrl(f"{self.server.url}/poll_connected_guest/{uid}"))
 
-        @response_handler(self.session.get(request))
-        def handler(body: str):
+        @backoff_response_handler(lambda: self.session.get(request))
+        def handler(body: list[dict[str, str]]):
             callback(body)
 
     def signup_counselor(
@@ -194,3 +435,60 @@ class HyperdomeClientApi:
         )
         def handler(body: str):
             callback()
+
+    def publish_pre_keys(
+        self, callback: Callable[[int], None], keyring: CounselorKeyring
+    ):
+        """
+        publish the keyring's signed pre key and one-time keys for guests to start chats with
+        callback is given how many one-time keys the server has left
+        """
+        identity = base64.urlsafe_b64encode(keyring.identity_key_bytes).decode()
+        bundle = keyring.pre_key_bundle
+        request = QNetworkRequest(QUrl(f"{self.server.url}/pre_keys/{identity}"))
+        request.setHeader(
+            QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded"
+        )
+        data = urlencode(
+            {
+                "signed_pre_key": base64.urlsafe_b64encode(bundle.signed_pre_key),
+                "pre_key_signature": base64.urlsafe_b64encode(bundle.pre_key_signature),
+                "one_time_keys": [
+                    base64.urlsafe_b64encode(key) for key in bundle.one_time_keys
+                ],
+                "one_time_keys_signature": base64.urlsafe_b64encode(
+                    bundle.one_time_keys_signature
+                ),
+            },
+            doseq=True,
+        ).encode()
+
+        @backoff_response_handler(lambda: self.session.post(request, data))
+        def handler(body: int):
+            callback(body)
+
+    def get_one_time_key_count(self, callback: Callable[[int], None], identity: str):
+        """
+        how many of the counselor's one-time keys the server has left to hand out
+        """
+        request = QNetworkRequest(QUrl(f"{self.server.url}/pre_keys/{identity}"))
+
+        @backoff_response_handler(lambda: self.session.get(request))
+        def handler(body: int):
+            callback(body)
+
+    def upload_one_time_keys(
+        self, callback: Callable[[int], None], identity: str, upload: bytes
+    ):
+        """
+        add one-time keys encoded by CounselorKeyring.one_time_keys_upload
+        callback is given how many one-time keys the server has left
+        """
+        request = QNetworkRequest(
+            QUrl(f"{self.server.url}/pre_keys/{identity}/one_time_keys")
+        )
+        request.setHeader(QNetworkRequest.ContentTypeHeader, "application/octet-stream")
+
+        @backoff_response_handler(lambda: self.session.post(request, upload))
+        def handler(body: int):
+            callback(body)
@@ -18,6 +18,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import base64
 import json
 import logging
 
@@ -30,11 +31,14 @@ from PyQt5.QtNetwork import (
 from hyperdome.common.common import Settings
 from hyperdome.common import strings
 from hyperdome.common.common import resource_path
+from hyperdome.common.encryption import CounselorKeyring
 from hyperdome.common.old_encryption import LockBox
+from hyperdome.common.schemas import ChatContent, ChatContentType, StatusType
 from hyperdome.common.server import Server
 
 from . import api
 from .add_server_dialog import AddServerDialog
+from .prekeys import OneTimeKeyReplenisher
 from .settings_dialog import SettingsDialog
 from .tor_connection_dialog import TorConnectionDialog
 from .widgets import Alert
@@ -78,6 +82,9 @@ class HyperdomeClient(QtWidgets.QMainWindow):
         # initialize session variables
         self.uid = ""
         self.partner_key = ""
+        # mailbox ids the server routes this chat's messages through
+        self.chat_id = ""
+        self.partner_id = ""
         self.chat_history = list()
         self.load_servers()
         self.server = Server()
@@ -85,12 +92,19 @@ class HyperdomeClient(QtWidgets.QMainWindow):
         self.client: api.HyperdomeClientApi | None = None
         self.crypt = LockBox()
 
-        self.get_messages_timer = QtCore.QTimer(self)
-        self.get_messages_timer.setInterval(5000)
-
         self.poll_connected_guest_timer = QtCore.QTimer(self)
         self.poll_connected_guest_timer.setInterval(5000)
 
+        # counselors check their one-time keys on the server this often
+        # as well as whenever a guest is assigned
+        self.pre_keys: OneTimeKeyReplenisher | None = None
+        self.one_time_key_timer = QtCore.QTimer(self)
+        self.one_time_key_timer.setInterval(60000)
+
+        self.chat_socket = None
+        self.is_polling = False
+        self.is_waiting = False
+
         # Load settings, if a custom config was passed in
         self.config = config
         if self.config:
@@ -190,20 +204,23 @@ class HyperdomeClient(QtWidgets.QMainWindow):
         message = self.message_text_field.text()
         self.message_text_field.clear()
 
-        if not (self.is_connected or self.uid) or self.client is None:
+        if not self.partner_id or self.client is None:
             return self.handle_error(Exception("not in an active chat"))
 
-        enc_message = self.crypt.encrypt_outgoing_message(message.encode())
+        # pasted lines are queued together and go out in a single request
+        for line in message.splitlines() or [message]:
+            enc_message = self.crypt.encrypt_outgoing_message(line.encode())
 
-        self.client.send_message(
-            lambda: self.__log.debug("message sent successfully"),
-            self.uid,
-            enc_message,
-        )
+            self.client.queue_message(
+                lambda: self.__log.debug("message sent successfully"),
+                lambda: self.handle_error(Exception("message not delivered")),
+                self.partner_id,
+                enc_message,
+            )
 
-        self.chat_window.addItem(f"You: {message}")
+            self.chat_window.addItem(f"You: {line}")
 
-    def on_history_added(self, messages: str):
+    def on_history_added(self, messages: list[str]):
         """
         Update UI with messages retrieved from server.
         """
@@ -211,11 +228,75 @@ class HyperdomeClient(QtWidgets.QMainWindow):
         sender_name = "User" if self.server.is_counselor else "Counselor"
         message_list = [
             f"{sender_name}: {self.crypt.decrypt_incoming_message(message.encode())}"
-            for message in messages.split("\n")
-            if message
+            for message in messages
         ]
         self.chat_window.addItems(message_list)
 
+    def on_chat_frame(self, frame: str):
+        """
+        Handle a single frame pushed over the chat socket.
+        """
+        if not frame.startswith("{"):
+            self.on_history_added([frame])
+            return
+        # the server refuses to relay status frames, so only it can send these
+        try:
+            content = ChatContent.parse_raw(frame)
+        except ValueError:
+            self.__log.warning("dropped malformed chat frame")
+            return
+        if content.type != ChatContentType.STATUS:
+            self.__log.warning("dropped unexpected chat frame")
+            return
+        if content.content.status == StatusType.QUEUE_FULL:
+            self.handle_error(Exception("message not delivered, try again shortly"))
+        else:
+            self.__log.info("chat ended by server")
+            self.disconnect_chat()
+
+    def receive_messages(self):
+        """
+        Start receiving messages for the active chat, pushed over a websocket
+        when possible and polled otherwise.
+        """
+        if self.client is None:
+            return
+
+        def fall_back_to_polling():
+            self.__log.info("chat socket unavailable, long polling for messages")
+            self.chat_socket = None
+            self.is_polling = True
+            self.poll_messages()
+
+        self.chat_socket = self.client.open_chat(
+            self.on_chat_frame, fall_back_to_polling, self.chat_id
+        )
+
+    def poll_messages(self):
+        """
+        Long poll the server for messages, reissuing the request as each one returns.
+        """
+        if self.client is None or not self.is_polling:
+            return
+
+        def after_poll(messages: list[str], chat_status: str):
+            self.on_history_added(messages)
+            if chat_status == "NO_CHAT":
+                self.__log.info("chat ended by server")
+                self.disconnect_chat()
+                return
+            self.poll_messages()
+
+        def poll_failed():
+            if not self.is_polling:
+                return
+            self.handle_error(Exception("lost connection to the chat"))
+            self.disconnect_chat()
+
+        self.client.get_messages(
+            after_poll, poll_failed, self.chat_id, api.LONG_POLL_SECONDS
+        )
+
     def get_uid(self):
         """
         Ask server for a new UID for a new user session
@@ -311,49 +392,81 @@ class HyperdomeClient(QtWidgets.QMainWindow):
 
         self.start_chat_button.setEnabled(False)
         self.pub_key = self.crypt.public_chat_key
+        keyring = None
         if self.server.is_counselor:
-            self.crypt.import_key(
-                self.server.key.encode(), b"123"
-            )  # TODO: use private key encryption
-            signature = self.crypt.sign_message(self.pub_key.encode())
+            # TODO: use private key encryption
+            try:
+                keyring = CounselorKeyring(self.server.key.encode(), b"123")
+                signature = base64.urlsafe_b64encode(
+                    keyring.sign(self.pub_key.encode())
+                ).decode()
+            except ValueError:
+                # enrolled before Ed25519 identity keys, the server still accepts Ed448
+                self.crypt.import_key(self.server.key.encode(), b"123")
+                signature = self.crypt.sign_message(self.pub_key.encode())
         else:
             signature = ""
 
-        @api.attach_callback(self.client.start_chat, self.uid, self.pub_key, signature)
-        def after_start(counselor: str):
-            if self.client is None:
+        if not self.server.is_counselor:
+            self.is_waiting = True
+            self.start_chat_button.clicked.disconnect()
+            self.start_chat_button.clicked.connect(self.disconnect_chat)
+            self.start_chat_button.setEnabled(True)
+
+        def show_position(position: int) -> bool:
+            self.start_chat_button.setText(f"Waiting (#{position})")
+            return self.is_waiting
+
+        def waiting_failed():
+            if not self.is_waiting:
                 return
+            self.handle_error(
+                Exception("couldn't reach a counselor, try again shortly")
+            )
+            self.disconnect_chat()
 
-            if not self.server.is_counselor and not counselor:
-                self.__log.info("no counselors logged in to server")
-                Alert("No counselors available!")
-                self.start_chat_button.setEnabled(True)
+        @api.attach_callback(
+            self.client.start_chat,
+            self.uid,
+            self.pub_key,
+            signature,
+            show_position,
+            waiting_failed,
+        )
+        def after_start(counselor: str, chat_id: str):
+            if self.client is None or not (self.server.is_counselor or self.is_waiting):
+                # guest cancelled while waiting for a counselor
                 return
+            self.is_waiting = False
+
             if self.server.is_counselor:
                 self.uid = counselor
                 self.__log.info("counselor got uid")
-
-                def counselor_got_guest(guest_key: str):
-                    if not guest_key or self.client is None:
+                if keyring is not None:
+                    self.pre_keys = OneTimeKeyReplenisher(self.client, keyring, self)
+                    self.client.publish_pre_keys(self.pre_keys.keys_left, keyring)
+                    self.one_time_key_timer.timeout.connect(self.pre_keys.check)
+                    self.one_time_key_timer.start()
+
+                def counselor_got_guest(new_guests: list[dict[str, str]]):
+                    if not new_guests or self.client is None:
                         return
                     self.__log.info("counselor got assigned to guest")
                     self.poll_connected_guest_timer.stop()
                     self.poll_connected_guest_timer.disconnect()
-                    self.partner_key = guest_key
+                    if self.pre_keys is not None:
+                        self.pre_keys.check()
+                    # signed in with the default capacity of one guest
+                    guest_key = new_guests[0]["guest_key"]
+                    self.chat_id = new_guests[0]["chat_id"]
+                    self.partner_key = self.partner_id = guest_key
                     self.crypt.perform_key_exchange(
                         guest_key.encode(), self.server.is_counselor
                     )
-
-                    self.get_messages_timer.timeout.connect(
-                        lambda: self.client.get_messages(
-                            self.on_history_added, self.uid
-                        )
-                        if self.client
-                        else None
-                    )
+                    self.receive_messages()
 
                 self.poll_connected_guest_timer.timeout.connect(
-                    lambda: self.client.get_guest_pub_key(counselor_got_guest, self.uid)
+                    lambda: self.client.get_new_guests(counselor_got_guest, self.uid)
                     if self.client
                     else None
                 )
@@ -361,6 +474,8 @@ class HyperdomeClient(QtWidgets.QMainWindow):
 
             else:
                 self.partner_key = counselor
+                self.chat_id = self.pub_key
+                self.partner_id = chat_id
                 try:
                     self.crypt.perform_key_exchange(
                         counselor.encode(), self.server.is_counselor
@@ -370,12 +485,7 @@ class HyperdomeClient(QtWidgets.QMainWindow):
                     self.__log.info("didn't recieve valid counselor, no chat started")
                     return
 
-                self.get_messages_timer.timeout.connect(
-                    lambda: self.client.get_messages(self.on_history_added, self.uid)
-                    if self.client
-                    else None
-                )
-                self.get_messages_timer.start(5000)
+                self.receive_messages()
 
             self.start_chat_button.setText("Disconnect")
             self.start_chat_button.clicked.disconnect()
@@ -459,7 +569,14 @@ class HyperdomeClient(QtWidgets.QMainWindow):
                 timer.disconnect()
 
         reset_timer(self.poll_connected_guest_timer)
-        reset_timer(self.get_messages_timer)
+        reset_timer(self.one_time_key_timer)
+        self.pre_keys = None
+        self.is_polling = False
+        self.is_waiting = False
+
+        if self.chat_socket is not None:
+            socket, self.chat_socket = self.chat_socket, None
+            socket.close()
 
     def disconnect_chat(self):
         self.start_chat_button.setEnabled(False)
@@ -469,11 +586,17 @@ class HyperdomeClient(QtWidgets.QMainWindow):
             self.__log.info("no connection to disconnect")
             return
 
-        @api.attach_callback(self.client.counseling_complete, self.pub_key)
+        @api.attach_callback(
+            self.client.counseling_complete, self.chat_id or self.pub_key
+        )
         def disconnect():
             self.__log.info("counseling completed")
             self.partner_key = ""
 
+        self.client.outboxes.pop(self.partner_id, None)
+        self.chat_id = ""
+        self.partner_id = ""
+
         if self.server.is_counselor:
 
             @api.attach_callback(self.client.signout_counselor, self.uid)
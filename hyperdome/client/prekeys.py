@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2019 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import base64
+import time
+from typing import Callable
+
+import autologging
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+from ..common.encryption import CounselorKeyring
+from . import api
+
+# upload more one-time keys once the server has fewer than this many left
+LOW_WATERMARK = 20
+# one-time keys generated and uploaded at a time
+BATCH_SIZE = 100
+# seconds after which a batch that was never uploaded no longer holds up the next
+GENERATE_TIMEOUT_SECONDS = 300
+
+
+@autologging.logged
+class _Generate(QRunnable):
+    """
+    generate a batch of one-time keys off the main thread
+    """
+
+    __log: autologging.logging.Logger  # makes linter happy about autologging
+
+    def __init__(
+        self,
+        keyring: CounselorKeyring,
+        done: Callable[[bytes], None],
+        failed: Callable[[], None],
+    ):
+        super().__init__()
+        self.keyring = keyring
+        self.done = done
+        self.failed = failed
+
+    def run(self):
+        try:
+            keys = self.keyring.one_time_keys_upload(BATCH_SIZE)
+        except Exception:
+            # raising here would abort the application
+            self.__log.exception("couldn't generate one-time keys")
+            self.failed()
+            return
+        self.done(keys)
+
+
+@autologging.logged
+class OneTimeKeyReplenisher(QObject):
+    """
+    keeps a counselor's one-time keys on the server above LOW_WATERMARK,
+    so guests starting chats never find none left
+    """
+
+    __log: autologging.logging.Logger  # makes linter happy about autologging
+
+    # emitted from the generating thread, delivered on the main thread
+    generated = pyqtSignal(bytes)
+    generation_failed = pyqtSignal()
+
+    def __init__(
+        self, client: api.HyperdomeClientApi, keyring: CounselorKeyring, parent=None
+    ):
+        super().__init__(parent)
+        self.client = client
+        self.keyring = keyring
+        self.identity = base64.urlsafe_b64encode(keyring.identity_key_bytes).decode()
+        self.generating = False
+        self.generating_since = 0.0
+        self.generated.connect(self.upload)
+        self.generation_failed.connect(self.failed)
+
+    def check(self):
+        """
+        ask the server how many one-time keys are left, replenishing if needed
+        """
+        self.client.get_one_time_key_count(self.keys_left, self.identity)
+
+    def keys_left(self, count):
+        if not isinstance(count, int) or count >= LOW_WATERMARK:
+            return
+        if (
+            self.generating
+            and time.monotonic() - self.generating_since < GENERATE_TIMEOUT_SECONDS
+        ):
+            return
+        self.__log.info(f"{count} one-time keys left, generating more")
+        self.generating = True
+        self.generating_since = time.monotonic()
+        QThreadPool.globalInstance().start(
+            _Generate(self.keyring, self.generated.emit, self.generation_failed.emit)
+        )
+
+    def failed(self):
+        # the next check tries again
+        self.generating = False
+
+    def upload(self, keys: bytes):
+        started = self.generating_since
+
+        def uploaded(count):
+            if self.generating_since != started:
+                # timed out, a newer batch is on its way
+                return
+            self.generating = False
+            if isinstance(count, int):
+                self.keyring.one_time_keys_uploaded(keys)
+            # still short if guests took keys faster than they were made
+            self.keys_left(count)
+
+        self.client.upload_one_time_keys(uploaded, self.identity, keys)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# compact binary framing for chat content
+#
+# every frame starts with a version byte and a content type byte:
+#   introduction:      scheme id (1) | ephemeral key (32) | one time key (32)
+#   encrypted message: varint sequence | nonce (12) | varint len(ad) + 1, 0 for none
+#                      | associated data | ciphertext (rest of frame)
+#   status:            status code (1)
+#
+# the encryption scheme is only sent in the introduction, every encrypted message
+# after it in the session is assumed to use the same scheme
+#
+# frames are sent as binary websocket messages, which the server relays to the
+# other side of the chat untouched
+#
+# key exchange bundles handed to guests have no content type:
+#   version (1) | signing key (32) | signed pre key (32) | pre key signature (64)
+#               | one time key (32) | key index (4) | key count (4)
+#               | one time keys signature (64) | inclusion proof (32 each)
+# everything before the one time key is the same in each of a counselor's bundles,
+# the rest shows the key is in the set the counselor signed, see merkle.py
+#
+# one time keys uploaded by a counselor are sent raw, with one signature
+# committing to all of their one time keys including these:
+#   version (1) | signature (64) | one time keys (32 each)
+
+from .schemas import (
+    DEFAULT_ENCRYPTION_SCHEME,
+    ChatContent,
+    ChatContentType,
+    EncryptedMessage,
+    EncryptionScheme,
+    IntroductionMessage,
+    KeyExchangeBundle,
+    StatusMessage,
+    StatusType,
+)
+
+FRAME_VERSION = 1
+# the server refuses chat messages any longer than this
+MAX_FRAME_LENGTH = 64 << 10
+# enough for any 64 bit value
+MAX_VARINT_LENGTH = 10
+
+KEY_LENGTH = 32
+NONCE_LENGTH = 12
+SIGNATURE_LENGTH = 64
+BUNDLE_PREFIX_LENGTH = 1 + 2 * KEY_LENGTH + SIGNATURE_LENGTH
+# a bundle with an empty inclusion proof, when it's the only key in its set
+BUNDLE_MIN_LENGTH = BUNDLE_PREFIX_LENGTH + KEY_LENGTH + 8 + SIGNATURE_LENGTH
+
+CONTENT_TYPES = {
+    ChatContentType.INTRODUCTION: 1,
+    ChatContentType.ENCRYPTED_MESSAGE: 2,
+    ChatContentType.STATUS: 3,
+}
+CONTENT_TYPE_CODES = {code: kind for kind, code in CONTENT_TYPES.items()}
+
+STATUS_TYPES = {
+    StatusType.DISCONNECT: 1,
+    StatusType.QUEUE_FULL: 2,
+}
+STATUS_TYPE_CODES = {code: status for status, code in STATUS_TYPES.items()}
+
+# encryption schemes that can be negotiated in an introduction, by id
+ENCRYPTION_SCHEMES = {
+    1: DEFAULT_ENCRYPTION_SCHEME,
+}
+
+
+def _scheme_id(scheme: EncryptionScheme) -> int:
+    for scheme_id, known_scheme in ENCRYPTION_SCHEMES.items():
+        if known_scheme == scheme:
+            return scheme_id
+    raise ValueError(f"no id for encryption scheme {scheme}")
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    encode a non-negative integer in as few 7 bit groups as it needs, low groups first
+    """
+    if value < 0:
+        raise ValueError("varints must be non-negative")
+    if value >> 7 * MAX_VARINT_LENGTH:
+        raise ValueError(f"varints are at most {MAX_VARINT_LENGTH} bytes")
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data: bytes, offset: int = 0) -> tuple[int, int]:
+    """
+    decode a varint starting at offset
+    returns its value and the offset of the byte following it
+    """
+    value = 0
+    for shift in range(0, 7 * MAX_VARINT_LENGTH, 7):
+        try:
+            byte = data[offset]
+        except IndexError:
+            raise ValueError("truncated varint") from None
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+    raise ValueError(f"varints are at most {MAX_VARINT_LENGTH} bytes")
+
+
+def encode(
+    content: ChatContent, scheme: EncryptionScheme = DEFAULT_ENCRYPTION_SCHEME
+) -> bytes:
+    """
+    encode chat content as a binary frame
+    scheme is the encryption scheme negotiated for the session
+    """
+    frame = _encode(content, scheme)
+    if len(frame) > MAX_FRAME_LENGTH:
+        raise ValueError(f"frames are at most {MAX_FRAME_LENGTH} bytes")
+    return frame
+
+
+def _encode(content: ChatContent, scheme: EncryptionScheme) -> bytes:
+    header = bytes((FRAME_VERSION, CONTENT_TYPES[content.type]))
+    match content.content:
+        case IntroductionMessage() as introduction:
+            return (
+                header
+                + bytes((_scheme_id(introduction.encryption),))
+                + introduction.ephemeral_key
+                + introduction.one_time_key
+            )
+        case EncryptedMessage() as message:
+            if message.encryption != scheme:
+                raise ValueError("message does not use the session's encryption")
+            associated_data = message.associated_data
+            return b"".join(
+                (
+                    header,
+                    encode_varint(message.sequence),
+                    message.nonce,
+                    encode_varint(
+                        0 if associated_data is None else len(associated_data) + 1
+                    ),
+                    associated_data or b"",
+                    message.ciphertext,
+                )
+            )
+        case StatusMessage() as status:
+            return header + bytes((STATUS_TYPES[status.status],))
+    raise TypeError(f"can't encode {type(content.content).__name__}")
+
+
+def decode(
+    frame: bytes,
+    scheme: EncryptionScheme = DEFAULT_ENCRYPTION_SCHEME,
+    validate: bool = True,
+) -> ChatContent:
+    """
+    decode a binary frame into chat content, raising ValueError if it is malformed
+    scheme is the encryption scheme negotiated for the session
+
+    frames from trusted sources can skip validating the decoded models
+    with validate set to False
+    """
+    if len(frame) < 2:
+        raise ValueError("truncated frame")
+    if len(frame) > MAX_FRAME_LENGTH:
+        raise ValueError(f"frames are at most {MAX_FRAME_LENGTH} bytes")
+    if frame[0] != FRAME_VERSION:
+        raise ValueError(f"unsupported frame version {frame[0]}")
+    try:
+        content_type = CONTENT_TYPE_CODES[frame[1]]
+    except KeyError:
+        raise ValueError(f"unknown content type {frame[1]}") from None
+    body = memoryview(frame)[2:]
+    match content_type:
+        case ChatContentType.INTRODUCTION:
+            if len(body) != 1 + 2 * KEY_LENGTH:
+                raise ValueError("introduction has the wrong length")
+            try:
+                encryption = ENCRYPTION_SCHEMES[body[0]]
+            except KeyError:
+                raise ValueError(f"unknown encryption scheme {body[0]}") from None
+            fields = dict(
+                ephemeral_key=bytes(body[1 : 1 + KEY_LENGTH]),
+                one_time_key=bytes(body[1 + KEY_LENGTH :]),
+                encryption=encryption,
+            )
+            model = IntroductionMessage
+        case ChatContentType.ENCRYPTED_MESSAGE:
+            sequence, offset = decode_varint(body)
+            nonce = bytes(body[offset : offset + NONCE_LENGTH])
+            if len(nonce) != NONCE_LENGTH:
+                raise ValueError("truncated nonce")
+            ad_length, offset = decode_varint(body, offset + NONCE_LENGTH)
+            associated_data = None
+            if ad_length:
+                associated_data = bytes(body[offset : offset + ad_length - 1])
+                offset += ad_length - 1
+                if len(associated_data) != ad_length - 1:
+                    raise ValueError("truncated associated data")
+            fields = dict(
+                sequence=sequence,
+                nonce=nonce,
+                ciphertext=bytes(body[offset:]),
+                associated_data=associated_data,
+                encryption=scheme,
+            )
+            model = EncryptedMessage
+        case ChatContentType.STATUS:
+            if len(body) != 1:
+                raise ValueError("status has the wrong length")
+            try:
+                fields = dict(status=STATUS_TYPE_CODES[body[0]])
+            except KeyError:
+                raise ValueError(f"unknown status {body[0]}") from None
+            model = StatusMessage
+    if not validate:
+        return ChatContent.construct(
+            type=content_type, content=model.construct(**fields)
+        )
+    return ChatContent(type=content_type, content=model(**fields))
+
+
+def encode_bundle_prefix(
+    pub_signing_key: bytes, signed_pre_key: bytes, pre_key_signature: bytes
+) -> bytes:
+    """
+    the part of a key exchange bundle shared by every one of a counselor's bundles,
+    a complete bundle is this followed by encode_one_time_key
+    """
+    if len(pub_signing_key) != KEY_LENGTH or len(signed_pre_key) != KEY_LENGTH:
+        raise ValueError("keys must be 32 bytes")
+    if len(pre_key_signature) != SIGNATURE_LENGTH:
+        raise ValueError("signatures must be 64 bytes")
+    return (
+        bytes((FRAME_VERSION,)) + pub_signing_key + signed_pre_key + pre_key_signature
+    )
+
+
+def encode_one_time_key(
+    one_time_key: bytes, index: int, count: int, signature: bytes, proof: list[bytes]
+) -> bytes:
+    """
+    the part of a key exchange bundle particular to its one time key
+    """
+    if len(one_time_key) != KEY_LENGTH or any(len(p) != KEY_LENGTH for p in proof):
+        raise ValueError("keys must be 32 bytes")
+    if len(signature) != SIGNATURE_LENGTH:
+        raise ValueError("signatures must be 64 bytes")
+    return (
+        one_time_key
+        + index.to_bytes(4, "big")
+        + count.to_bytes(4, "big")
+        + signature
+        + b"".join(proof)
+    )
+
+
+def encode_bundle(bundle: KeyExchangeBundle) -> bytes:
+    return encode_bundle_prefix(
+        bundle.pub_signing_key, bundle.signed_pre_key, bundle.pre_key_signature
+    ) + encode_one_time_key(
+        bundle.one_time_key,
+        bundle.one_time_key_index,
+        bundle.one_time_keys_count,
+        bundle.one_time_keys_signature,
+        bundle.one_time_key_proof,
+    )
+
+
+def decode_bundle(data: bytes, validate: bool = True) -> KeyExchangeBundle:
+    """
+    decode a key exchange bundle, raising ValueError if it is malformed
+    """
+    if len(data) < BUNDLE_MIN_LENGTH or (len(data) - BUNDLE_MIN_LENGTH) % KEY_LENGTH:
+        raise ValueError("key exchange bundle has the wrong length")
+    if data[0] != FRAME_VERSION:
+        raise ValueError(f"unsupported bundle version {data[0]}")
+    offset = BUNDLE_PREFIX_LENGTH + KEY_LENGTH
+    fields = dict(
+        pub_signing_key=data[1 : 1 + KEY_LENGTH],
+        signed_pre_key=data[1 + KEY_LENGTH : 1 + 2 * KEY_LENGTH],
+        pre_key_signature=data[1 + 2 * KEY_LENGTH : BUNDLE_PREFIX_LENGTH],
+        one_time_key=data[BUNDLE_PREFIX_LENGTH:offset],
+        one_time_key_index=int.from_bytes(data[offset : offset + 4], "big"),
+        one_time_keys_count=int.from_bytes(data[offset + 4 : offset + 8], "big"),
+        one_time_keys_signature=data[offset + 8 : BUNDLE_MIN_LENGTH],
+        one_time_key_proof=[
+            data[start : start + KEY_LENGTH]
+            for start in range(BUNDLE_MIN_LENGTH, len(data), KEY_LENGTH)
+        ],
+    )
+    if not validate:
+        return KeyExchangeBundle.construct(**fields)
+    return KeyExchangeBundle(**fields)
+
+
+def encode_one_time_keys(signature: bytes, keys: bytes) -> bytes:
+    """
+    encode concatenated one time keys with the signature over them for upload
+    """
+    if len(signature) != SIGNATURE_LENGTH:
+        raise ValueError("signatures must be 64 bytes")
+    if len(keys) % KEY_LENGTH:
+        raise ValueError("keys must be 32 bytes")
+    return bytes((FRAME_VERSION,)) + signature + keys
+
+
+def decode_one_time_keys(data: bytes) -> tuple[bytes, bytes]:
+    """
+    the signature and concatenated one time keys of an upload,
+    raising ValueError if it is malformed
+    """
+    if len(data) < 1 + SIGNATURE_LENGTH:
+        raise ValueError("truncated one time key upload")
+    if data[0] != FRAME_VERSION:
+        raise ValueError(f"unsupported upload version {data[0]}")
+    keys = data[1 + SIGNATURE_LENGTH :]
+    if len(keys) % KEY_LENGTH:
+        raise ValueError("one time keys must be 32 bytes")
+    return data[1 : 1 + SIGNATURE_LENGTH], keys
@@ -215,6 +215,15 @@ class Settings(object):
             # perhaps "use ephemeral"
             "private_key": "",
             "hidservauth_string": "",
+            "matching_strategy": "random",
+            "max_chat_messages": 1000,
+            "max_chat_bytes": 1 << 20,
+            "message_memory_budget": 256 << 20,
+            "session_ttl": 120,
+            "state_backend": "memory",
+            "workers": 1,
+            "metrics_port": 0,
+            "max_active_chats": 10_000,
             "locale": None,  # this gets defined in fill_in_defaults()
         }
         self._settings: dict[str] = {}
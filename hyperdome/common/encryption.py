@@ -19,7 +19,11 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from collections import deque
+import hashlib
+import hmac
 import secrets
+import threading
 
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.backends import default_backend
@@ -41,6 +45,8 @@ from cryptography.hazmat.primitives.serialization import (
     BestAvailableEncryption,
 )
 
+from hyperdome.common import merkle
+from hyperdome.common.codec import encode_one_time_keys
 from hyperdome.common.key_conversion import (
     x25519_from_ed25519_private_key,
     x25519_from_ed25519_public_key,
@@ -57,6 +63,21 @@ from hyperdome.common.schemas import (
 )
 
 
+# parameters of the HKDF-BLAKE2b ratchet step. with a fixed salt and 64 bytes out,
+# HKDF is one HMAC to extract and one to expand a single block, done directly
+# so each step doesn't construct an HKDF
+RATCHET_SALT = b"g9V1g/blZmlPV1wXTxwTWRokO5HCvLOY"
+RATCHET_INFO = b"key ratchet increment"
+_RATCHET_EXPAND_INFO = RATCHET_INFO + b"\x01"
+# message keys a chat session derives at a time
+RATCHET_WINDOW = 8
+
+
+def _ratchet_step(kdf_key: bytes) -> bytes:
+    pseudorandom_key = hmac.digest(RATCHET_SALT, kdf_key, hashlib.blake2b)
+    return hmac.digest(pseudorandom_key, _RATCHET_EXPAND_INFO, hashlib.blake2b)
+
+
 class KeyRatchet:
     """
     HKDF key ratchet using blake2b digests generating one-time use 256-bit key material.
@@ -64,26 +85,33 @@ class KeyRatchet:
     This construct should only be initialized with bytes suitable for key material.
 
     This construct only does key management, not encryption/decryption.
+
+    With a window keys are derived that many at a time, and held until used.
     """
 
-    def __init__(self, initial_key_material: bytes):
+    def __init__(self, initial_key_material: bytes, window: int = 1):
         if len(initial_key_material) != 32:
             raise ValueError("initial key material must be 32 bytes")
+        if window < 1:
+            raise ValueError("window must hold at least one key")
         self._kdf_key = initial_key_material
+        self._window = window
+        self._next_keys: deque[bytes] = deque()
         self._counter: int = 0
         self._increment()
 
+    def _derive_window(self):
+        kdf_key = self._kdf_key
+        for _ in range(self._window):
+            new_key_bytes = _ratchet_step(kdf_key)
+            kdf_key = new_key_bytes[32:]
+            self._next_keys.append(new_key_bytes[:32])
+        self._kdf_key = kdf_key
+
     def _increment(self):
-        key_derivation_function = HKDF(
-            hashes.BLAKE2b(64),
-            64,
-            b"g9V1g/blZmlPV1wXTxwTWRokO5HCvLOY",
-            b"key ratchet increment",
-            default_backend(),
-        )
-        new_key_bytes = key_derivation_function.derive(self._kdf_key)
-        self._kdf_key = new_key_bytes[32:]
-        self._enc_key = new_key_bytes[:32]
+        if not self._next_keys:
+            self._derive_window()
+        self._enc_key = self._next_keys.popleft()
         self._counter += 1
 
     @property
@@ -98,8 +126,8 @@ class KeyRatchet:
 
 
 class MessageEncryptor:
-    def __init__(self, initial_key_material: bytes):
-        self._ratchet = KeyRatchet(initial_key_material)
+    def __init__(self, initial_key_material: bytes, window: int = RATCHET_WINDOW):
+        self._ratchet = KeyRatchet(initial_key_material, window)
 
     def encrypt(
         self, plaintext: bytes, associated_data: bytes | None = None
@@ -117,8 +145,8 @@ class MessageEncryptor:
 
 
 class MessageDecryptor:
-    def __init__(self, initial_key_material: bytes):
-        self._ratchet = KeyRatchet(initial_key_material)
+    def __init__(self, initial_key_material: bytes, window: int = RATCHET_WINDOW):
+        self._ratchet = KeyRatchet(initial_key_material, window)
         self._run_ahead_buffer: dict[int, ChaCha20Poly1305] = dict()
 
     def _run_ahead(self, sequence: int):
@@ -208,6 +236,16 @@ class GuestKeyring:
         cid_key = Ed25519PublicKey.from_public_bytes(key_bundle.pub_signing_key)
         csp_key = X25519PublicKey.from_public_bytes(key_bundle.signed_pre_key)
         ot_key = X25519PublicKey.from_public_bytes(key_bundle.one_time_key)
+        root = merkle.root_from_proof(
+            key_bundle.one_time_key,
+            key_bundle.one_time_key_index,
+            key_bundle.one_time_keys_count,
+            key_bundle.one_time_key_proof,
+        )
+        cid_key.verify(
+            key_bundle.one_time_keys_signature,
+            merkle.commitment(key_bundle.one_time_keys_count, root),
+        )
         (self._encryptor, self._decryptor) = HA3DH.exchange(
             cid_key, csp_key, self._private_key, ot_key, key_bundle.pre_key_signature
         )
@@ -222,11 +260,65 @@ class GuestKeyring:
         return self._decryptor.decrypt(message)
 
 
+class OneTimeKeyPool:
+    """
+    X25519 key pairs generated ahead of time by a background thread,
+    which runs while fewer than size are ready
+    """
+
+    def __init__(self, size: int = 100) -> None:
+        self.size = size
+        self._ready: deque[tuple[PubKeyBytes, X25519PrivateKey]] = deque()
+        self._changed = threading.Condition()
+        self._producing = False
+        with self._changed:
+            self._produce_more()
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def _produce_more(self):
+        # must hold self._changed
+        if not self._producing and len(self._ready) < self.size:
+            self._producing = True
+            threading.Thread(target=self._produce, daemon=True).start()
+
+    def _produce(self):
+        while True:
+            with self._changed:
+                if len(self._ready) >= self.size:
+                    self._producing = False
+                    return
+            key = X25519PrivateKey.generate()
+            key_bytes = PubKeyBytes(
+                key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+            )
+            with self._changed:
+                self._ready.append((key_bytes, key))
+                self._changed.notify_all()
+
+    def take(self, count: int) -> list[tuple[PubKeyBytes, X25519PrivateKey]]:
+        """
+        count key pairs, waiting for any that aren't ready yet
+        """
+        taken = []
+        with self._changed:
+            while len(taken) < count:
+                if self._ready:
+                    taken.append(self._ready.popleft())
+                else:
+                    self._produce_more()
+                    self._changed.wait()
+            self._produce_more()
+        return taken
+
+
 class CounselorKeyring:
     def __init__(
         self,
         encrypted_private_key: bytes | None = None,
         key_passphrase: bytes | None = None,
+        one_time_keys: int = 100,
     ) -> None:
         if isinstance(encrypted_private_key, bytes) and isinstance(
             key_passphrase, bytes
@@ -241,47 +333,130 @@ class CounselorKeyring:
         self.public_signing_key = self._private_signing_key.public_key()
 
         self._pre_key = X25519PrivateKey.generate()
+        # one-time keys are generated in the background from construction on,
+        # and only drawn from the pool once they're published
+        self._key_pool = OneTimeKeyPool(one_time_keys)
         self._one_time_key_pairs: dict[PubKeyBytes, X25519PrivateKey] = dict()
-        self._generate_one_time_keys()
-
-    def _generate_one_time_keys(self):
-        for _ in range(100):
-            key = X25519PrivateKey.generate()
-            key_bytes = PubKeyBytes(
-                key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
-            )
-            self._one_time_key_pairs[key_bytes] = key
+        # bumped whenever the one-time keys change, invalidating their signature
+        self._key_set_version = 0
+        # the published one-time keys, including any since taken by exchanges,
+        # held while drawing keys as uploads may come from a background thread
+        self._key_tree = merkle.MerkleTree()
+        self._key_tree_lock = threading.Lock()
+        # an upload's keys join the tree only once the server accepts them,
+        # held with the tree it was signed on top of and the tree it signed
+        self._pending_upload: tuple[
+            bytes, merkle.MerkleTree, merkle.MerkleTree
+        ] | None = None
+        self._pre_key_signed: tuple[X25519PrivateKey, bytes, bytes] | None = None
+        self._one_time_keys_signed: tuple[int, list[PubKeyBytes], bytes] | None = None
+
+    def _generate_one_time_keys(self, count: int | None = None) -> list[PubKeyBytes]:
+        # added in one update so this can run in a background thread
+        # while exchanges take keys out
+        if count is None:
+            count = self._key_pool.size
+        key_pairs = dict(self._key_pool.take(count))
+        self._one_time_key_pairs.update(key_pairs)
+        self._key_set_version += 1
+        return list(key_pairs)
 
     def sign(self, data: bytes):
         return self._private_signing_key.sign(data)
 
+    @property
+    def identity_key_bytes(self):
+        return self.public_signing_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+    def _signed_pre_key(self) -> tuple[X25519PrivateKey, bytes, bytes]:
+        if self._pre_key_signed is None or self._pre_key_signed[0] is not self._pre_key:
+            key_bytes = self._pre_key.public_key().public_bytes(
+                Encoding.Raw, PublicFormat.Raw
+            )
+            self._pre_key_signed = (self._pre_key, key_bytes, self.sign(key_bytes))
+        return self._pre_key_signed
+
+    def _sign_key_tree(self, tree: merkle.MerkleTree) -> bytes:
+        return self.sign(merkle.commitment(len(tree), tree.root))
+
+    def _signed_one_time_keys(self) -> tuple[int, list[PubKeyBytes], bytes]:
+        # building a bundle starts a new tree of the keys not yet taken,
+        # as publishing it replaces the counselor's one-time keys on the server
+        with self._key_tree_lock:
+            if (
+                self._one_time_keys_signed is None
+                or self._one_time_keys_signed[0] != self._key_set_version
+            ):
+                if not self._one_time_key_pairs:
+                    self._generate_one_time_keys()
+                keys = list(self._one_time_key_pairs)
+                self._key_tree = merkle.MerkleTree(keys)
+                self._one_time_keys_signed = (
+                    self._key_set_version,
+                    keys,
+                    self._sign_key_tree(self._key_tree),
+                )
+            return self._one_time_keys_signed
+
     @property
     def pre_key_bytes(self):
-        return self._pre_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return self._signed_pre_key()[1]
 
     @property
     def pre_key_signature(self):
-        return self.sign(self.pre_key_bytes)
+        return self._signed_pre_key()[2]
 
     @property
     def one_time_keys_signature(self):
-        key_bytes = b""
-        for key in self._one_time_key_pairs.keys():
-            key_bytes += key
-        return self.sign(key_bytes)
+        return self._signed_one_time_keys()[2]
 
     @property
     def pre_key_bundle(self):
+        """
+        the signed pre key and one-time keys to publish,
+        drawing a batch of one-time keys if none are left
+        """
+        _, one_time_keys, signature = self._signed_one_time_keys()
         return NewPreKeyBundle(
             signed_pre_key=PubKeyBytes(self.pre_key_bytes),
             pre_key_signature=SignatureBytes(self.pre_key_signature),
-            one_time_keys=[PubKeyBytes(key) for key in self._one_time_key_pairs.keys()],
-            one_time_keys_signature=SignatureBytes(self.one_time_keys_signature),
+            one_time_keys=one_time_keys,
+            one_time_keys_signature=SignatureBytes(signature),
         )
 
+    def one_time_keys_upload(self, count: int = 100) -> bytes:
+        """
+        draw more one-time keys, encoded for upload as by codec.encode_one_time_keys
+        with a signature committing to them added to those already published
+        upload one batch at a time, passing each to one_time_keys_uploaded
+        once the server accepts it
+        """
+        with self._key_tree_lock:
+            keys = self._generate_one_time_keys(count)
+            tree = self._key_tree.copy()
+            tree.extend(keys)
+            upload = encode_one_time_keys(self._sign_key_tree(tree), b"".join(keys))
+            self._pending_upload = (upload, self._key_tree, tree)
+            return upload
+
+    def one_time_keys_uploaded(self, upload: bytes):
+        """
+        add the keys of an upload the server accepted to those published,
+        a failed upload's keys are left out so the next one is signed without them
+        """
+        with self._key_tree_lock:
+            if self._pending_upload is None or self._pending_upload[0] != upload:
+                return
+            _, base, tree = self._pending_upload
+            self._pending_upload = None
+            # publishing a bundle since replaced the tree the upload added to
+            if self._key_tree is base:
+                self._key_tree = tree
+
     def exchange(self, key_bundle: IntroductionMessage):
         eph_key = X25519PublicKey.from_public_bytes(key_bundle.ephemeral_key)
         ot_key = self._one_time_key_pairs.pop(key_bundle.one_time_key)
+        self._key_set_version += 1
 
         (self._encryptor, self._decryptor) = HA3DH.exchange(
             self._private_signing_key, self._pre_key, eph_key, ot_key
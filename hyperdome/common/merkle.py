@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# one-time keys are committed to as a merkle tree shaped as in RFC 9162,
+# so one key can be shown to be in a signed set with a hash per level
+#   leaf hash: H(0x00 | key)    node hash: H(0x01 | left | right)
+# with H as 32 byte BLAKE2b. the counselor signs COMMITMENT_PREFIX | size (4) | root
+
+from collections.abc import Iterable
+import hashlib
+
+HASH_LENGTH = 32
+COMMITMENT_PREFIX = b"hyperdome one-time keys"
+
+
+def leaf_hash(key: bytes) -> bytes:
+    return hashlib.blake2b(b"\x00" + key, digest_size=HASH_LENGTH).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.blake2b(b"\x01" + left + right, digest_size=HASH_LENGTH).digest()
+
+
+def commitment(size: int, root: bytes) -> bytes:
+    """
+    what the counselor signs to commit to a set of size one-time keys
+    """
+    return COMMITMENT_PREFIX + size.to_bytes(4, "big") + root
+
+
+def _split(size: int) -> int:
+    # the largest power of two smaller than size
+    return 1 << ((size - 1).bit_length() - 1)
+
+
+class MerkleTree:
+    """
+    an append-only merkle tree of keys
+
+    Every complete subtree's hash is kept, packed end to end by level,
+    so appending rehashes one node per level and proofs need no rehashing
+    of complete subtrees.
+    """
+
+    def __init__(self, keys: Iterable[bytes] = ()) -> None:
+        self._levels: list[bytearray] = [bytearray()]
+        self.extend(keys)
+
+    def __len__(self) -> int:
+        return len(self._levels[0]) // HASH_LENGTH
+
+    def copy(self) -> "MerkleTree":
+        tree = MerkleTree()
+        tree._levels = [bytearray(level) for level in self._levels]
+        return tree
+
+    def append(self, key: bytes):
+        node = leaf_hash(key)
+        for level in self._levels:
+            level += node
+            if len(level) // HASH_LENGTH % 2:
+                return
+            node = node_hash(
+                bytes(level[-2 * HASH_LENGTH : -HASH_LENGTH]),
+                bytes(level[-HASH_LENGTH:]),
+            )
+        self._levels.append(bytearray(node))
+
+    def extend(self, keys: Iterable[bytes]):
+        for key in keys:
+            self.append(key)
+
+    def _node(self, height: int, index: int) -> bytes:
+        level = self._levels[height]
+        return bytes(level[index * HASH_LENGTH : (index + 1) * HASH_LENGTH])
+
+    def _subtree(self, start: int, end: int) -> bytes:
+        size = end - start
+        if not size & (size - 1):
+            height = size.bit_length() - 1
+            return self._node(height, start >> height)
+        middle = start + _split(size)
+        return node_hash(self._subtree(start, middle), self._subtree(middle, end))
+
+    @property
+    def root(self) -> bytes:
+        if not len(self):
+            return hashlib.blake2b(b"", digest_size=HASH_LENGTH).digest()
+        return self._subtree(0, len(self))
+
+    def proof(self, index: int) -> list[bytes]:
+        """
+        hashes from the key at index up to the root, as checked by root_from_proof
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("no key at that index")
+        path = []
+        start, end = 0, len(self)
+        while end - start > 1:
+            middle = start + _split(end - start)
+            if index < middle:
+                path.append(self._subtree(middle, end))
+                end = middle
+            else:
+                path.append(self._subtree(start, middle))
+                start = middle
+        path.reverse()
+        return path
+
+
+def root_from_proof(key: bytes, index: int, size: int, proof: list[bytes]) -> bytes:
+    """
+    the root of a tree of size keys with key at index, given its proof,
+    raising ValueError if the proof can't be for such a tree
+    """
+    if not 0 <= index < size:
+        raise ValueError("key index outside the tree")
+    node, size = leaf_hash(key), size - 1
+    for sibling in proof:
+        if not size:
+            raise ValueError("inclusion proof is too long")
+        if index & 1 or index == size:
+            node = node_hash(sibling, node)
+            while not index & 1 and index:
+                index, size = index >> 1, size >> 1
+        else:
+            node = node_hash(node, sibling)
+        index, size = index >> 1, size >> 1
+    if size:
+        raise ValueError("inclusion proof is too short")
+    return node
@@ -58,10 +58,16 @@ class NonceBytes(ConstrainedBytes):
     max_length = 12
 
 
+class HashBytes(ConstrainedBytes):
+    min_length = 32
+    max_length = 32
+
+
 class NewPreKeyBundle(BaseModel):
     signed_pre_key: PubKeyBytes = Required
     pre_key_signature: SignatureBytes = Required
     one_time_keys: list[PubKeyBytes] = Required
+    # signs merkle.commitment of a tree of one_time_keys
     one_time_keys_signature: SignatureBytes = Required
 
 
@@ -70,6 +76,11 @@ class KeyExchangeBundle(BaseModel):
     signed_pre_key: PubKeyBytes = Required
     pre_key_signature: SignatureBytes = Required
     one_time_key: PubKeyBytes = Required
+    # shows one_time_key is in a signed set of one_time_keys_count keys
+    one_time_key_index: int = Required
+    one_time_keys_count: int = Required
+    one_time_keys_signature: SignatureBytes = Required
+    one_time_key_proof: list[HashBytes] = Required
 
 
 class CounselorKeys(BaseModel):
@@ -93,11 +104,6 @@ class ChatContentType(StrEnum):
     STATUS = auto()
 
 
-class IntroductionMessage(BaseModel):
-    ephemeral_key: PubKeyBytes = Required
-    one_time_key: PubKeyBytes = Required
-
-
 class EncryptionScheme(BaseModel):
     version: str = "v1"
     cipher: str = "ChaCha20Poly1305"
@@ -108,6 +114,12 @@ class EncryptionScheme(BaseModel):
 DEFAULT_ENCRYPTION_SCHEME = EncryptionScheme()
 
 
+class IntroductionMessage(BaseModel):
+    ephemeral_key: PubKeyBytes = Required
+    one_time_key: PubKeyBytes = Required
+    encryption: EncryptionScheme = DEFAULT_ENCRYPTION_SCHEME
+
+
 class EncryptedMessage(BaseModel):
     sequence: int = Required
     nonce: NonceBytes = Required
@@ -118,6 +130,7 @@ class EncryptedMessage(BaseModel):
 
 class StatusType(StrEnum):
     DISCONNECT = auto()
+    QUEUE_FULL = auto()
 
 
 class StatusMessage(BaseModel):
@@ -125,5 +138,5 @@ class StatusMessage(BaseModel):
 
 
 class ChatContent(BaseModel):
-    _type: ChatContentType = Required
+    type: ChatContentType = Required
     content: IntroductionMessage | EncryptedMessage | StatusMessage = Required
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import time
+
+
+class ActivityTracker:
+    """
+    last activity time of every session, kept oldest first
+
+    Touching a session moves it to the back, so the sessions at the front are
+    always the longest idle and finding expired ones never scans live sessions.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._last_seen: OrderedDict[str, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
+
+    def __contains__(self, session_id: object) -> bool:
+        return session_id in self._last_seen
+
+    def touch(self, session_id: str):
+        self._last_seen[session_id] = time.monotonic()
+        self._last_seen.move_to_end(session_id)
+
+    def forget(self, session_id: str):
+        self._last_seen.pop(session_id, None)
+
+    def expired(self) -> list[str]:
+        """
+        remove and return every session idle for longer than the ttl
+        """
+        cutoff = time.monotonic() - self.ttl
+        expired = []
+        while self._last_seen:
+            session_id, last_seen = next(iter(self._last_seen.items()))
+            if last_seen > cutoff:
+                break
+            del self._last_seen[session_id]
+            expired.append(session_id)
+        return expired
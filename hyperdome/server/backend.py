@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import Counter
+from collections.abc import Callable
+from typing import TypeVar
+
+from .mailbox import Frame
+
+T = TypeVar("T")
+
+
+class StateBackend:
+    """
+    where the server keeps counselor sessions, the waiting room and chat mailboxes
+
+    Methods are synchronous and called from the event loop through run(),
+    waiting is done through the mailbox and waiting guest objects they return,
+    which have async wait methods. ChatRouter keeps everything in process
+    memory, shared backends let several worker processes serve the same chats.
+    """
+
+    reaped: Counter[str]
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        call fn, a method of the backend or of an object it returned
+        backends that block on I/O run it off the event loop
+        """
+        return fn(*args)
+
+    @property
+    def online(self) -> int:
+        """
+        number of counselors able to take another guest
+        """
+        raise NotImplementedError
+
+    @property
+    def active_chats(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def queued_guests(self) -> int:
+        """
+        number of guests in the waiting room who haven't been matched
+        """
+        raise NotImplementedError
+
+    @property
+    def queued_bytes(self) -> int:
+        """
+        size of every message waiting to be delivered
+        """
+        raise NotImplementedError
+
+    def add_counselor(self, pub_key: str, capacity: int = 1) -> str:
+        """
+        make a signed in counselor available for up to capacity guests at once,
+        returning its session id
+        """
+        raise NotImplementedError
+
+    def remove_counselor(self, counselor_id: str):
+        """
+        stop matching guests to a counselor, their ongoing chats are left open
+        """
+        raise NotImplementedError
+
+    def match_guest(self, guest_key: str) -> tuple[str, str]:
+        """
+        pair a guest with an available counselor and open their chat
+        returns the counselor's key and the chat id to send them messages at,
+        both empty if none are available
+
+        Guests already waiting go first, so while anyone is in line the guest
+        joins the back of it, and is handed their match when they ask again.
+        """
+        guest = self.wait_for_counselor(guest_key)
+        if guest.counselor_key:
+            self.collect_match(guest_key)
+        return guest.counselor_key, guest.chat_id
+
+    def wait_for_counselor(self, guest_key: str):
+        """
+        match a guest immediately if possible, otherwise hold their place in line
+        returns an object with counselor_key and chat_id attributes, empty
+        until matched, and an async wait(timeout) for the match
+        """
+        raise NotImplementedError
+
+    def position(self, guest) -> int:
+        """
+        place in line of a guest returned by wait_for_counselor, 0 once matched
+        """
+        raise NotImplementedError
+
+    def collect_match(self, guest_key: str):
+        """
+        forget a matched guest's place in line once they know their counselor
+        """
+        raise NotImplementedError
+
+    def pop_guests(self, counselor_id: str) -> list[dict[str, str]]:
+        """
+        return the guest keys and chat ids of guests newly assigned to counselor_id
+        """
+        raise NotImplementedError
+
+    def has_session(self, user_id: str) -> bool:
+        """
+        whether user_id is in a chat or waiting for one
+        """
+        raise NotImplementedError
+
+    def partner(self, user_id: str) -> str:
+        """
+        whoever user_id is chatting with, raising KeyError if it has no chat
+        """
+        raise NotImplementedError
+
+    def mailbox(self, user_id: str):
+        """
+        return user_id's mailbox, raising KeyError if it has no chat
+        mailboxes have a closed flag, a length, drain(max_messages, max_bytes)
+        and async wait(timeout)
+        """
+        raise NotImplementedError
+
+    def send(self, user_id: str, *messages: str):
+        """
+        queue messages for user_id, raising KeyError if it has no chat
+        and MailboxFull or BudgetExceeded if the messages can't all be held
+        """
+        raise NotImplementedError
+
+    def send_to_partner(self, user_id: str, message: Frame):
+        """
+        queue a message for whoever user_id is chatting with
+        """
+        raise NotImplementedError
+
+    def close_chat(self, user_id: str):
+        """
+        end user_id's chat for both sides, or take them out of the waiting room
+        """
+        raise NotImplementedError
+
+    def new_guest_id(self) -> str:
+        raise NotImplementedError
+
+    def touch(self, session_id: str):
+        """
+        note activity from a session so it isn't reaped
+        """
+        raise NotImplementedError
+
+    def connect(self, user_id: str):
+        """
+        note that user_id has an open websocket, so it never goes idle
+        """
+        raise NotImplementedError
+
+    def disconnect(self, user_id: str):
+        raise NotImplementedError
+
+    def reap(self) -> Counter[str]:
+        """
+        drop every session idle for longer than the session ttl
+        returns how many of each kind of session were reaped
+        """
+        raise NotImplementedError
@@ -19,17 +19,100 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from sqlalchemy import create_engine
+from collections.abc import AsyncIterator
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from ..common.common import data_path
 
-SQLITE_DB_URI = f"sqlite:///{data_path / 'hyperdome_server.db'}"
+SQLITE_DB_PATH = data_path / "hyperdome_server.db"
+SQLITE_DB_URI = f"sqlite:///{SQLITE_DB_PATH}"
+ASYNC_SQLITE_DB_URI = f"sqlite+aiosqlite:///{SQLITE_DB_PATH}"
+# rewritten whenever counselors change, so every server process drops cached keys
+COUNSELORS_CHANGED_PATH = data_path / "counselors.changed"
+
+# applied to every new connection
+SQLITE_PRAGMAS = {
+    # readers don't wait on the writer, sign-ins are nearly all reads
+    "journal_mode": "WAL",
+    # with WAL only a power loss can lose the last commits, never corrupt
+    "synchronous": "NORMAL",
+    # milliseconds to wait for the write lock instead of failing
+    "busy_timeout": 5000,
+    # negative is KiB of page cache
+    "cache_size": -16000,
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+
+# connections kept open, and extra ones allowed under bursts of sign-ins
+POOL_SIZE = 16
+POOL_OVERFLOW = 0
+
+
+def apply_pragmas(bind: Engine):
+    """
+    set SQLITE_PRAGMAS on each connection bind opens
+    """
+
+    @event.listens_for(bind, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def _pool_options(default_pool: type, kwargs: dict) -> dict:
+    """
+    size the pool unless the caller picked their own
+    """
+    if "poolclass" in kwargs:
+        return kwargs
+    return {
+        "poolclass": default_pool,
+        "pool_size": POOL_SIZE,
+        "max_overflow": POOL_OVERFLOW,
+        **kwargs,
+    }
+
 
-engine = create_engine(SQLITE_DB_URI, connect_args={"check_same_thread": False})
+def make_engine(uri: str = SQLITE_DB_URI, **kwargs) -> Engine:
+    """
+    blocking engine, used by admin commands and migrations
+    """
+    bind = create_engine(
+        uri,
+        connect_args={"check_same_thread": False},
+        **_pool_options(QueuePool, kwargs),
+    )
+    apply_pragmas(bind)
+    return bind
+
+
+def make_async_engine(uri: str = ASYNC_SQLITE_DB_URI, **kwargs) -> AsyncEngine:
+    """
+    aiosqlite engine the server queries from the event loop
+    """
+    bind = create_async_engine(uri, **_pool_options(AsyncAdaptedQueuePool, kwargs))
+    apply_pragmas(bind.sync_engine)
+    return bind
+
+
+def make_async_session(bind: AsyncEngine) -> sessionmaker:
+    return sessionmaker(bind=bind, class_=AsyncSession, expire_on_commit=False)
+
+
+engine = make_engine()
+async_engine = make_async_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = make_async_session(async_engine)
 
 Base = declarative_base()
 
@@ -40,3 +123,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        yield db
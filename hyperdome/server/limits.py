@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import math
+import time
+
+from fastapi import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class BodySizeLimit:
+    """
+    ASGI middleware refusing request bodies over max_bytes
+
+    Declared lengths are checked before any of the body is read,
+    chunked bodies are cut off as soon as they pass the limit.
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        for name, value in scope["headers"]:
+            if name != b"content-length":
+                continue
+            try:
+                length = int(value)
+            except ValueError:
+                response = PlainTextResponse("malformed content-length", 400)
+                return await response(scope, receive, send)
+            if length > self.max_bytes:
+                response = PlainTextResponse("request body too large", 413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                raise HTTPException(413, "request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class RateLimiter:
+    """
+    token bucket per key, refilled at rate tokens a second up to burst
+
+    Buckets are kept in least recently used order, when there are more than
+    max_keys the oldest is dropped, which only ever resets it to a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, time of last update)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: str, cost: float = 1.0) -> float:
+        """
+        take cost tokens from key's bucket
+        returns 0 if they were taken, otherwise the seconds until they will be there
+        """
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def check(self, key: str, cost: float = 1.0):
+        """
+        take cost tokens from key's bucket or refuse the request with a 429
+        """
+        if wait := self.acquire(key, cost):
+            raise HTTPException(
+                429,
+                "too many requests",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
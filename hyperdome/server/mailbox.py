@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from collections import deque
+
+# chat messages are text, or binary frames from hyperdome.common.codec
+Frame = str | bytes
+
+
+def frame_size(frame: Frame) -> int:
+    return len(frame) if isinstance(frame, bytes) else len(frame.encode())
+
+
+class MailboxFull(Exception):
+    """
+    the recipient already has as many pending messages or bytes as one chat may hold
+    """
+
+    pass
+
+
+class BudgetExceeded(Exception):
+    """
+    pending messages across every chat have used up the server's memory budget
+    """
+
+    pass
+
+
+class MessageBudget:
+    """
+    count of bytes held in every mailbox on the server, against a fixed limit
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0
+
+    def reserve(self, size: int):
+        if self.used + size > self.max_bytes:
+            raise BudgetExceeded("server message memory budget exhausted")
+        self.used += size
+
+    def release(self, size: int):
+        self.used -= size
+
+
+class Mailbox:
+    """
+    queue of pending messages for one side of a chat
+
+    any number of waiters (websockets, long polls) can wait for messages to
+    arrive or for the chat to close. Must only be used from the event loop.
+
+    A mailbox holds at most max_messages messages and max_bytes bytes, and
+    reserves what it holds from a budget shared by the whole server.
+    """
+
+    def __init__(
+        self,
+        max_messages: int = 1000,
+        max_bytes: int = 1 << 20,
+        budget: MessageBudget | None = None,
+    ) -> None:
+        self._messages: deque[Frame] = deque()
+        self._ready = asyncio.Event()
+        self._bytes = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.budget = MessageBudget(max_bytes) if budget is None else budget
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._bytes
+
+    def put(self, *messages: Frame):
+        """
+        queue messages in order, raising MailboxFull or BudgetExceeded
+        if they can't all be held, in which case none are queued
+        """
+        size = sum(map(frame_size, messages))
+        if (
+            len(self._messages) + len(messages) > self.max_messages
+            or self._bytes + size > self.max_bytes
+        ):
+            raise MailboxFull("recipient has too many undelivered messages")
+        self.budget.reserve(size)
+        self._bytes += size
+        self._messages.extend(messages)
+        self._ready.set()
+
+    def drain(
+        self, max_messages: int | None = None, max_bytes: int | None = None
+    ) -> list[Frame]:
+        """
+        remove and return pending messages in order, at most max_messages of them
+        and no more than max_bytes in total, though always at least one if any
+        are pending, so an oversized message can't block the queue
+        """
+        if max_messages is None and max_bytes is None:
+            messages = list(self._messages)
+            self._messages.clear()
+            size = self._bytes
+        else:
+            messages = []
+            size = 0
+            while self._messages and len(messages) != max_messages:
+                next_size = frame_size(self._messages[0])
+                if messages and max_bytes is not None and size + next_size > max_bytes:
+                    break
+                messages.append(self._messages.popleft())
+                size += next_size
+        if not self.closed:
+            self.budget.release(size)
+            self._bytes -= size
+            if not self._messages:
+                self._ready.clear()
+        return messages
+
+    def close(self):
+        """
+        mark the chat as ended and wake every waiter
+        messages still pending can be drained but no longer count against the budget
+        """
+        self.closed = True
+        self.budget.release(self._bytes)
+        self._bytes = 0
+        self._ready.set()
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """
+        wait until a message is pending or the mailbox is closed
+        returns False if the timeout expired first
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
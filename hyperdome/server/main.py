@@ -24,9 +24,13 @@ import os
 import sys
 
 from ..common import strings
-from ..common.common import Settings, platform_str, host
+from ..common.common import Settings, data_path, platform_str, host
 from ..common.onion import Onion, TorErrorProtocolError, TorTooOld
 from .hyperdome_server import HyperdomeServer
+from .matching import STRATEGIES
+from .models import create_models
+from .router import ChatRouter
+from .shared import SharedBackend
 from . import web
 import uvicorn
 
@@ -47,6 +51,40 @@ def main(cwd=""):
     settings = Settings()
     strings.load_strings(settings)
 
+    # create or bring the counselor tables up to date before serving sign-ins
+    create_models()
+
+    # several workers can only serve the same chats through shared state
+    workers = settings.get("workers")
+    if workers > 1 or settings.get("state_backend") == "sqlite":
+        state_db = data_path / "hyperdome_state.db"
+        SharedBackend.create(
+            state_db,
+            max_chat_messages=settings.get("max_chat_messages"),
+            max_chat_bytes=settings.get("max_chat_bytes"),
+            message_budget=settings.get("message_memory_budget"),
+            session_ttl=settings.get("session_ttl"),
+            max_active_chats=settings.get("max_active_chats"),
+            matching_strategy=settings.get("matching_strategy"),
+        )
+        os.environ[web.STATE_DB_ENV] = str(state_db)
+    else:
+        web.router = ChatRouter(
+            STRATEGIES[settings.get("matching_strategy")](),
+            max_chat_messages=settings.get("max_chat_messages"),
+            max_chat_bytes=settings.get("max_chat_bytes"),
+            message_budget=settings.get("message_memory_budget"),
+            session_ttl=settings.get("session_ttl"),
+            max_active_chats=settings.get("max_active_chats"),
+        )
+
+    if metrics_port := settings.get("metrics_port"):
+        if workers > 1:
+            # each worker would only report on its own requests
+            main._log.warning("metrics are only served with a single worker")
+        else:
+            os.environ[web.METRICS_PORT_ENV] = str(metrics_port)
+
     # hyperdome in OSX needs to change current working directory (onionshare #132)
     if platform_str == "Darwin" and cwd:
         os.chdir(cwd)
@@ -85,7 +123,14 @@ def main(cwd=""):
     )
 
     try:  # Trap exit conditions for cleanup
-        uvicorn.run(web.app, host=host, port=app.port)
+        uvicorn.run(
+            # worker processes import the app themselves
+            "hyperdome.server.web:app" if workers > 1 else web.app,
+            host=host,
+            port=app.port,
+            ws_max_size=web.MAX_REQUEST_BYTES,
+            workers=workers,
+        )
     except (KeyboardInterrupt, SystemExit):
         main._log.info("application stopped from keyboard interrupt")
     finally:
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import heapq
+import itertools
+import secrets
+
+
+class CounselorPool:
+    """
+    set of counselors available to be matched with guests
+
+    Subclasses decide which counselor choose() hands out next.
+    Every operation is O(1) in the number of counselors in the pool,
+    except choosing the least recently assigned, which is O(log n).
+    """
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, counselor_id: object) -> bool:
+        raise NotImplementedError
+
+    def add(self, counselor_id: str, load: int = 0):
+        """
+        make counselor_id available, load is how many chats they already have
+        """
+        raise NotImplementedError
+
+    def discard(self, counselor_id: str):
+        raise NotImplementedError
+
+    def forget(self, counselor_id: str):
+        """
+        remove a counselor who has signed out, along with anything kept about them
+        """
+        self.discard(counselor_id)
+
+    def choose(self) -> str:
+        """
+        pick the next counselor to assign a guest to, raising IndexError if empty
+        the counselor stays in the pool, callers remove it when it is full
+        """
+        raise NotImplementedError
+
+    def release(self, counselor_id: str):
+        """
+        note that one of counselor_id's chats has ended
+        """
+
+
+class RandomPool(CounselorPool):
+    """
+    uniformly random choice using the secrets module
+
+    Counselors are kept in a list with an index of their positions,
+    removal swaps the last counselor into the removed slot.
+    """
+
+    def __init__(self) -> None:
+        self._counselors: list[str] = []
+        self._positions: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._counselors)
+
+    def __contains__(self, counselor_id: object) -> bool:
+        return counselor_id in self._positions
+
+    def add(self, counselor_id: str, load: int = 0):
+        if counselor_id in self._positions:
+            return
+        self._positions[counselor_id] = len(self._counselors)
+        self._counselors.append(counselor_id)
+
+    def discard(self, counselor_id: str):
+        position = self._positions.pop(counselor_id, None)
+        if position is None:
+            return
+        last = self._counselors.pop()
+        if last != counselor_id:
+            self._counselors[position] = last
+            self._positions[last] = position
+
+    def choose(self) -> str:
+        if not self._counselors:
+            raise IndexError("no counselors available")
+        return self._counselors[secrets.randbelow(len(self._counselors))]
+
+
+class RoundRobinPool(CounselorPool):
+    """
+    hand out counselors in turn, new counselors join the end of the rotation
+    """
+
+    def __init__(self) -> None:
+        self._rotation: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._rotation)
+
+    def __contains__(self, counselor_id: object) -> bool:
+        return counselor_id in self._rotation
+
+    def add(self, counselor_id: str, load: int = 0):
+        self._rotation.setdefault(counselor_id)
+
+    def discard(self, counselor_id: str):
+        self._rotation.pop(counselor_id, None)
+
+    def choose(self) -> str:
+        if not self._rotation:
+            raise IndexError("no counselors available")
+        counselor_id = next(iter(self._rotation))
+        self._rotation.move_to_end(counselor_id)
+        return counselor_id
+
+
+class LeastRecentlyAssignedPool(CounselorPool):
+    """
+    hand out whichever counselor has waited longest since their last guest
+    counselors that have never been assigned a guest go first, newest first
+
+    When each counselor was last assigned is kept apart from whether they're
+    available, so one who comes back when a chat ends keeps their place.
+    Available counselors are kept in a heap in that order, entries left by
+    counselors since assigned or made unavailable are dropped once on top.
+    """
+
+    def __init__(self) -> None:
+        self._available: set[str] = set()
+        # counselor id -> place in line, (0, -joined) until first assigned
+        # and (1, assigned) after, lowest first
+        self._order: dict[str, tuple[int, int]] = {}
+        self._heap: list[tuple[tuple[int, int], str]] = []
+        self._events = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._available)
+
+    def __contains__(self, counselor_id: object) -> bool:
+        return counselor_id in self._available
+
+    def add(self, counselor_id: str, load: int = 0):
+        if counselor_id in self._available:
+            return
+        self._available.add(counselor_id)
+        order = self._order.setdefault(counselor_id, (0, -next(self._events)))
+        heapq.heappush(self._heap, (order, counselor_id))
+
+    def discard(self, counselor_id: str):
+        self._available.discard(counselor_id)
+
+    def forget(self, counselor_id: str):
+        self._available.discard(counselor_id)
+        self._order.pop(counselor_id, None)
+
+    def choose(self) -> str:
+        while self._heap:
+            order, counselor_id = self._heap[0]
+            if counselor_id in self._available and self._order[counselor_id] == order:
+                order = self._order[counselor_id] = (1, next(self._events))
+                heapq.heapreplace(self._heap, (order, counselor_id))
+                return counselor_id
+            heapq.heappop(self._heap)
+        raise IndexError("no counselors available")
+
+
+class LeastLoadedPool(CounselorPool):
+    """
+    hand out the counselor with the fewest active chats
+
+    Counselors are bucketed by load, ties go to whoever has been at that
+    load the longest. Loads only move by one so the lowest bucket is tracked
+    directly, only removing the last counselor at that load scans upward.
+    """
+
+    def __init__(self) -> None:
+        self._loads: dict[str, int] = {}
+        self._buckets: dict[int, OrderedDict[str, None]] = {}
+        self._min_load = 0
+
+    def __len__(self) -> int:
+        return len(self._loads)
+
+    def __contains__(self, counselor_id: object) -> bool:
+        return counselor_id in self._loads
+
+    def _place(self, counselor_id: str, load: int):
+        self._loads[counselor_id] = load
+        self._buckets.setdefault(load, OrderedDict())[counselor_id] = None
+        if load < self._min_load or len(self._loads) == 1:
+            self._min_load = load
+
+    def _unplace(self, counselor_id: str) -> int:
+        load = self._loads.pop(counselor_id)
+        bucket = self._buckets[load]
+        del bucket[counselor_id]
+        if not bucket:
+            del self._buckets[load]
+            if load == self._min_load and self._buckets:
+                while self._min_load not in self._buckets:
+                    self._min_load += 1
+        return load
+
+    def add(self, counselor_id: str, load: int = 0):
+        if counselor_id not in self._loads:
+            self._place(counselor_id, load)
+
+    def discard(self, counselor_id: str):
+        if counselor_id in self._loads:
+            self._unplace(counselor_id)
+
+    def choose(self) -> str:
+        if not self._loads:
+            raise IndexError("no counselors available")
+        counselor_id = next(iter(self._buckets[self._min_load]))
+        self._place(counselor_id, self._unplace(counselor_id) + 1)
+        return counselor_id
+
+    def release(self, counselor_id: str):
+        if counselor_id in self._loads:
+            self._place(counselor_id, max(self._unplace(counselor_id) - 1, 0))
+
+
+STRATEGIES: dict[str, type[CounselorPool]] = {
+    "random": RandomPool,
+    "round_robin": RoundRobinPool,
+    "least_recently_assigned": LeastRecentlyAssignedPool,
+    "least_loaded": LeastLoadedPool,
+}
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# minimal Prometheus text format metrics
+#
+# these are served by a plain asyncio server bound to localhost on its own port,
+# the chat app can't tell local requests apart since tor forwards every request
+# from 127.0.0.1
+
+import asyncio
+from bisect import bisect_left
+from collections.abc import Callable, Iterator
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# request latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# guest waits for a counselor, in seconds
+WAIT_BUCKETS = (0.1, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """
+    a named metric, optionally split by labels, registered for rendering on creation
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {value}"
+
+
+class Gauge(Metric):
+    """
+    a value read from the server's state whenever metrics are rendered
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        super().__init__(name, description)
+        self.read = read
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {self.read()}"
+
+
+class Histogram(Metric):
+    """
+    counts of observations in fixed buckets, with their sum and count
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # per label set: observations in each bucket, the last one past every bound
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if (counts := self._counts.get(key)) is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _labels(self.label_names, key, le=str(bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {self._sums[key]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "hyperdome_request_duration_seconds",
+    "time taken to answer HTTP requests",
+    ("route", "method"),
+)
+REQUESTS = Counter(
+    "hyperdome_requests_total",
+    "HTTP requests answered",
+    ("route", "method", "status"),
+)
+MATCHES = Counter("hyperdome_matches_total", "guests paired with a counselor")
+TIME_TO_MATCH = Histogram(
+    "hyperdome_time_to_match_seconds",
+    "time guests spent in the waiting room before being matched",
+    buckets=WAIT_BUCKETS,
+)
+SIGNIN_FAILURES = Counter(
+    "hyperdome_signin_failures_total", "counselor sign ins refused"
+)
+SESSIONS_EXPIRED = Counter(
+    "hyperdome_sessions_expired_total", "idle sessions reaped", ("kind",)
+)
+
+
+class RequestMetrics:
+    """
+    ASGI middleware recording the latency and status of every HTTP request
+
+    Requests are labelled with their route's path template rather than the
+    requested path, so ids in paths don't create a label set per user.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def record_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, record_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - start, route=route, method=scope["method"]
+            )
+            REQUESTS.inc(route=route, method=scope["method"], status=str(status))
+
+
+async def _answer_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        if request.split()[:2] == [b"GET", b"/metrics"]:
+            status = "200 OK"
+            body = render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_metrics(port: int) -> asyncio.Server:
+    """
+    serve GET /metrics on localhost only, from the running event loop
+    """
+    return await asyncio.start_server(_answer_scrape, "127.0.0.1", port)
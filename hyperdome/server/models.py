@@ -19,14 +19,132 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import base64
+import binascii
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+import threading
+import time
+
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 import cryptography.hazmat.primitives.serialization as serial
 from cryptography.hazmat.primitives.asymmetric.ed448 import Ed448PublicKey
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+from hyperdome.server.database import COUNSELORS_CHANGED_PATH, Base, engine
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+    event,
+    inspect,
+    text,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# counselors enrolled before identity keys moved to Ed25519 still sign with Ed448
+CounselorPublicKey = Ed25519PublicKey | Ed448PublicKey
+
+
+class KeyCache:
+    """
+    least recently used counselor name -> parsed public key, shared by worker threads
+
+    Entries are dropped when counselors are changed through this process.
+    Other processes, like the admin commands, rewrite the stamp file after
+    changing counselors, which empties the cache within stamp_interval seconds.
+    Entries also expire after ttl seconds in case a change goes unannounced.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 4096,
+        ttl: float = 300.0,
+        stamp: Path | None = None,
+        stamp_interval: float = 1.0,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stamp = stamp
+        self.stamp_interval = stamp_interval
+        self._lock = threading.Lock()
+        # name -> (key, time it was loaded)
+        self._keys: OrderedDict[str, tuple[CounselorPublicKey, float]] = OrderedDict()
+        self._stamp_seen: bytes | None = None
+        self._next_stamp_check = 0.0
+
+    def _check_stamp(self):
+        """
+        empty the cache if the stamp was rewritten, looking at most every stamp_interval
+        """
+        now = time.monotonic()
+        if self.stamp is None or now < self._next_stamp_check:
+            return
+        self._next_stamp_check = now + self.stamp_interval
+        try:
+            stamp = self.stamp.read_bytes()
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self._stamp_seen:
+            self._stamp_seen = stamp
+            self._keys.clear()
+
+    def get(self, name: str) -> CounselorPublicKey | None:
+        with self._lock:
+            self._check_stamp()
+            entry = self._keys.get(name)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._keys[name]
+                return None
+            self._keys.move_to_end(name)
+            return entry[0]
+
+    def put(self, name: str, key: CounselorPublicKey):
+        with self._lock:
+            self._keys[name] = (key, time.monotonic())
+            self._keys.move_to_end(name)
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def invalidate(self, *names: str):
+        with self._lock:
+            for name in names:
+                self._keys.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def announce(self):
+        """
+        tell caches in every process sharing the stamp that counselors changed
+        """
+        self.clear()
+        if self.stamp is not None:
+            self.stamp.write_bytes(str(time.time_ns()).encode())
+
+
+counselor_keys = KeyCache(stamp=COUNSELORS_CHANGED_PATH)
 
-from hyperdome.server.database import Base, engine
 
-from sqlalchemy import String, Column, Integer
+def verify_signature(
+    pub_key: CounselorPublicKey, signature: bytes, message: bytes
+) -> bool:
+    try:
+        pub_key.verify(signature, message)
+        return True
+    except InvalidSignature:
+        return False
 
 
 class Counselor(Base):
@@ -41,18 +159,25 @@ class Counselor(Base):
         primary_key=True,
     )
     name = Column(String(100), unique=True, nullable=False)
-    key_bytes = Column(String(64), unique=True, nullable=False)
+    # raw Ed25519 identity key
+    key = Column(LargeBinary(32), unique=True, index=True)
+    # PEM Ed448 key of a counselor enrolled before raw keys, until they enroll again
+    legacy_key = Column("key_bytes", Text, unique=True)
 
     # TODO: this should be in the cryptography common module and take pub_key as an argument
     # TODO: make into a pydantic type verification
-    def verify(self, signature: bytes, message: bytes) -> bool:
-        pub_key = serial.load_pem_public_key(self.key_bytes.encode(), default_backend())
+    @property
+    def public_key(self) -> CounselorPublicKey:
+        if self.key is not None:
+            return Ed25519PublicKey.from_public_bytes(self.key)
+        pub_key = serial.load_pem_public_key(
+            self.legacy_key.encode(), default_backend()
+        )
         assert isinstance(pub_key, Ed448PublicKey)
-        try:
-            pub_key.verify(signature, message)
-            return True
-        except InvalidSignature:
-            return False
+        return pub_key
+
+    def verify(self, signature: bytes, message: bytes) -> bool:
+        return verify_signature(self.public_key, signature, message)
 
 
 class CounselorSignUp(Base):
@@ -66,8 +191,194 @@ class CounselorSignUp(Base):
         Integer,
         primary_key=True,
     )
-    passphrase = Column(String(32), unique=True, nullable=False)
+    passphrase = Column(String(32), unique=True, index=True, nullable=False)
+    # naive UTC time after which the code can't be redeemed, never if empty
+    expires = Column(DateTime)
+
+
+class SignedPreKey(Base):
+    """
+    a counselor's current signed pre key, shared by all of their key exchange bundles
+    """
+
+    __tablename__ = "signed_pre_keys"
+
+    counselor_key = Column(
+        LargeBinary(32),
+        ForeignKey("counselors.key", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    pre_key = Column(LargeBinary(32), nullable=False)
+    signature = Column(LargeBinary(64), nullable=False)
+    # every one-time key in the merkle tree the counselor signed, in tree order,
+    # including those already handed out
+    committed_keys = Column(LargeBinary, nullable=False, default=b"")
+    committed_keys_signature = Column(LargeBinary(64))
+
+
+class OneTimeKey(Base):
+    """
+    a one-time key published by a counselor, deleted once handed to a guest
+    """
+
+    __tablename__ = "one_time_keys"
+
+    key = Column(LargeBinary(32), primary_key=True)
+    counselor_key = Column(
+        LargeBinary(32),
+        ForeignKey("counselors.key", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+
+
+def utcnow() -> datetime:
+    """
+    current time as stored in the database, naive UTC
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@event.listens_for(Session, "after_flush")
+def _note_changed_counselors(session: Session, flush_context):
+    """
+    remember the names of counselors changed in this transaction
+    """
+    changed = session.info.setdefault("changed_counselors", set())
+    for counselor in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(counselor, Counselor):
+            history = inspect(counselor).attrs.name.history
+            changed.update(history.added, history.unchanged, history.deleted)
+
+
+@event.listens_for(Session, "after_bulk_delete")
+@event.listens_for(Session, "after_bulk_update")
+def _note_bulk_change(update_context):
+    if update_context.mapper.class_ is Counselor:
+        update_context.session.info["changed_counselors"] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_counselor_keys(session: Session):
+    """
+    drop cached keys only once changes are committed,
+    so a reader can't cache a key that is about to be replaced
+    """
+    if "changed_counselors" not in session.info:
+        return
+    changed = session.info.pop("changed_counselors")
+    if changed is None:
+        counselor_keys.clear()
+    else:
+        counselor_keys.invalidate(*changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_counselors(session: Session):
+    session.info.pop("changed_counselors", None)
+
+
+def parse_public_key(key: str) -> bytes:
+    """
+    raw bytes of an Ed25519 public key given urlsafe base64 encoded or as PEM
+    raises ValueError for anything else
+    """
+    if key.lstrip().startswith("-----BEGIN"):
+        pub_key = serial.load_pem_public_key(key.encode(), default_backend())
+        if not isinstance(pub_key, Ed25519PublicKey):
+            raise ValueError("counselor keys must be Ed25519")
+        return pub_key.public_bytes(serial.Encoding.Raw, serial.PublicFormat.Raw)
+    try:
+        raw = base64.urlsafe_b64decode(key)
+    except binascii.Error as e:
+        raise ValueError("counselor key is not valid base64") from e
+    if len(raw) != 32:
+        raise ValueError("counselor keys must be 32 raw bytes")
+    return raw
+
+
+def migrate_counselors(bind: Engine):
+    """
+    bring a counselors table from before raw Ed25519 keys up to date
+
+    The table is rebuilt so the old key column can be empty, then any Ed25519
+    PEM keys are stored raw. Ed448 keys can't be converted and are left
+    for legacy sign-in until those counselors enroll again.
+    """
+    if not inspect(bind).has_table("counselors"):
+        return
+    columns = {column["name"] for column in inspect(bind).get_columns("counselors")}
+    with bind.begin() as connection:
+        if "key" not in columns:
+            connection.execute(text("ALTER TABLE counselors RENAME TO counselors_old"))
+            Counselor.__table__.create(connection)
+            connection.execute(
+                text(
+                    "INSERT INTO counselors (id, name, key_bytes) "
+                    "SELECT id, name, key_bytes FROM counselors_old"
+                )
+            )
+            connection.execute(text("DROP TABLE counselors_old"))
+
+        rows = connection.execute(
+            text("SELECT id, key_bytes FROM counselors WHERE key IS NULL")
+        ).all()
+        for id_, pem in rows:
+            try:
+                raw = parse_public_key(pem)
+            except ValueError:
+                continue
+            connection.execute(
+                text(
+                    "UPDATE counselors SET key = :key, key_bytes = NULL WHERE id = :id"
+                ),
+                {"key": raw, "id": id_},
+            )
+    counselor_keys.clear()
+
+
+def migrate_signup_tokens(bind: Engine):
+    """
+    add the expiry column and passphrase index to a sign-up code table that predates them
+    """
+    if not inspect(bind).has_table("counselor_signup_tokens"):
+        return
+    columns = inspect(bind).get_columns("counselor_signup_tokens")
+    with bind.begin() as connection:
+        if "expires" not in {column["name"] for column in columns}:
+            connection.execute(
+                text("ALTER TABLE counselor_signup_tokens ADD COLUMN expires DATETIME")
+            )
+        connection.execute(
+            text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_counselor_signup_tokens_passphrase "
+                "ON counselor_signup_tokens (passphrase)"
+            )
+        )
+
+
+def migrate_pre_keys(bind: Engine):
+    """
+    drop pre keys stored before one-time keys were committed to in a merkle tree
+
+    Counselors publish new pre keys whenever they sign in, so none are kept.
+    """
+    if not inspect(bind).has_table("signed_pre_keys"):
+        return
+    columns = inspect(bind).get_columns("signed_pre_keys")
+    if "committed_keys" in {column["name"] for column in columns}:
+        return
+    with bind.begin() as connection:
+        OneTimeKey.__table__.drop(connection)
+        SignedPreKey.__table__.drop(connection)
+        SignedPreKey.__table__.create(connection)
+        OneTimeKey.__table__.create(connection)
 
 
-def create_models():
-    Base.metadata.create_all(bind=engine)
+def create_models(bind: Engine = engine):
+    # tables left by older versions are brought up to date first, renaming a table
+    # while others reference it would point their foreign keys at the old copy
+    migrate_counselors(bind)
+    migrate_signup_tokens(bind)
+    migrate_pre_keys(bind)
+    Base.metadata.create_all(bind=bind)
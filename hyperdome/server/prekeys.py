@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from collections.abc import Iterable
+import secrets
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..common.codec import KEY_LENGTH, encode_bundle_prefix, encode_one_time_key
+from ..common.merkle import MerkleTree, commitment
+from .models import CounselorPublicKey, OneTimeKey, SignedPreKey, verify_signature
+
+
+class OneTimeKeys:
+    """
+    one-time keys packed end to end in a bytearray
+
+    A random key is removed by moving the last key into its place,
+    so taking one costs the same however many there are.
+    """
+
+    def __init__(self, keys: Iterable[bytes] = ()) -> None:
+        self._keys = bytearray()
+        self.extend(keys)
+
+    def __len__(self) -> int:
+        return len(self._keys) // KEY_LENGTH
+
+    def extend(self, keys: Iterable[bytes]):
+        for key in keys:
+            if len(key) != KEY_LENGTH:
+                raise ValueError("one-time keys must be 32 bytes")
+            self._keys += key
+
+    def extend_packed(self, keys: bytes):
+        """
+        add keys already concatenated end to end
+        """
+        if len(keys) % KEY_LENGTH:
+            raise ValueError("one-time keys must be 32 bytes")
+        self._keys += keys
+
+    def pop_random(self) -> bytes:
+        if not self._keys:
+            raise IndexError("no one-time keys left")
+        start = secrets.randbelow(len(self)) * KEY_LENGTH
+        key = bytes(self._keys[start : start + KEY_LENGTH])
+        last = len(self._keys) - KEY_LENGTH
+        self._keys[start : start + KEY_LENGTH] = self._keys[last:]
+        del self._keys[last:]
+        return key
+
+
+def _unpack(keys: bytes) -> list[bytes]:
+    return [
+        keys[start : start + KEY_LENGTH] for start in range(0, len(keys), KEY_LENGTH)
+    ]
+
+
+class CounselorPreKeys:
+    """
+    a counselor's one-time keys, the signed merkle tree committing to them
+    and the encoded start of each of their bundles
+    """
+
+    def __init__(
+        self,
+        bundle_prefix: bytes,
+        one_time_keys: OneTimeKeys,
+        committed_keys: bytes,
+        signature: bytes | None,
+    ) -> None:
+        self.bundle_prefix = bundle_prefix
+        self.one_time_keys = one_time_keys
+        keys = _unpack(committed_keys)
+        self.tree = MerkleTree(keys)
+        # each committed key's index in the tree
+        self.positions = {key: position for position, key in enumerate(keys)}
+        self.signature = signature
+
+    def commit(self, keys: list[bytes], tree: MerkleTree, signature: bytes):
+        """
+        take tree, already extended with keys, as the one the counselor signed
+        """
+        self.positions.update(
+            (key, position) for position, key in enumerate(keys, len(self.tree))
+        )
+        self.tree = tree
+        self.signature = signature
+
+    def bundle(self, one_time_key: bytes) -> bytes:
+        index = self.positions[one_time_key]
+        return self.bundle_prefix + encode_one_time_key(
+            one_time_key, index, len(self.tree), self.signature, self.tree.proof(index)
+        )
+
+
+class PreKeyStore:
+    """
+    pre keys of each counselor, kept in memory in front of the database
+
+    The database decides which keys are still unused: a key is only handed
+    out once deleting its row succeeds, so several workers sharing the
+    database, each with their own copy in memory, never hand out a key twice.
+    """
+
+    def __init__(self) -> None:
+        # counselor identity key -> their pre keys
+        self._counselors: dict[bytes, CounselorPreKeys] = {}
+
+    async def publish(
+        self,
+        db: AsyncSession,
+        counselor_key: bytes,
+        signed_pre_key: bytes,
+        signature: bytes,
+        one_time_keys: list[bytes],
+        one_time_keys_signature: bytes | None,
+    ):
+        """
+        store a counselor's signed pre key and replace their one-time keys,
+        signatures must be checked by the caller
+
+        Publishing starts a new merkle tree of one-time keys, which the
+        counselor's keyring builds from the keys it hasn't used, so any
+        published before are dropped.
+        """
+        current = await db.get(SignedPreKey, counselor_key)
+        await db.execute(
+            delete(OneTimeKey).where(OneTimeKey.counselor_key == counselor_key)
+        )
+        self.forget(counselor_key)
+        if current is None:
+            current = SignedPreKey(counselor_key=counselor_key)
+        current.pre_key, current.signature = signed_pre_key, signature
+        current.committed_keys = b"".join(one_time_keys)
+        current.committed_keys_signature = one_time_keys_signature
+        db.add(current)
+        await self._insert(db, counselor_key, one_time_keys)
+        await db.commit()
+        await self._load(db, counselor_key)
+
+    async def add_one_time_keys(
+        self,
+        db: AsyncSession,
+        counselor_key: bytes,
+        public_key: CounselorPublicKey,
+        one_time_keys: bytes,
+        signature: bytes,
+    ):
+        """
+        add concatenated one-time keys to those of a counselor with a signed pre key
+        signature must commit to the counselor's merkle tree with them appended,
+        raises ValueError if it doesn't
+        """
+        # the tree may have grown through another worker
+        stored = await self._load(db, counselor_key)
+        keys = _unpack(one_time_keys)
+        tree = stored.tree.copy()
+        tree.extend(keys)
+        if not verify_signature(
+            public_key, signature, commitment(len(tree), tree.root)
+        ):
+            raise ValueError("one-time keys weren't signed by the counselor")
+        signed = await db.get(SignedPreKey, counselor_key)
+        signed.committed_keys += one_time_keys
+        signed.committed_keys_signature = signature
+        await self._insert(db, counselor_key, keys)
+        await db.commit()
+        stored.one_time_keys.extend_packed(one_time_keys)
+        stored.commit(keys, tree, signature)
+
+    async def _insert(
+        self, db: AsyncSession, counselor_key: bytes, one_time_keys: list[bytes]
+    ):
+        if one_time_keys:
+            await db.execute(
+                insert(OneTimeKey).on_conflict_do_nothing(),
+                [{"key": key, "counselor_key": counselor_key} for key in one_time_keys],
+            )
+
+    async def _load(self, db: AsyncSession, counselor_key: bytes) -> CounselorPreKeys:
+        signed = await db.get(SignedPreKey, counselor_key, populate_existing=True)
+        if signed is None:
+            raise LookupError("counselor has not published pre keys")
+        keys = await db.scalars(
+            select(OneTimeKey.key).where(OneTimeKey.counselor_key == counselor_key)
+        )
+        stored = CounselorPreKeys(
+            encode_bundle_prefix(counselor_key, signed.pre_key, signed.signature),
+            OneTimeKeys(keys),
+            signed.committed_keys,
+            signed.committed_keys_signature,
+        )
+        self._counselors[counselor_key] = stored
+        return stored
+
+    async def take_bundle(self, db: AsyncSession, counselor_key: bytes) -> bytes:
+        """
+        an encoded key exchange bundle with one of the counselor's one-time keys,
+        which is deleted so it's never handed out again
+        raises LookupError if the counselor has no pre keys or none are left
+        """
+        stored = self._counselors.get(counselor_key)
+        for reloaded in (False, True):
+            if stored is None or reloaded:
+                # keys may have been published through another worker
+                stored = await self._load(db, counselor_key)
+            while stored.one_time_keys:
+                key = stored.one_time_keys.pop_random()
+                deleted = await db.execute(
+                    delete(OneTimeKey).where(OneTimeKey.key == key)
+                )
+                await db.commit()
+                if deleted.rowcount:
+                    return stored.bundle(key)
+        raise LookupError("counselor has no one-time keys left")
+
+    async def one_time_keys_left(self, db: AsyncSession, counselor_key: bytes) -> int:
+        """
+        the counselor's unused one-time keys, counted in the database
+        so keys handed out by other workers aren't included
+        """
+        return await db.scalar(
+            select(func.count())
+            .select_from(OneTimeKey)
+            .where(OneTimeKey.counselor_key == counselor_key)
+        )
+
+    def forget(self, counselor_key: bytes):
+        self._counselors.pop(counselor_key, None)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from collections.abc import Callable, Iterable, Iterator
+from itertools import islice
+
+from sqlalchemy import bindparam, delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+
+from .models import Counselor, counselor_keys, parse_public_key
+
+# rows written per transaction and prepared statement
+BATCH_SIZE = 1000
+
+# longest counselor name the table holds
+MAX_NAME_LENGTH = Counselor.name.type.length
+
+
+class Progress:
+    """
+    running totals of a bulk change to the counselors table
+    """
+
+    def __init__(self) -> None:
+        self.changed = 0
+        self.skipped = 0
+        # description of every row refused by validation
+        self.invalid: list[str] = []
+
+    @property
+    def seen(self) -> int:
+        return self.changed + self.skipped + len(self.invalid)
+
+
+def batches(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def add_counselors(
+    bind: Engine,
+    counselors: Iterable[tuple[str, str, str]],
+    batch_size: int = BATCH_SIZE,
+    on_batch: Callable[[Progress], None] = lambda _: None,
+) -> Progress:
+    """
+    insert (source, name, key) rows streamed from counselors, a batch per transaction
+
+    Every key is parsed before its batch is written, rows that don't parse are
+    left out and described in the returned progress. Names or keys that are
+    already taken are skipped.
+    """
+    progress = Progress()
+    statement = insert(Counselor.__table__).on_conflict_do_nothing()
+    for batch in batches(counselors, batch_size):
+        rows = []
+        for source, name, key in batch:
+            if not name or len(name) > MAX_NAME_LENGTH:
+                progress.invalid.append(f"{source}: bad counselor name {name!r}")
+                continue
+            try:
+                rows.append({"name": name, "key": parse_public_key(key)})
+            except ValueError as e:
+                progress.invalid.append(f"{source}: {e}")
+        if rows:
+            with bind.begin() as connection:
+                added = connection.execute(statement, rows).rowcount
+            progress.changed += added
+            progress.skipped += len(rows) - added
+        on_batch(progress)
+    counselor_keys.announce()
+    return progress
+
+
+def remove_counselors(
+    bind: Engine,
+    column: str,
+    values: Iterable,
+    batch_size: int = BATCH_SIZE,
+    on_batch: Callable[[Progress], None] = lambda _: None,
+) -> Progress:
+    """
+    delete counselors whose column matches one of values, a batch per transaction
+    values that match no counselor are counted as skipped
+    """
+    progress = Progress()
+    statement = delete(Counselor.__table__).where(
+        Counselor.__table__.c[column] == bindparam("value")
+    )
+    for batch in batches(values, batch_size):
+        with bind.begin() as connection:
+            removed = connection.execute(
+                statement, [{"value": value} for value in batch]
+            ).rowcount
+        progress.changed += removed
+        progress.skipped += len(batch) - removed
+        on_batch(progress)
+    counselor_keys.announce()
+    return progress
+
+
+def remove_all_counselors(bind: Engine) -> int:
+    with bind.begin() as connection:
+        removed = connection.execute(delete(Counselor.__table__)).rowcount
+    counselor_keys.announce()
+    return removed
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import Counter
+import logging
+import secrets
+import time
+
+from .activity import ActivityTracker
+from .backend import StateBackend
+from . import metrics
+from .mailbox import Frame, Mailbox, MessageBudget
+from .matching import CounselorPool, RandomPool
+from .waiting import WaitingGuest, WaitingRoom
+
+logger = logging.getLogger(__name__)
+
+# waiting guests that haven't checked in for this long are passed over
+WAITING_LEASE_SECONDS = 60.0
+
+
+class ChatRouter(StateBackend):
+    """
+    in-memory state for available counselors and active chats
+
+    Every chat has a mailbox for each side. The guest's is keyed by their
+    public key, the counselor's by a chat id made for that chat, so one
+    counselor can hold as many chats as their capacity allows.
+
+    The event loop is the only owner of this state: every method is
+    synchronous and never awaits, so each call runs to completion without
+    interleaving and no locking is needed. Never call into a router from
+    another thread.
+    """
+
+    def __init__(
+        self,
+        counselors_available: CounselorPool | None = None,
+        max_chat_messages: int = 1000,
+        max_chat_bytes: int = 1 << 20,
+        message_budget: int = 256 << 20,
+        session_ttl: float = 120.0,
+        max_active_chats: int = 10_000,
+    ) -> None:
+        self.counselors_available = (
+            RandomPool() if counselors_available is None else counselors_available
+        )
+        self.max_chat_messages = max_chat_messages
+        self.max_chat_bytes = max_chat_bytes
+        self.max_active_chats = max_active_chats
+        self.message_budget = MessageBudget(message_budget)
+        self.counselor_keys: dict[str, str] = dict()
+        self.capacity: dict[str, int] = dict()
+        self.load: dict[str, int] = dict()
+        # guests assigned to a counselor that the counselor hasn't polled for yet
+        self.new_guests: dict[str, list[dict[str, str]]] = dict()
+        # chat id -> counselor session id holding that chat
+        self.counselor_chats: dict[str, str] = dict()
+        # guest key -> (counselor key, chat id) for guests in a chat
+        self.matches: dict[str, tuple[str, str]] = dict()
+        self.chats: dict[str, Mailbox] = dict()
+        self.partners: dict[str, str] = dict()
+        self.waiting = WaitingRoom(WAITING_LEASE_SECONDS)
+        self.guest_ids: set[str] = set()
+        # sessions with an open websocket never go idle
+        self.connected: Counter[str] = Counter()
+        self.activity = ActivityTracker(session_ttl)
+        self.reaped: Counter[str] = Counter()
+
+    @property
+    def online(self) -> int:
+        return len(self.counselors_available)
+
+    @property
+    def active_chats(self) -> int:
+        return len(self.counselor_chats)
+
+    @property
+    def queued_guests(self) -> int:
+        return len(self.waiting)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self.message_budget.used
+
+    def add_counselor(self, pub_key: str, capacity: int = 1) -> str:
+        """
+        make a signed in counselor available for up to capacity guests at once,
+        returning its session id
+        """
+        sid = secrets.token_urlsafe(16)
+        self.counselor_keys[sid] = pub_key
+        self.capacity[sid] = capacity
+        self.load[sid] = 0
+        self.activity.touch(sid)
+        self.counselors_available.add(sid)
+        self._serve_waiting()
+        return sid
+
+    def remove_counselor(self, counselor_id: str):
+        """
+        stop matching guests to a counselor, their ongoing chats are left open
+        """
+        self.activity.forget(counselor_id)
+        self.counselors_available.forget(counselor_id)
+        self.counselor_keys.pop(counselor_id, None)
+        self.capacity.pop(counselor_id, None)
+        self.load.pop(counselor_id, None)
+        self.new_guests.pop(counselor_id, None)
+
+    def _release(self, counselor_id: str):
+        if counselor_id not in self.load:
+            # counselor already signed out
+            return
+        load = self.load[counselor_id] = max(self.load[counselor_id] - 1, 0)
+        if counselor_id in self.counselors_available:
+            self.counselors_available.release(counselor_id)
+        elif load < self.capacity[counselor_id]:
+            self.counselors_available.add(counselor_id, load)
+            self._serve_waiting()
+
+    def _can_open_chat(self) -> bool:
+        return (
+            bool(self.counselors_available)
+            and self.active_chats < self.max_active_chats
+        )
+
+    def _new_mailbox(self) -> Mailbox:
+        return Mailbox(self.max_chat_messages, self.max_chat_bytes, self.message_budget)
+
+    def _open_chat(self, guest_key: str) -> tuple[str, str]:
+        counselor_id = self.counselors_available.choose()
+        self.load[counselor_id] += 1
+        if self.load[counselor_id] >= self.capacity[counselor_id]:
+            self.counselors_available.discard(counselor_id)
+        counselor_key = self.counselor_keys[counselor_id]
+        chat_id = secrets.token_urlsafe(16)
+        self.new_guests.setdefault(counselor_id, []).append(
+            {"guest_key": guest_key, "chat_id": chat_id}
+        )
+        self.counselor_chats[chat_id] = counselor_id
+        self.matches[guest_key] = (counselor_key, chat_id)
+        self.chats[guest_key] = self._new_mailbox()
+        self.chats[chat_id] = self._new_mailbox()
+        self.partners[guest_key] = chat_id
+        self.partners[chat_id] = guest_key
+        self.activity.touch(guest_key)
+        self.activity.touch(chat_id)
+        metrics.MATCHES.inc()
+        return counselor_key, chat_id
+
+    def _serve_waiting(self):
+        """
+        hand available counselors to guests in the waiting room
+        """
+        while self._can_open_chat() and (next_guest := self.waiting.pop_next()):
+            guest_key, guest = next_guest
+            metrics.TIME_TO_MATCH.observe(time.monotonic() - guest.joined)
+            self.waiting.match(guest_key, guest, *self._open_chat(guest_key))
+
+    def wait_for_counselor(self, guest_key: str) -> WaitingGuest:
+        """
+        match a guest immediately if possible, otherwise hold their place in line
+        """
+        if (match := self.matches.get(guest_key)) is not None:
+            self.activity.touch(guest_key)
+            guest = WaitingGuest(-1)
+            guest.match(*match)
+            return guest
+        guest = self.waiting.join(guest_key)
+        self.activity.touch(guest_key)
+        self._serve_waiting()
+        return guest
+
+    def position(self, guest: WaitingGuest) -> int:
+        return self.waiting.position(guest)
+
+    def collect_match(self, guest_key: str):
+        self.waiting.collect(guest_key)
+
+    def new_guest_id(self) -> str:
+        guest_id = secrets.token_urlsafe(16)
+        while guest_id in self.guest_ids:
+            guest_id = secrets.token_urlsafe(16)
+        self.guest_ids.add(guest_id)
+        self.activity.touch(guest_id)
+        return guest_id
+
+    def touch(self, session_id: str):
+        """
+        note activity from a session so it isn't reaped, along with the counselor
+        behind it when it's one of a counselor's chats
+        """
+        if session_id in self.activity:
+            self.activity.touch(session_id)
+        if (counselor_id := self.counselor_chats.get(session_id)) in self.activity:
+            self.activity.touch(counselor_id)
+
+    def pop_guests(self, counselor_id: str) -> list[dict[str, str]]:
+        """
+        return the guest keys and chat ids of guests newly assigned to counselor_id
+        """
+        self.touch(counselor_id)
+        return self.new_guests.pop(counselor_id, [])
+
+    def has_session(self, user_id: str) -> bool:
+        return user_id in self.chats or user_id in self.waiting
+
+    def partner(self, user_id: str) -> str:
+        return self.partners[user_id]
+
+    def mailbox(self, user_id: str) -> Mailbox:
+        mailbox = self.chats[user_id]
+        self.touch(user_id)
+        return mailbox
+
+    def send(self, user_id: str, *messages: str):
+        """
+        queue messages for user_id, raising KeyError if it has no chat
+        and MailboxFull or BudgetExceeded if the messages can't all be held
+        """
+        self.chats[user_id].put(*messages)
+        self.touch(self.partners.get(user_id, ""))
+
+    def send_to_partner(self, user_id: str, message: Frame):
+        """
+        queue a message for whoever user_id is chatting with
+        """
+        self.chats[self.partners[user_id]].put(message)
+        self.touch(user_id)
+
+    def close_chat(self, user_id: str):
+        """
+        remove the chat for user_id and its partner, waking anyone waiting on either
+        guests who haven't been matched yet give up their place in line,
+        and a match a guest hasn't collected yet is dropped with the chat
+        """
+        partner_id = self.partners.pop(user_id, None)
+        if partner_id is not None:
+            self.partners.pop(partner_id, None)
+        for chat_id in (user_id, partner_id):
+            self.waiting.leave(chat_id)
+            self.activity.forget(chat_id)
+            self.matches.pop(chat_id, None)
+            if (mailbox := self.chats.pop(chat_id, None)) is not None:
+                mailbox.close()
+            if (counselor_id := self.counselor_chats.pop(chat_id, None)) is not None:
+                self._release(counselor_id)
+        # a chat ending may bring the server back under its chat ceiling
+        self._serve_waiting()
+
+    def connect(self, user_id: str):
+        self.connected[user_id] += 1
+
+    def disconnect(self, user_id: str):
+        self.connected[user_id] -= 1
+        if not self.connected[user_id]:
+            del self.connected[user_id]
+        self.touch(user_id)
+
+    def reap(self) -> Counter[str]:
+        reaped: Counter[str] = Counter()
+        # an open socket keeps the counselor behind the chat signed in too
+        live = set(self.connected)
+        live.update(
+            self.counselor_chats[user_id]
+            for user_id in self.connected
+            if user_id in self.counselor_chats
+        )
+        for session_id in self.activity.expired():
+            if session_id in live:
+                self.activity.touch(session_id)
+            elif session_id in self.counselor_keys:
+                self.remove_counselor(session_id)
+                reaped["counselor"] += 1
+            elif session_id in self.chats or session_id in self.waiting:
+                self.close_chat(session_id)
+                reaped["chat"] += 1
+            elif session_id in self.guest_ids:
+                self.guest_ids.discard(session_id)
+                reaped["guest_id"] += 1
+        self.reaped.update(reaped)
+        return reaped
@@ -19,8 +19,12 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from collections.abc import Iterator
+import csv
 import logging
+from pathlib import Path
 import secrets
+import sys
 
 from autologging import install_traced_noop
 import click
@@ -72,6 +76,31 @@ def admin(ctx, log_level, log_file):
         main()
 
 
+def csv_rows(file) -> Iterator[tuple[str, list[str]]]:
+    """
+    (source, fields) of each row in a CSV file, skipping blank lines and a header
+    """
+    for number, row in enumerate(csv.reader(file), 1):
+        if not row or (number == 1 and row[0].strip().lower() == "name"):
+            continue
+        yield f"{file.name}:{number}", [field.strip() for field in row]
+
+
+def show_progress(progress) -> None:
+    click.echo(
+        f"{progress.seen} processed: {progress.changed} changed, "
+        f"{progress.skipped} skipped, {len(progress.invalid)} invalid",
+        err=True,
+    )
+
+
+def show_invalid(problems: list[str]) -> None:
+    for problem in problems:
+        click.echo(f"invalid: {problem}", err=True)
+    if problems:
+        sys.exit(1)
+
+
 @admin.command()
 @click.option(
     "--import",
@@ -79,17 +108,39 @@ def admin(ctx, log_level, log_file):
     "import_",
     type=click.File(),
     multiple=True,
-    help="import public key from a file (filename used as NAME)",
+    help="import public key from a file (file name without extension used as NAME)",
+)
+@click.option(
+    "--csv",
+    "csv_",
+    type=click.File(),
+    multiple=True,
+    help="import NAME,PUBLIC_KEY rows from a CSV file",
 )
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000)
 @click.argument("counselors", nargs=-1)
-def add(import_, counselors):
+def add(import_, csv_, batch_size, counselors):
     """Add new counselors in NAME=PUBLIC_KEY format to server database"""
-    counselors += tuple(f"{file.name}={file.read()}" for file in import_)
-    counselors = dict(counselor.strip(",").split("=") for counselor in counselors)
-    [
-        click.echo(f"counselor {name} added with public key: {pub_key}")
-        for name, pub_key in counselors.items()
-    ]
+    from .. import database
+    from ..models import create_models
+    from ..provisioning import add_counselors
+
+    def rows():
+        for counselor in counselors:
+            name, _, pub_key = counselor.strip(",").partition("=")
+            yield "argument", name, pub_key
+        for file in import_:
+            yield file.name, Path(file.name).stem, file.read()
+        for file in csv_:
+            for source, fields in csv_rows(file):
+                yield source, *(fields + ["", ""])[:2]
+
+    create_models(database.engine)
+    progress = add_counselors(
+        database.engine, rows(), batch_size, on_batch=show_progress
+    )
+    click.echo(f"{progress.changed} counselors added")
+    show_invalid(progress.invalid)
 
 
 @admin.command()
@@ -102,34 +153,106 @@ def add(import_, counselors):
     multiple=True,
     help="delete counselor by file used to import",
 )
+@click.option(
+    "--csv",
+    "csv_",
+    type=click.File(),
+    multiple=True,
+    help="delete counselors named in the first column of a CSV file",
+)
 @click.option("--all", "all_", is_flag=True, help="delete entire counselor database")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000)
 @click.argument("names", nargs=-1)
-def remove(pubkey, file, all_, names):
+def remove(pubkey, file, csv_, all_, batch_size, names):
     """remove counselor NAMES from server database"""
+    from .. import database
+    from ..models import create_models, parse_public_key
+    from ..provisioning import remove_all_counselors, remove_counselors
+
+    create_models(database.engine)
     if all_:
         click.confirm(
             "this will remove all counselors from the database\n"
             "Are you really sure this is what you want?",
             abort=True,
         )
-        click.echo("all counselors deleted")
+        removed = remove_all_counselors(database.engine)
+        click.echo(f"all {removed} counselors deleted")
+        return
 
-    [click.echo(f"found counselor with key: {key}") for key in pubkey]
-    [click.echo(f"found counselor from file {f.name}") for f in file]
-    [click.echo(f"counselor removed: {name.strip(',')}") for name in names]
+    invalid: list[str] = []
+
+    def keys():
+        for source, key in [("argument", key) for key in pubkey] + [
+            (f.name, f.read()) for f in file
+        ]:
+            try:
+                yield parse_public_key(key)
+            except ValueError as e:
+                invalid.append(f"{source}: {e}")
+
+    def all_names():
+        yield from (name.strip(",") for name in names)
+        for f in csv_:
+            for _, fields in csv_rows(f):
+                yield fields[0]
+
+    removed = 0
+    for column, values in (("key", keys()), ("name", all_names())):
+        progress = remove_counselors(
+            database.engine, column, values, batch_size, on_batch=show_progress
+        )
+        removed += progress.changed
+    click.echo(f"{removed} counselors removed")
+    show_invalid(invalid)
 
 
 @admin.command()
-def generate():
-    """generate a sign-up code for a new counselor"""
-    from ..models import CounselorSignUp
-    from ..app import db
-
-    code = secrets.token_urlsafe(16)
-    sign_up = CounselorSignUp(passphrase=code)
-    db.session.add(sign_up)
-    db.session.commit()
-    click.echo(code)
+@click.option(
+    "--count",
+    "-n",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="number of codes to generate",
+)
+@click.option(
+    "--expires",
+    "-e",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="hours until the codes can no longer be redeemed (default: never)",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.File("w"),
+    default="-",
+    help="file to write the codes to, one per line (default: stdout)",
+)
+def generate(count, expires, output):
+    """generate sign-up codes for new counselors"""
+    from datetime import timedelta
+
+    from sqlalchemy import insert
+
+    from .. import database
+    from ..models import CounselorSignUp, create_models, utcnow
+
+    expiry = utcnow() + timedelta(hours=expires) if expires else None
+    codes = [secrets.token_urlsafe(16) for _ in range(count)]
+
+    create_models(database.engine)
+    with database.SessionLocal() as session:
+        session.execute(
+            insert(CounselorSignUp),
+            [{"passphrase": code, "expires": expiry} for code in codes],
+        )
+        session.commit()
+
+    output.write("".join(f"{code}\n" for code in codes))
+    if output.name != "<stdout>":
+        click.echo(f"{count} sign-up codes written to {output.name}")
 
 
 def load_config(ctx, param, value):
@@ -0,0 +1,767 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+from pathlib import Path
+import secrets
+import sqlite3
+import time
+
+from . import metrics
+from .backend import StateBackend, T
+from .mailbox import BudgetExceeded, Frame, MailboxFull, frame_size
+from .router import WAITING_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# how often waiters check whether another process has changed the state
+NOTIFY_INTERVAL_SECONDS = 0.05
+
+# how each of matching.STRATEGIES orders the counselors able to take a guest,
+# None picks one with the secrets module as sqlite's RANDOM() is predictable
+MATCH_ORDER: dict[str, str | None] = {
+    "random": None,
+    "round_robin": "MAX(last_assigned, joined)",
+    "least_recently_assigned": "last_assigned, joined DESC",
+    "least_loaded": "load, last_assigned, joined",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    key TEXT PRIMARY KEY,
+    value NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counselors (
+    sid TEXT PRIMARY KEY,
+    pub_key TEXT NOT NULL,
+    capacity INTEGER NOT NULL,
+    load INTEGER NOT NULL DEFAULT 0,
+    last_assigned INTEGER NOT NULL DEFAULT 0,
+    joined INTEGER NOT NULL DEFAULT 0,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS counselors_by_load ON counselors (load, last_assigned);
+CREATE INDEX IF NOT EXISTS counselors_by_last_seen ON counselors (last_seen);
+CREATE TABLE IF NOT EXISTS new_guests (
+    id INTEGER PRIMARY KEY,
+    sid TEXT NOT NULL,
+    guest_key TEXT NOT NULL,
+    chat_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS new_guests_by_sid ON new_guests (sid, id);
+CREATE TABLE IF NOT EXISTS waiting (
+    ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+    guest_key TEXT NOT NULL UNIQUE,
+    joined REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    counselor_key TEXT NOT NULL DEFAULT '',
+    chat_id TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    partner TEXT NOT NULL,
+    counselor_key TEXT NOT NULL DEFAULT '',
+    counselor_sid TEXT,
+    pending INTEGER NOT NULL DEFAULT 0,
+    pending_bytes INTEGER NOT NULL DEFAULT 0,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_by_last_seen ON chats (last_seen);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    -- binary frames are kept as BLOBs
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, id);
+CREATE TABLE IF NOT EXISTS guest_ids (
+    id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS guest_ids_by_last_seen ON guest_ids (last_seen);
+"""
+
+STATE_TABLES = ("counselors", "new_guests", "waiting", "chats", "messages", "guest_ids")
+
+
+class Notifier:
+    """
+    wakes this process's waiters whenever any process makes a change they
+    could be waiting on: a message arriving, a chat ending or a guest matched
+
+    Those changes also bump a counter in the database. Commits from this
+    process notify directly. Commits from other processes are noticed by
+    polling PRAGMA data_version, which only changes when another connection
+    commits, and only while something is waiting. The counter is only read
+    once it has, so commits that just note activity wake nobody.
+    """
+
+    def __init__(
+        self,
+        db: sqlite3.Connection,
+        interval: float,
+        run: Callable[[Callable[[], bool]], "asyncio.Future[bool]"],
+    ) -> None:
+        self._db = db
+        self.interval = interval
+        self._run = run
+        self._changed = asyncio.Event()
+        self._version = self._data_version()
+        self._changes = self._read_changes()
+        self._waiters = 0
+        self._poller: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _data_version(self) -> int:
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read_changes(self) -> float:
+        row = self._db.execute(
+            "SELECT value FROM config WHERE key = 'changes'"
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def _changed_elsewhere(self) -> bool:
+        if (version := self._data_version()) == self._version:
+            return False
+        self._version = version
+        changes, self._changes = self._changes, self._read_changes()
+        return changes != self._changes
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def notify(self, changes: float):
+        """
+        wake waiters once this process has bumped the counter to changes,
+        from any thread
+        """
+        # waiters check the state again, seeing anything others changed before
+        self._changes = changes
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake)
+
+    async def _poll(self):
+        while self._waiters:
+            if await self._run(self._changed_elsewhere):
+                self._wake()
+            await asyncio.sleep(self.interval)
+        self._poller = None
+
+    def watch(self) -> asyncio.Event:
+        """
+        an event set by the next change, taken before checking the state
+        so a change made meanwhile isn't missed
+        """
+        self._loop = asyncio.get_running_loop()
+        return self._changed
+
+    async def wait(self, changed: asyncio.Event, timeout: float | None = None) -> bool:
+        """
+        wait for changed to be set, returns False if the timeout expired first
+        """
+        self._waiters += 1
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters -= 1
+        return True
+
+
+async def _wait_until(
+    backend: "SharedBackend", ready: Callable[[], bool], timeout: float | None
+) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        changed = backend.notifier.watch()
+        if await backend.run(ready):
+            return True
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return False
+        await backend.notifier.wait(changed, remaining)
+
+
+class SharedMailbox:
+    """
+    view of one side of a chat in a SharedBackend, used like a Mailbox
+    """
+
+    def __init__(self, backend: "SharedBackend", user_id: str) -> None:
+        self._backend = backend
+        self.user_id = user_id
+
+    def __len__(self) -> int:
+        row = self._backend._db.execute(
+            "SELECT pending FROM chats WHERE id = ?", (self.user_id,)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    @property
+    def closed(self) -> bool:
+        return not self._backend._has_chat(self.user_id)
+
+    def drain(
+        self, max_messages: int | None = None, max_bytes: int | None = None
+    ) -> list[Frame]:
+        return self._backend._drain(self.user_id, max_messages, max_bytes)
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        return await _wait_until(
+            self._backend, lambda: bool(len(self)) or self.closed, timeout
+        )
+
+
+class SharedWaitingGuest:
+    """
+    a guest's place in a SharedBackend's waiting room
+    """
+
+    def __init__(
+        self,
+        backend: "SharedBackend",
+        guest_key: str,
+        ticket: int,
+        counselor_key: str = "",
+        chat_id: str = "",
+    ) -> None:
+        self._backend = backend
+        self.guest_key = guest_key
+        self.ticket = ticket
+        self.counselor_key = counselor_key
+        self.chat_id = chat_id
+
+    def _check(self) -> bool:
+        row = self._backend._db.execute(
+            "SELECT counselor_key, chat_id FROM waiting WHERE guest_key = ?",
+            (self.guest_key,),
+        ).fetchone()
+        if row is not None and row[0]:
+            self.counselor_key, self.chat_id = row
+        return bool(self.counselor_key)
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        wait until a counselor is assigned, returns False if the timeout expired first
+        """
+        return await _wait_until(self._backend, self._check, timeout)
+
+
+class SharedBackend(StateBackend):
+    """
+    chat state kept in a SQLite database in WAL mode, shared by every worker
+    process on the machine
+
+    Each write runs in its own immediate transaction so workers never
+    interleave, waiters are woken through a Notifier. Calls made through
+    run() happen on one thread of their own, so waiting on another worker's
+    lock never holds up the event loop.
+
+    Limits, the session ttl and the matching strategy are stored in the
+    database by create(), so workers only need the path to open it.
+    """
+
+    def __init__(self, path: Path | str) -> None:
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="shared-state")
+        self._db = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=5.0
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        config = dict(self._db.execute("SELECT key, value FROM config"))
+        self.max_chat_messages = int(config.get("max_chat_messages", 1000))
+        self.max_chat_bytes = int(config.get("max_chat_bytes", 1 << 20))
+        self.message_budget = int(config.get("message_budget", 256 << 20))
+        self.session_ttl = config.get("session_ttl", 120.0)
+        self.max_active_chats = int(config.get("max_active_chats", 10_000))
+        self.matching_strategy = str(config.get("matching_strategy", "least_loaded"))
+        self._depth = 0
+        # set by changes that waiters could be waiting on
+        self._changed = False
+        self.notifier = Notifier(self._db, NOTIFY_INTERVAL_SECONDS, self.run)
+        # sessions with an open websocket to this process
+        self.connected: Counter[str] = Counter()
+        self.reaped: Counter[str] = Counter()
+
+    @classmethod
+    def create(
+        cls,
+        path: Path | str,
+        max_chat_messages: int = 1000,
+        max_chat_bytes: int = 1 << 20,
+        message_budget: int = 256 << 20,
+        session_ttl: float = 120.0,
+        max_active_chats: int = 10_000,
+        matching_strategy: str = "least_loaded",
+    ) -> "SharedBackend":
+        """
+        start a fresh shared state database at path, dropping any previous state
+        matching_strategy is one of matching.STRATEGIES
+        """
+        if matching_strategy not in MATCH_ORDER:
+            raise ValueError(f"unknown matching strategy {matching_strategy}")
+        backend = cls(path)
+        # only called before any worker has opened the database
+        for table in STATE_TABLES:
+            backend._db.execute(f"DROP TABLE {table}")
+        backend._db.executescript(SCHEMA)
+        with backend._transaction():
+            backend._db.executemany(
+                "INSERT OR REPLACE INTO config VALUES (?, ?)",
+                (
+                    ("max_chat_messages", max_chat_messages),
+                    ("max_chat_bytes", max_chat_bytes),
+                    ("message_budget", message_budget),
+                    ("session_ttl", session_ttl),
+                    ("max_active_chats", max_active_chats),
+                    ("matching_strategy", matching_strategy),
+                    ("pending_bytes", 0),
+                ),
+            )
+        backend.max_chat_messages = max_chat_messages
+        backend.max_chat_bytes = max_chat_bytes
+        backend.message_budget = message_budget
+        backend.session_ttl = session_ttl
+        backend.max_active_chats = max_active_chats
+        backend.matching_strategy = matching_strategy
+        return backend
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    @contextmanager
+    def _transaction(self):
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        self._db.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        self._changed = False
+        try:
+            yield
+            if changed := self._changed:
+                (changes,) = self._db.execute(
+                    "INSERT INTO config VALUES ('changes', 1)"
+                    " ON CONFLICT (key) DO UPDATE SET value = value + 1"
+                    " RETURNING value"
+                ).fetchone()
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        else:
+            self._db.execute("COMMIT")
+            if changed:
+                self.notifier.notify(changes)
+        finally:
+            self._depth = 0
+
+    def _has_chat(self, user_id: str) -> bool:
+        return (
+            self._db.execute("SELECT 1 FROM chats WHERE id = ?", (user_id,)).fetchone()
+            is not None
+        )
+
+    @property
+    def online(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM counselors WHERE load < capacity"
+        ).fetchone()[0]
+
+    @property
+    def active_chats(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM chats WHERE counselor_sid IS NOT NULL"
+        ).fetchone()[0]
+
+    @property
+    def queued_guests(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM waiting WHERE counselor_key = ''"
+        ).fetchone()[0]
+
+    @property
+    def queued_bytes(self) -> int:
+        row = self._db.execute(
+            "SELECT value FROM config WHERE key = 'pending_bytes'"
+        ).fetchone()
+        return 0 if row is None else int(row[0])
+
+    def add_counselor(self, pub_key: str, capacity: int = 1) -> str:
+        sid = secrets.token_urlsafe(16)
+        with self._transaction():
+            self._db.execute(
+                "INSERT INTO counselors (sid, pub_key, capacity, joined, last_seen)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (sid, pub_key, capacity, time.time_ns(), time.time()),
+            )
+            self._serve_waiting()
+        return sid
+
+    def remove_counselor(self, counselor_id: str):
+        with self._transaction():
+            self._db.execute("DELETE FROM counselors WHERE sid = ?", (counselor_id,))
+            self._db.execute("DELETE FROM new_guests WHERE sid = ?", (counselor_id,))
+
+    def _open_chat(self, guest_key: str) -> tuple[str, str] | None:
+        if self.active_chats >= self.max_active_chats:
+            return None
+        query = "SELECT sid, pub_key FROM counselors WHERE load < capacity"
+        if (order := MATCH_ORDER[self.matching_strategy]) is None:
+            eligible = self._db.execute(query).fetchall()
+            counselor = secrets.choice(eligible) if eligible else None
+        else:
+            counselor = self._db.execute(f"{query} ORDER BY {order} LIMIT 1").fetchone()
+        if counselor is None:
+            return None
+        counselor_id, counselor_key = counselor
+        chat_id = secrets.token_urlsafe(16)
+        now = time.time()
+        self._db.execute(
+            "UPDATE counselors SET load = load + 1, last_assigned = ? WHERE sid = ?",
+            (time.time_ns(), counselor_id),
+        )
+        self._db.execute(
+            "INSERT INTO new_guests (sid, guest_key, chat_id) VALUES (?, ?, ?)",
+            (counselor_id, guest_key, chat_id),
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO chats"
+            " (id, partner, counselor_key, counselor_sid, last_seen)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                (guest_key, chat_id, counselor_key, None, now),
+                (chat_id, guest_key, "", counselor_id, now),
+            ),
+        )
+        self._changed = True
+        metrics.MATCHES.inc()
+        return counselor_key, chat_id
+
+    def _serve_waiting(self):
+        cutoff = time.time() - WAITING_LEASE_SECONDS
+        self._db.execute(
+            "DELETE FROM waiting WHERE counselor_key = '' AND last_seen < ?", (cutoff,)
+        )
+        while (
+            guest := self._db.execute(
+                "SELECT ticket, guest_key, joined FROM waiting"
+                " WHERE counselor_key = '' ORDER BY ticket LIMIT 1"
+            ).fetchone()
+        ) is not None and (match := self._open_chat(guest[1])) is not None:
+            self._db.execute(
+                "UPDATE waiting SET counselor_key = ?, chat_id = ? WHERE ticket = ?",
+                (*match, guest[0]),
+            )
+            metrics.TIME_TO_MATCH.observe(time.time() - guest[2])
+
+    def wait_for_counselor(self, guest_key: str) -> SharedWaitingGuest:
+        now = time.time()
+        with self._transaction():
+            match = self._db.execute(
+                "SELECT counselor_key, partner FROM chats"
+                " WHERE id = ? AND counselor_key != ''",
+                (guest_key,),
+            ).fetchone()
+            if match is not None:
+                self._db.execute(
+                    "UPDATE chats SET last_seen = ? WHERE id = ?", (now, guest_key)
+                )
+                return SharedWaitingGuest(self, guest_key, -1, *match)
+            self._db.execute(
+                "INSERT INTO waiting (guest_key, joined, last_seen) VALUES (?, ?, ?)"
+                " ON CONFLICT (guest_key) DO UPDATE SET last_seen = excluded.last_seen",
+                (guest_key, now, now),
+            )
+            self._serve_waiting()
+            ticket, counselor_key, chat_id = self._db.execute(
+                "SELECT ticket, counselor_key, chat_id FROM waiting WHERE guest_key = ?",
+                (guest_key,),
+            ).fetchone()
+        return SharedWaitingGuest(self, guest_key, ticket, counselor_key, chat_id)
+
+    def position(self, guest: SharedWaitingGuest) -> int:
+        if guest.counselor_key:
+            return 0
+        return self._db.execute(
+            "SELECT COUNT(*) FROM waiting WHERE counselor_key = '' AND ticket <= ?",
+            (guest.ticket,),
+        ).fetchone()[0]
+
+    def collect_match(self, guest_key: str):
+        with self._transaction():
+            self._db.execute(
+                "DELETE FROM waiting WHERE guest_key = ? AND counselor_key != ''",
+                (guest_key,),
+            )
+
+    def pop_guests(self, counselor_id: str) -> list[dict[str, str]]:
+        with self._transaction():
+            self._db.execute(
+                "UPDATE counselors SET last_seen = ? WHERE sid = ?",
+                (time.time(), counselor_id),
+            )
+            new_guests = self._db.execute(
+                "SELECT guest_key, chat_id FROM new_guests WHERE sid = ? ORDER BY id",
+                (counselor_id,),
+            ).fetchall()
+            self._db.execute("DELETE FROM new_guests WHERE sid = ?", (counselor_id,))
+        return [
+            {"guest_key": guest_key, "chat_id": chat_id}
+            for guest_key, chat_id in new_guests
+        ]
+
+    def has_session(self, user_id: str) -> bool:
+        return (
+            self._has_chat(user_id)
+            or self._db.execute(
+                "SELECT 1 FROM waiting WHERE guest_key = ?", (user_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def partner(self, user_id: str) -> str:
+        row = self._db.execute(
+            "SELECT partner FROM chats WHERE id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(user_id)
+        return row[0]
+
+    def mailbox(self, user_id: str) -> SharedMailbox:
+        with self._transaction():
+            now = time.time()
+            if not self._db.execute(
+                "UPDATE chats SET last_seen = ? WHERE id = ?", (now, user_id)
+            ).rowcount:
+                raise KeyError(user_id)
+            self._touch_counselor(user_id, now)
+        return SharedMailbox(self, user_id)
+
+    def _put(self, user_id: str, messages: tuple[Frame, ...]):
+        chat = self._db.execute(
+            "SELECT pending, pending_bytes FROM chats WHERE id = ?", (user_id,)
+        ).fetchone()
+        if chat is None:
+            raise KeyError(user_id)
+        pending, pending_bytes = chat
+        size = sum(map(frame_size, messages))
+        if (
+            pending + len(messages) > self.max_chat_messages
+            or pending_bytes + size > self.max_chat_bytes
+        ):
+            raise MailboxFull("recipient has too many undelivered messages")
+        (used,) = self._db.execute(
+            "SELECT value FROM config WHERE key = 'pending_bytes'"
+        ).fetchone() or (0,)
+        if used + size > self.message_budget:
+            raise BudgetExceeded("server message memory budget exhausted")
+        self._db.executemany(
+            "INSERT INTO messages (recipient, body) VALUES (?, ?)",
+            ((user_id, message) for message in messages),
+        )
+        self._db.execute(
+            "UPDATE chats SET pending = pending + ?, pending_bytes = pending_bytes + ?"
+            " WHERE id = ?",
+            (len(messages), size, user_id),
+        )
+        self._add_pending_bytes(size)
+        self._changed = True
+
+    def _add_pending_bytes(self, size: int):
+        self._db.execute(
+            "INSERT INTO config VALUES ('pending_bytes', ?)"
+            " ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+            (size,),
+        )
+
+    def _drain(
+        self, user_id: str, max_messages: int | None, max_bytes: int | None
+    ) -> list[Frame]:
+        # most drains find nothing, don't take the write lock for those
+        if not len(SharedMailbox(self, user_id)):
+            return []
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT id, body FROM messages WHERE recipient = ? ORDER BY id LIMIT ?",
+                (user_id, -1 if max_messages is None else max_messages),
+            )
+            messages = []
+            size = 0
+            last_id = None
+            for message_id, body in rows:
+                next_size = frame_size(body)
+                if messages and max_bytes is not None and size + next_size > max_bytes:
+                    break
+                messages.append(body)
+                size += next_size
+                last_id = message_id
+            if last_id is None:
+                return []
+            self._db.execute(
+                "DELETE FROM messages WHERE recipient = ? AND id <= ?",
+                (user_id, last_id),
+            )
+            self._db.execute(
+                "UPDATE chats SET pending = pending - ?, pending_bytes = pending_bytes - ?"
+                " WHERE id = ?",
+                (len(messages), size, user_id),
+            )
+            self._add_pending_bytes(-size)
+        return messages
+
+    def _touch_counselor(self, chat_id: str, now: float):
+        self._db.execute(
+            "UPDATE counselors SET last_seen = ?"
+            " WHERE sid = (SELECT counselor_sid FROM chats WHERE id = ?)",
+            (now, chat_id),
+        )
+
+    def _touch_partner(self, user_id: str, now: float):
+        (partner,) = self._db.execute(
+            "SELECT partner FROM chats WHERE id = ?", (user_id,)
+        ).fetchone()
+        self._db.execute("UPDATE chats SET last_seen = ? WHERE id = ?", (now, partner))
+        self._touch_counselor(partner, now)
+
+    def send(self, user_id: str, *messages: str):
+        with self._transaction():
+            self._put(user_id, messages)
+            self._touch_partner(user_id, time.time())
+
+    def send_to_partner(self, user_id: str, message: Frame):
+        with self._transaction():
+            partner = self._db.execute(
+                "SELECT partner FROM chats WHERE id = ?", (user_id,)
+            ).fetchone()
+            if partner is None:
+                raise KeyError(user_id)
+            self._put(partner[0], (message,))
+            self._touch(user_id, time.time())
+
+    def _close_chat(self, user_id: str):
+        partner = self._db.execute(
+            "SELECT partner FROM chats WHERE id = ?", (user_id,)
+        ).fetchone()
+        for chat_id in (user_id,) if partner is None else (user_id, partner[0]):
+            # along with a match the guest hasn't collected yet
+            self._db.execute("DELETE FROM waiting WHERE guest_key = ?", (chat_id,))
+            chat = self._db.execute(
+                "DELETE FROM chats WHERE id = ? RETURNING pending_bytes, counselor_sid",
+                (chat_id,),
+            ).fetchone()
+            if chat is None:
+                continue
+            pending_bytes, counselor_id = chat
+            self._changed = True
+            self._db.execute("DELETE FROM messages WHERE recipient = ?", (chat_id,))
+            self._add_pending_bytes(-pending_bytes)
+            if counselor_id is not None:
+                self._db.execute(
+                    "UPDATE counselors SET load = MAX(load - 1, 0) WHERE sid = ?",
+                    (counselor_id,),
+                )
+        self._serve_waiting()
+
+    def close_chat(self, user_id: str):
+        with self._transaction():
+            self._close_chat(user_id)
+
+    def new_guest_id(self) -> str:
+        with self._transaction():
+            while True:
+                guest_id = secrets.token_urlsafe(16)
+                if self._db.execute(
+                    "INSERT OR IGNORE INTO guest_ids VALUES (?, ?)",
+                    (guest_id, time.time()),
+                ).rowcount:
+                    return guest_id
+
+    def _touch(self, session_id: str, now: float):
+        for query in (
+            "UPDATE counselors SET last_seen = ? WHERE sid = ?",
+            "UPDATE chats SET last_seen = ? WHERE id = ?",
+            "UPDATE waiting SET last_seen = ? WHERE guest_key = ?",
+            "UPDATE guest_ids SET last_seen = ? WHERE id = ?",
+        ):
+            self._db.execute(query, (now, session_id))
+        self._touch_counselor(session_id, now)
+
+    def touch(self, session_id: str):
+        with self._transaction():
+            self._touch(session_id, time.time())
+
+    def connect(self, user_id: str):
+        self.connected[user_id] += 1
+
+    def disconnect(self, user_id: str):
+        self.connected[user_id] -= 1
+        if not self.connected[user_id]:
+            del self.connected[user_id]
+        self.touch(user_id)
+
+    def reap(self) -> Counter[str]:
+        reaped: Counter[str] = Counter()
+        now = time.time()
+        cutoff = now - self.session_ttl
+        with self._transaction():
+            # other workers can't see this worker's sockets, so keep them fresh
+            for user_id in self.connected:
+                self._touch(user_id, now)
+            for (counselor_id,) in self._db.execute(
+                "SELECT sid FROM counselors WHERE last_seen < ?", (cutoff,)
+            ).fetchall():
+                self.remove_counselor(counselor_id)
+                reaped["counselor"] += 1
+            for (chat_id,) in self._db.execute(
+                "SELECT id FROM chats WHERE last_seen < ?", (cutoff,)
+            ).fetchall():
+                if self._has_chat(chat_id):
+                    self._close_chat(chat_id)
+                    reaped["chat"] += 1
+            if waiting := self._db.execute(
+                "DELETE FROM waiting WHERE counselor_key = '' AND last_seen < ?",
+                (cutoff,),
+            ).rowcount:
+                reaped["chat"] += waiting
+            if guest_ids := self._db.execute(
+                "DELETE FROM guest_ids WHERE last_seen < ?", (cutoff,)
+            ).rowcount:
+                reaped["guest_id"] += guest_ids
+        self.reaped.update(reaped)
+        return reaped
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import time
+
+
+class WaitingGuest:
+    """
+    a guest's place in the waiting room, kept until they collect their match
+    """
+
+    __slots__ = (
+        "ticket",
+        "joined",
+        "last_seen",
+        "counselor_key",
+        "chat_id",
+        "_matched",
+    )
+
+    def __init__(self, ticket: int) -> None:
+        self.ticket = ticket
+        self.joined = self.last_seen = time.monotonic()
+        self.counselor_key = ""
+        self.chat_id = ""
+        self._matched = asyncio.Event()
+
+    def match(self, counselor_key: str, chat_id: str):
+        self.counselor_key = counselor_key
+        self.chat_id = chat_id
+        self._matched.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        wait until a counselor is assigned, returns False if the timeout expired first
+        """
+        try:
+            await asyncio.wait_for(self._matched.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class WaitingRoom:
+    """
+    first come first served queue of guests waiting for a counselor
+
+    Guests are given increasing ticket numbers, so a position is the distance
+    from the head ticket minus guests who left from further up the queue.
+    Those are kept in a sorted list, making a position lookup O(log n).
+    Guests who haven't checked in within lease seconds are skipped.
+    """
+
+    def __init__(self, lease: float) -> None:
+        self.lease = lease
+        self._queue: OrderedDict[str, WaitingGuest] = OrderedDict()
+        self._matched: dict[str, WaitingGuest] = dict()
+        self._left: list[int] = []
+        self._next_ticket = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __contains__(self, guest_key: object) -> bool:
+        return guest_key in self._queue or guest_key in self._matched
+
+    def join(self, guest_key: str) -> WaitingGuest:
+        """
+        add a guest to the back of the queue, or refresh their place if already waiting
+        """
+        if (
+            guest := self._queue.get(guest_key) or self._matched.get(guest_key)
+        ) is None:
+            guest = self._queue[guest_key] = WaitingGuest(self._next_ticket)
+            self._next_ticket += 1
+        guest.last_seen = time.monotonic()
+        return guest
+
+    def position(self, guest: WaitingGuest) -> int:
+        """
+        1 for the guest at the front of the queue, 0 once matched
+        """
+        if guest.counselor_key or not self._queue:
+            return 0
+        head = next(iter(self._queue.values())).ticket
+        return guest.ticket - head - bisect_left(self._left, guest.ticket) + 1
+
+    def _prune_left(self):
+        if not self._queue:
+            self._left.clear()
+            return
+        head = next(iter(self._queue.values())).ticket
+        del self._left[: bisect_left(self._left, head)]
+
+    def leave(self, guest_key: str):
+        """
+        remove a guest whether they are still waiting or already matched
+        """
+        self._matched.pop(guest_key, None)
+        if (guest := self._queue.pop(guest_key, None)) is None:
+            return
+        insort(self._left, guest.ticket)
+        self._prune_left()
+
+    def pop_next(self) -> tuple[str, WaitingGuest] | None:
+        """
+        take the longest waiting guest that is still checking in
+        """
+        expired = time.monotonic() - self.lease
+        next_guest = None
+        while self._queue and next_guest is None:
+            guest_key, guest = self._queue.popitem(last=False)
+            if guest.last_seen >= expired:
+                next_guest = (guest_key, guest)
+        self._prune_left()
+        return next_guest
+
+    def match(
+        self, guest_key: str, guest: WaitingGuest, counselor_key: str, chat_id: str
+    ):
+        """
+        hold a guest's counselor until they next check in
+        """
+        guest.match(counselor_key, chat_id)
+        self._matched[guest_key] = guest
+
+    def collect(self, guest_key: str):
+        """
+        forget a matched guest once they have been told who their counselor is
+        """
+        self._matched.pop(guest_key, None)
@@ -18,155 +18,626 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import asyncio
 import base64
-from queue import Queue
-import secrets
-from threading import Lock
-
-from fastapi import Depends, HTTPException, FastAPI, Form
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+import os
+
+from fastapi import (
+    Body,
+    Depends,
+    Query,
+    HTTPException,
+    FastAPI,
+    Form,
+    Request,
+    Response,
+    WebSocket,
+    status,
+)
+from fastapi.websockets import WebSocketDisconnect
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import logging
 
-from . import models
-from .database import get_db
+from . import metrics, models
+from .database import get_async_db
+from .limits import BodySizeLimit, RateLimiter
+from .mailbox import BudgetExceeded, Frame, Mailbox, MailboxFull, frame_size
+from .prekeys import PreKeyStore
+from .backend import StateBackend
+from .router import ChatRouter
+from .shared import SharedBackend
+from ..common import codec, merkle
 from ..common.common import version
+from ..common.schemas import (
+    ChatContent,
+    ChatContentType,
+    StatusMessage,
+    StatusType,
+)
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
-# hyperdome server user tracking variables
-counselors_available: set[str] = set()
-active_chats: dict[str, Queue[str]] = dict()
-guest_keys = dict()
-counselor_keys = dict()
-active_codes = set()
-
-lock = Lock()
+# largest single chat message accepted, in bytes
+MAX_MESSAGE_BYTES = 64 << 10
+# largest request body or websocket frame accepted, in bytes
+MAX_REQUEST_BYTES = 2 * MAX_MESSAGE_BYTES
+# most messages accepted in one send_messages batch
+MAX_BATCH_MESSAGES = 100
+# how long senders are told to back off when a recipient can't take more
+BACKPRESSURE_RETRY_SECONDS = 2
+
+# path of the shared state database, set when serving from several worker processes
+STATE_DB_ENV = "HYPERDOME_STATE_DB"
+# localhost port to serve metrics on, unset to not serve them
+METRICS_PORT_ENV = "HYPERDOME_METRICS_PORT"
+
+# how often idle sessions are looked for and dropped
+REAP_INTERVAL_SECONDS = 15.0
+
+
+async def reap_sessions():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL_SECONDS)
+        if reaped := await router.run(router.reap):
+            for kind, count in reaped.items():
+                metrics.SESSIONS_EXPIRED.inc(count, kind=kind)
+            logger.info(
+                f"reaped idle sessions: {dict(reaped)}, total {dict(router.reaped)}"
+            )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global router
+    if state_db := os.environ.get(STATE_DB_ENV):
+        router = SharedBackend(state_db)
+    metrics_server = None
+    if metrics_port := os.environ.get(METRICS_PORT_ENV):
+        metrics_server = await metrics.serve_metrics(int(metrics_port))
+    reaper = asyncio.create_task(reap_sessions())
+    yield
+    reaper.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_REQUEST_BYTES)
+app.add_middleware(metrics.RequestMetrics)
+
+# hyperdome server user tracking, only touched from the event loop through router.run
+# except by the gauges below, whose counts are reads that never wait on a lock
+router: StateBackend = ChatRouter()
+
+metrics.Gauge(
+    "hyperdome_counselors_available",
+    "counselors able to take another guest",
+    lambda: router.online,
+)
+metrics.Gauge(
+    "hyperdome_active_chats", "chats in progress", lambda: router.active_chats
+)
+metrics.Gauge(
+    "hyperdome_queued_guests",
+    "guests in the waiting room",
+    lambda: router.queued_guests,
+)
+metrics.Gauge(
+    "hyperdome_queued_message_bytes",
+    "bytes of messages waiting to be delivered",
+    lambda: router.queued_bytes,
+)
+
+# most messages and bytes of messages returned by one collect_messages call
+MAX_COLLECT_MESSAGES = 100
+MAX_COLLECT_BYTES = 256 << 10
+
+# longest a collect_messages request may be held open waiting for a message
+MAX_LONG_POLL_SECONDS = 30.0
+
+# most guests let into the waiting room before new ones are turned away
+MAX_QUEUED_GUESTS = 1000
+
+# token buckets per session, as (tokens a second, burst)
+# sending messages, keyed by the sending session, a batch costs one token a message
+message_limits = RateLimiter(20, 40)
+# polling for messages, matches and new guests, keyed by whoever is polling
+poll_limits = RateLimiter(10, 20)
+# starting sessions, keyed by guest key or counselor name
+session_limits = RateLimiter(5, 20)
+# guest ids are requested anonymously, so this bucket is shared by everyone
+guest_id_limits = RateLimiter(50, 100)
+# handing out key exchange bundles, keyed by counselor so no one can drain their keys
+bundle_limits = RateLimiter(2, 20)
+
+# published pre keys of every counselor
+pre_keys = PreKeyStore()
+
+# most one-time keys a counselor may publish at once
+MAX_PUBLISHED_KEYS = 1000
+
+# most guests a single counselor may chat with at once
+MAX_COUNSELOR_CAPACITY = 16
+
+DISCONNECT_FRAME = ChatContent(
+    type=ChatContentType.STATUS,
+    content=StatusMessage(status=StatusType.DISCONNECT),
+).json()
+
+QUEUE_FULL_FRAME = ChatContent(
+    type=ChatContentType.STATUS,
+    content=StatusMessage(status=StatusType.QUEUE_FULL),
+).json()
+
+
+def is_status_frame(frame: Frame) -> bool:
+    """
+    whether a frame would be taken for one of the server's status frames,
+    peers may not send these or they could end or disrupt each other's chats
+    """
+    if isinstance(frame, bytes):
+        return frame[:2] == bytes(
+            (codec.FRAME_VERSION, codec.CONTENT_TYPES[ChatContentType.STATUS])
+        )
+    if not frame.lstrip().startswith("{"):
+        return False
+    try:
+        return ChatContent.parse_raw(frame).type == ChatContentType.STATUS
+    except ValueError:
+        return False
+
+
+async def deliver(user_id: str, *messages: str):
+    """
+    queue messages for user_id, turning a full mailbox into a backpressure response
+    messages are rate limited by their sender, as over the chat websocket
+    """
+    if any(len(message.encode()) > MAX_MESSAGE_BYTES for message in messages):
+        raise HTTPException(413, "message too large")
+    if any(map(is_status_frame, messages)):
+        raise HTTPException(422, "status frames are only sent by the server")
+    try:
+        # capped so a full batch can still be sent with a full bucket
+        message_limits.check(
+            await router.run(router.partner, user_id),
+            cost=min(len(messages), message_limits.burst),
+        )
+        await router.run(router.send, user_id, *messages)
+    except KeyError:
+        raise HTTPException(404, "no chat")
+    except MailboxFull:
+        raise HTTPException(
+            429,
+            "recipient queue full",
+            headers={"Retry-After": str(BACKPRESSURE_RETRY_SECONDS)},
+        )
+    except BudgetExceeded:
+        logger.warning("message memory budget exhausted")
+        raise HTTPException(
+            503,
+            "server busy",
+            headers={"Retry-After": str(BACKPRESSURE_RETRY_SECONDS)},
+        )
 
 
 @app.get("/probe")
-def probe():
+async def probe():
     return {
         "name": "hyperdome",
         "version": version,
-        "online": len(counselors_available),
+        "online": await router.run(lambda: router.online),
     }
 
 
+def waiting_room_full(pub_key: str) -> bool:
+    return not router.has_session(pub_key) and router.queued_guests >= MAX_QUEUED_GUESTS
+
+
+async def check_waiting_room(pub_key: str):
+    """
+    turn new guests away with a 503 while the waiting room is full
+    """
+    if await router.run(waiting_room_full, pub_key):
+        raise HTTPException(
+            503,
+            "waiting room full",
+            headers={"Retry-After": str(BACKPRESSURE_RETRY_SECONDS)},
+        )
+
+
 @app.post("/request_counselor")
-def request_counselor(guest_id: str = Form(), pub_key: str = Form()):
-    if not counselors_available:
-        return ""
-    with lock:
-        chosen_counselor = secrets.choice(tuple(counselors_available))
-        counselors_available.remove(chosen_counselor)
-    active_chats[pub_key] = Queue()
-    guest_keys[chosen_counselor] = pub_key
-    counselor_key = counselor_keys.pop(chosen_counselor)
-    active_chats[counselor_key] = Queue()
-    return counselor_key
+async def request_counselor(guest_id: str = Form(), pub_key: str = Form()):
+    """
+    match a guest without waiting, unmatched guests are kept in the waiting room
+    so asking again keeps their place in line
+    returns the counselor's key and the chat id to send them messages at,
+    as /waiting_room does
+    """
+    session_limits.check(pub_key)
+    await router.run(router.touch, guest_id)
+    await check_waiting_room(pub_key)
+    counselor_key, chat_id = await router.run(router.match_guest, pub_key)
+    return {"counselor_key": counselor_key, "chat_id": chat_id}
+
+
+@app.post("/waiting_room")
+async def waiting_room(pub_key: str = Form(), wait: float = 0):
+    """
+    join or check in with the queue of guests waiting for a counselor
+    with wait set, hold the request for up to that many seconds until matched
+    new guests are turned away with a 503 while the waiting room is full
+    """
+    poll_limits.check(pub_key)
+    await check_waiting_room(pub_key)
+    guest = await router.run(router.wait_for_counselor, pub_key)
+    if wait > 0 and not guest.counselor_key:
+        await guest.wait(min(wait, MAX_LONG_POLL_SECONDS))
+    if guest.counselor_key:
+        await router.run(router.collect_match, pub_key)
+    return {
+        "counselor_key": guest.counselor_key,
+        "chat_id": guest.chat_id,
+        "position": await router.run(router.position, guest),
+    }
 
 
 @app.get("/poll_connected_guest/{counselor_id}")
-def poll_connected_guest(counselor_id: str):
-    guest_key = guest_keys.pop(counselor_id, "")
-    return guest_key
+async def poll_connected_guest(counselor_id: str):
+    """
+    list guests assigned to the counselor since they last polled
+    """
+    poll_limits.check(counselor_id)
+    return await router.run(router.pop_guests, counselor_id)
 
 
 @app.post("/counseling_complete")
-def counseling_complete(user_id: str = Form()):
-    if user_id not in active_chats.keys():
+async def counseling_complete(user_id: str = Form()):
+    if not await router.run(router.has_session, user_id):
         raise HTTPException(404, "no active chat")
-    with lock:
-        active_chats.pop(user_id)
+    await router.run(router.close_chat, user_id)
     return "Chat Ended"
 
 
 @app.post("/counselor_signout")
-def counselor_signout(user_id: str = Form()):
-    with lock:
-        counselors_available.remove(user_id)
-        counselor_keys.pop(user_id, "")
+async def counselor_signout(user_id: str = Form()):
+    await router.run(router.remove_counselor, user_id)
     return "Success"
 
 
+async def counselor_key(db: AsyncSession, username: str) -> models.CounselorPublicKey:
+    """
+    the counselor's parsed public key, only queried for when it isn't cached
+    """
+    pub_key = models.counselor_keys.get(username)
+    if pub_key is None:
+        counselor = await db.scalar(
+            select(models.Counselor).where(models.Counselor.name == username)
+        )
+        if counselor is None:
+            raise HTTPException(404, "no match for counselor credentials")
+        pub_key = counselor.public_key
+        models.counselor_keys.put(username, pub_key)
+    return pub_key
+
+
+async def register_counselor(
+    db: AsyncSession, username: str, pub_key: str, signup_code: str, signature: bytes
+) -> bool:
+    """
+    redeem a sign-up code and create the counselor in one transaction
+    """
+    activator = await db.scalar(
+        select(models.CounselorSignUp).where(
+            models.CounselorSignUp.passphrase == signup_code,
+            or_(
+                models.CounselorSignUp.expires.is_(None),
+                models.CounselorSignUp.expires > models.utcnow(),
+            ),
+        )
+    )
+    if activator is None:
+        raise HTTPException(404, "no matching sign-up code")
+    try:
+        key = models.parse_public_key(pub_key)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    await db.delete(activator)
+    counselor = models.Counselor(name=username, key=key)
+    verified = counselor.verify(signature, signup_code.encode())
+    if verified:
+        legacy = await db.scalar(
+            select(models.Counselor).where(
+                models.Counselor.name == username, models.Counselor.key.is_(None)
+            )
+        )
+        if legacy is not None:
+            # enrolling again moves a counselor off their old Ed448 key
+            legacy.key, legacy.legacy_key = key, None
+        else:
+            db.add(counselor)
+    await db.commit()
+    return verified
+
+
 @app.post("/counselor_signin")
-def counselor_signin(
+async def counselor_signin(
     username: str = Form(),
     pub_key: str = Form(),
     signature: str | bytes = Form(),
-    db: Session = Depends(get_db),
+    capacity: int = Form(1, ge=1, le=MAX_COUNSELOR_CAPACITY),
+    db: AsyncSession = Depends(get_async_db),
 ):
+    session_limits.check(username)
     signature = base64.urlsafe_b64decode(signature)
-    counselor = (
-        db.query(models.Counselor).filter(models.Counselor.name == username).first()
-    )
-    if counselor is None:
-        raise HTTPException(404, "no match for counselor credentials")
-    if not counselor.verify(signature, pub_key):
+    key = await counselor_key(db, username)
+    if not models.verify_signature(key, signature, pub_key.encode()):
         logger.info(f"attempted counselor login failed verification {username=}")
+        metrics.SIGNIN_FAILURES.inc()
         raise HTTPException(401, "Bad signature")
-    sid = secrets.token_urlsafe(16)
-    # will use capacity variable for this later
-    counselors_available.add(sid)
-    counselor_keys[sid] = pub_key
+    sid = await router.run(router.add_counselor, pub_key, capacity)
     logger.info(f"successful counselor login {username=}")
     return sid
 
 
 @app.post("/counselor_signup")
-def counselor_signup(
+async def counselor_signup(
     username: str = Form(),
     pub_key: str = Form(),
     signup_code: str = Form(),
     signature: str | bytes = Form(),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
+    session_limits.check(username)
     signature = base64.urlsafe_b64decode(signature)
-    activator = models.CounselorSignUp.query.filter_by(
-        passphrase=signup_code
-    ).first_or_404()
-    db.delete(activator)
-    counselor = models.Counselor(name=username, key_bytes=pub_key)
-    if counselor.verify(signature, signup_code.encode()):
-        db.add(counselor)
-        db.commit()
+    if await register_counselor(db, username, pub_key, signup_code, signature):
         logger.info(f"new counselor {username=} added")
-
         return "Good"  # TODO: add better responses
     else:
-        db.commit()
         logger.warning(
             f"{username=} attempted registration but failed key verification"
         )
         raise HTTPException(400, "User not Registered")
 
 
+def decode_key(value: str, length: int = 32) -> bytes:
+    """
+    decode a urlsafe base64 key or signature from a request, or refuse it with a 400
+    """
+    try:
+        raw = base64.urlsafe_b64decode(value)
+    except ValueError:
+        raise HTTPException(400, "malformed key")
+    if len(raw) != length:
+        raise HTTPException(400, f"keys must be {length} bytes")
+    return raw
+
+
+@app.post("/pre_keys/{counselor_key}")
+async def publish_pre_keys(
+    counselor_key: str,
+    signed_pre_key: str = Form(),
+    pre_key_signature: str = Form(),
+    one_time_keys: list[str] = Form([]),
+    one_time_keys_signature: str = Form(""),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    publish a counselor's signed pre key and one-time keys for guests to start chats with
+    returns how many one-time keys the counselor has left
+    """
+    identity = decode_key(counselor_key)
+    session_limits.check(counselor_key)
+    if len(one_time_keys) > MAX_PUBLISHED_KEYS:
+        raise HTTPException(413, f"at most {MAX_PUBLISHED_KEYS} keys at once")
+    pre_key = decode_key(signed_pre_key)
+    signature = decode_key(pre_key_signature, 64)
+    keys = [decode_key(key) for key in one_time_keys]
+    keys_signature = decode_key(one_time_keys_signature, 64) if keys else None
+    identity_key = (await registered_counselor(db, identity)).public_key
+    if not models.verify_signature(identity_key, signature, pre_key) or (
+        keys
+        and not models.verify_signature(
+            identity_key,
+            keys_signature,
+            merkle.commitment(len(keys), merkle.MerkleTree(keys).root),
+        )
+    ):
+        raise HTTPException(401, "Bad signature")
+    await pre_keys.publish(db, identity, pre_key, signature, keys, keys_signature)
+    return await pre_keys.one_time_keys_left(db, identity)
+
+
+async def registered_counselor(db: AsyncSession, identity: bytes) -> models.Counselor:
+    counselor = await db.scalar(
+        select(models.Counselor).where(models.Counselor.key == identity)
+    )
+    if counselor is None:
+        raise HTTPException(404, "no counselor with that key")
+    return counselor
+
+
+@app.get("/pre_keys/{counselor_key}")
+async def count_one_time_keys(
+    counselor_key: str, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    how many one-time keys the counselor has left, checked to know when to upload more
+    """
+    identity = decode_key(counselor_key)
+    poll_limits.check(counselor_key)
+    await registered_counselor(db, identity)
+    return await pre_keys.one_time_keys_left(db, identity)
+
+
+@app.post("/pre_keys/{counselor_key}/one_time_keys")
+async def upload_one_time_keys(
+    counselor_key: str, request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    add one-time keys to a counselor's published pre keys, sent raw
+    as encoded by codec.encode_one_time_keys
+    returns how many one-time keys the counselor has left
+    """
+    identity = decode_key(counselor_key)
+    session_limits.check(counselor_key)
+    try:
+        signature, keys = codec.decode_one_time_keys(await request.body())
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if len(keys) > MAX_PUBLISHED_KEYS * codec.KEY_LENGTH:
+        raise HTTPException(413, f"at most {MAX_PUBLISHED_KEYS} keys at once")
+    counselor = await registered_counselor(db, identity)
+    try:
+        await pre_keys.add_one_time_keys(
+            db, identity, counselor.public_key, keys, signature
+        )
+    except LookupError as e:
+        raise HTTPException(409, str(e))
+    except ValueError:
+        raise HTTPException(401, "Bad signature")
+    return await pre_keys.one_time_keys_left(db, identity)
+
+
+@app.get("/pre_key_bundle/{counselor_key}")
+async def pre_key_bundle(counselor_key: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    a key exchange bundle for starting an encrypted chat with the counselor,
+    encoded as by codec.encode_bundle
+    """
+    identity = decode_key(counselor_key)
+    bundle_limits.check(counselor_key)
+    try:
+        bundle = await pre_keys.take_bundle(db, identity)
+    except LookupError as e:
+        raise HTTPException(404, str(e))
+    return Response(bundle, media_type="application/octet-stream")
+
+
 @app.get("/generate_guest_id")
-def generate_guest_id():
-    # TODO check for collisions
-    return secrets.token_urlsafe(16)
+async def generate_guest_id():
+    guest_id_limits.check("")
+    return await router.run(router.new_guest_id)
 
 
 @app.post("/send_message")
-def message_from_user(message: str = Form(), user_id: str = Form()):
-    try:
-        active_chats[user_id].put_nowait(message)
-    except KeyError:
-        raise HTTPException(404, "no chat")
+async def message_from_user(message: str = Form(), user_id: str = Form()):
+    await deliver(user_id, message)
+    return "Success"
+
+
+@app.post("/send_messages")
+async def messages_from_user(
+    messages: list[str] = Body(max_items=MAX_BATCH_MESSAGES),
+    user_id: str = Body(),
+):
+    """
+    queue an ordered batch of messages for user_id in a single request
+    either every message is queued or none are
+    """
+    await deliver(user_id, *messages)
     return "Success"
 
 
+def drain_mailbox(
+    mailbox: Mailbox, max_messages: int, max_bytes: int
+) -> tuple[list[Frame], bool, bool]:
+    """
+    messages drained from a mailbox, whether it's closed and whether any are left
+    """
+    messages = mailbox.drain(max_messages, max_bytes)
+    return messages, mailbox.closed, bool(len(mailbox))
+
+
 @app.get("/collect_messages/{user_id}")
-def collect_messages(user_id: str):
-    messages: str = ""
+async def collect_messages(
+    user_id: str,
+    wait: float = 0,
+    max_messages: int = Query(MAX_COLLECT_MESSAGES, ge=1, le=MAX_COLLECT_MESSAGES),
+    max_bytes: int = Query(MAX_COLLECT_BYTES, ge=1, le=MAX_COLLECT_BYTES),
+):
+    """
+    return pending messages for user_id, oldest first, up to max_messages of them
+    and max_bytes in total, more is set when others are still waiting
+    with wait set, hold the request for up to that many seconds until one arrives
+    binary frames sent over the websocket are base64 encoded, binary lists where
+    they are among the messages
+    """
+    poll_limits.check(user_id)
     try:
-        message_queue = active_chats[user_id]
-        while not message_queue.empty():
-            messages += f"{message_queue.get_nowait()}\n"
-        chat_status = "CHAT_ACTIVE"
+        mailbox = await router.run(router.mailbox, user_id)
     except KeyError:
-        chat_status = "NO_CHAT"
-    return {"chat_status": chat_status, "messages": messages}
+        return {"chat_status": "NO_CHAT", "messages": [], "more": False}
+    if wait > 0 and not await router.run(len, mailbox):
+        await mailbox.wait(min(wait, MAX_LONG_POLL_SECONDS))
+    messages, closed, more = await router.run(
+        drain_mailbox, mailbox, max_messages, max_bytes
+    )
+    binary = [i for i, message in enumerate(messages) if isinstance(message, bytes)]
+    for i in binary:
+        messages[i] = base64.b64encode(messages[i]).decode()
+    return {
+        "chat_status": "NO_CHAT" if closed else "CHAT_ACTIVE",
+        "messages": messages,
+        "binary": binary,
+        "more": more,
+    }
+
+
+async def _push_frames(websocket: WebSocket, mailbox: Mailbox):
+    while not await router.run(lambda: mailbox.closed):
+        await mailbox.wait()
+        for frame in await router.run(mailbox.drain):
+            if isinstance(frame, bytes):
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+    await websocket.send_text(DISCONNECT_FRAME)
+
+
+async def _relay_frames(websocket: WebSocket, user_id: str):
+    while (message := await websocket.receive())["type"] == "websocket.receive":
+        # binary frames are relayed as they are, see hyperdome.common.codec
+        frame = message["text"] if message.get("text") is not None else message["bytes"]
+        if is_status_frame(frame):
+            logger.debug("dropped status frame sent by a peer")
+            continue
+        try:
+            if frame_size(frame) > MAX_MESSAGE_BYTES or message_limits.acquire(user_id):
+                raise MailboxFull("frame too large or sent too fast")
+            await router.run(router.send_to_partner, user_id, frame)
+        except KeyError:
+            logger.debug("dropped frame sent after chat ended")
+        except (MailboxFull, BudgetExceeded):
+            await websocket.send_text(QUEUE_FULL_FRAME)
+
+
+@app.websocket("/chat/{user_id}")
+async def chat(websocket: WebSocket, user_id: str):
+    """
+    push chat frames to user_id as they arrive and relay frames it sends
+    to its partner, HTTP polling endpoints remain usable as a fallback
+    """
+    try:
+        mailbox = await router.run(router.mailbox, user_id)
+    except KeyError:
+        await websocket.close(status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    push = asyncio.create_task(_push_frames(websocket, mailbox))
+    relay = asyncio.create_task(_relay_frames(websocket, user_id))
+    await router.run(router.connect, user_id)
+    try:
+        await asyncio.wait((push, relay), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        await router.run(router.disconnect, user_id)
+    relay.cancel()
+    push.cancel()
+    if push.done() and not push.cancelled():
+        try:
+            push.result()
+            await websocket.close()
+        except WebSocketDisconnect:
+            logger.debug("chat socket closed before chat ended")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from collections.abc import Iterator
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5")
+from PyQt5.QtCore import QCoreApplication, QTimer
+from PyQt5.QtNetwork import QNetworkAccessManager
+import uvicorn
+
+from hyperdome.client.api import HyperdomeClientApi
+from hyperdome.common.server import Server
+from hyperdome.server.router import ChatRouter
+import hyperdome.server.web as web
+
+COUNSELOR_KEY = "counselor-key"
+GUEST_KEY = "guest-key"
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> Iterator[Server]:
+    """
+    the web app served on a local port, as a client's server details
+    """
+    monkeypatch.setattr(web, "router", ChatRouter())
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    uvicorn_server = uvicorn.Server(uvicorn.Config(web.app, log_level="warning"))
+    thread = threading.Thread(
+        target=uvicorn_server.run, kwargs={"sockets": [sock]}, daemon=True
+    )
+    thread.start()
+    while not uvicorn_server.started:
+        time.sleep(0.01)
+    server = Server()
+    server.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    yield server
+    uvicorn_server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture
+def app() -> QCoreApplication:
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+def run_until(app: QCoreApplication, done: list, timeout_ms: int = 5000):
+    """
+    run the Qt event loop until something is appended to done
+    """
+    timer = QTimer()
+    timer.timeout.connect(lambda: done and app.quit())
+    timer.start(10)
+    QTimer.singleShot(timeout_ms, app.quit)
+    app.exec_()
+
+
+def test_guest_joins_waiting_room(app: QCoreApplication, server: Server):
+    web.router.add_counselor(COUNSELOR_KEY)
+    api = HyperdomeClientApi(server, QNetworkAccessManager())
+    matches = []
+    api.wait_for_counselor(lambda *match: matches.append(match), GUEST_KEY)
+    run_until(app, matches)
+    assert matches == [(COUNSELOR_KEY, web.router.partner(GUEST_KEY))]
+
+
+def test_failed_requests_call_on_error(app: QCoreApplication):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = Server()
+    server.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    sock.close()
+    api = HyperdomeClientApi(server, QNetworkAccessManager())
+    errors = []
+    done = []
+
+    def failed(request: str):
+        errors.append(request)
+        if len(errors) == 3:
+            done.append(True)
+
+    api.get_messages(pytest.fail, lambda: failed("get"), GUEST_KEY)
+    api.send_message(pytest.fail, lambda: failed("send"), GUEST_KEY, "hi")
+    api.wait_for_counselor(pytest.fail, GUEST_KEY, on_error=lambda: failed("wait"))
+    run_until(app, done)
+    assert sorted(errors) == ["get", "send", "wait"]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import pytest
+
+pytest.importorskip("PyQt5")
+from PyQt5.QtCore import QCoreApplication, QThreadPool
+
+from hyperdome.client.prekeys import OneTimeKeyReplenisher
+from hyperdome.common.encryption import CounselorKeyring
+
+
+class Client:
+    """
+    records uploads and accepts them all
+    """
+
+    def __init__(self) -> None:
+        self.uploads: list[bytes] = []
+
+    def upload_one_time_keys(self, callback, identity: str, upload: bytes):
+        self.uploads.append(upload)
+        callback(len(self.uploads) * 100)
+
+
+def wait_for_generation(app: QCoreApplication):
+    QThreadPool.globalInstance().waitForDone()
+    app.processEvents()
+
+
+def test_replenisher_recovers_from_failed_generation(monkeypatch: pytest.MonkeyPatch):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    keyring = CounselorKeyring(one_time_keys=10)
+    client = Client()
+    replenisher = OneTimeKeyReplenisher(client, keyring)
+
+    def fail(count: int) -> bytes:
+        raise RuntimeError("out of entropy")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(keyring, "one_time_keys_upload", fail)
+        replenisher.keys_left(0)
+        wait_for_generation(app)
+    assert not replenisher.generating
+    assert client.uploads == []
+
+    replenisher.keys_left(0)
+    wait_for_generation(app)
+    assert not replenisher.generating
+    assert len(client.uploads) == 1
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from hypothesis import given
+import hypothesis.strategies as st
+import pytest
+
+from hyperdome.common import codec
+from hyperdome.common.schemas import (
+    ChatContent,
+    ChatContentType,
+    EncryptedMessage,
+    IntroductionMessage,
+    KeyExchangeBundle,
+    StatusMessage,
+    StatusType,
+)
+
+encrypted_messages = st.builds(
+    EncryptedMessage,
+    sequence=st.integers(min_value=0, max_value=1 << 64),
+    nonce=st.binary(min_size=12, max_size=12),
+    ciphertext=st.binary(),
+    associated_data=st.none() | st.binary(),
+)
+introductions = st.builds(
+    IntroductionMessage,
+    ephemeral_key=st.binary(min_size=32, max_size=32),
+    one_time_key=st.binary(min_size=32, max_size=32),
+)
+statuses = st.builds(StatusMessage, status=st.sampled_from(StatusType))
+
+chat_content = st.one_of(
+    encrypted_messages.map(
+        lambda m: ChatContent(type=ChatContentType.ENCRYPTED_MESSAGE, content=m)
+    ),
+    introductions.map(
+        lambda m: ChatContent(type=ChatContentType.INTRODUCTION, content=m)
+    ),
+    statuses.map(lambda m: ChatContent(type=ChatContentType.STATUS, content=m)),
+)
+
+
+@given(value=st.integers(min_value=0, max_value=(1 << 70) - 1))
+def test_varint_round_trip(value: int):
+    encoded = codec.encode_varint(value)
+    assert codec.decode_varint(encoded) == (value, len(encoded))
+
+
+def test_long_varints_rejected():
+    with pytest.raises(ValueError):
+        codec.encode_varint(1 << 70)
+    with pytest.raises(ValueError):
+        codec.decode_varint(b"\x80" * codec.MAX_VARINT_LENGTH + b"\x00")
+
+
+@given(content=chat_content, validate=st.booleans())
+def test_round_trip(content: ChatContent, validate: bool):
+    assert codec.decode(codec.encode(content), validate=validate) == content
+
+
+@given(message=encrypted_messages)
+def test_encrypted_message_overhead(message: EncryptedMessage):
+    content = ChatContent(type=ChatContentType.ENCRYPTED_MESSAGE, content=message)
+    payload = len(message.ciphertext) + len(message.associated_data or b"")
+    # header, sequence, nonce and associated data length
+    assert len(codec.encode(content)) - payload <= 2 + 10 + 12 + 5
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        b"",
+        b"\x02\x03\x01",
+        b"\x01\x09",
+        b"\x01\x03\x09",
+        b"\x01\x01\x01" + b"\x00" * 10,
+        b"\x01\x02\x80",
+        b"\x01\x02\x00" + b"\x00" * 5,
+        b"\x01\x02\x00" + b"\x00" * 12 + b"\x05ab",
+        b"\x01\x02" + b"\x80" * 100,
+        b"\x01\x02\x00" + b"\x00" * 13 + b"\x00" * codec.MAX_FRAME_LENGTH,
+    ],
+)
+def test_malformed_frames_rejected(frame: bytes):
+    with pytest.raises(ValueError):
+        codec.decode(frame)
+
+
+def test_oversized_content_not_encoded():
+    message = EncryptedMessage(
+        sequence=0, nonce=bytes(12), ciphertext=bytes(codec.MAX_FRAME_LENGTH)
+    )
+    with pytest.raises(ValueError):
+        codec.encode(
+            ChatContent(type=ChatContentType.ENCRYPTED_MESSAGE, content=message)
+        )
+
+
+@given(
+    bundle=st.builds(
+        KeyExchangeBundle,
+        pub_signing_key=st.binary(min_size=32, max_size=32),
+        signed_pre_key=st.binary(min_size=32, max_size=32),
+        pre_key_signature=st.binary(min_size=64, max_size=64),
+        one_time_key=st.binary(min_size=32, max_size=32),
+        one_time_key_index=st.integers(0, 2**32 - 1),
+        one_time_keys_count=st.integers(0, 2**32 - 1),
+        one_time_keys_signature=st.binary(min_size=64, max_size=64),
+        one_time_key_proof=st.lists(st.binary(min_size=32, max_size=32), max_size=32),
+    ),
+    validate=st.booleans(),
+)
+def test_bundle_round_trip(bundle: KeyExchangeBundle, validate: bool):
+    encoded = codec.encode_bundle(bundle)
+    assert len(encoded) == codec.BUNDLE_MIN_LENGTH + 32 * len(bundle.one_time_key_proof)
+    assert encoded.startswith(
+        codec.encode_bundle_prefix(
+            bundle.pub_signing_key, bundle.signed_pre_key, bundle.pre_key_signature
+        )
+    )
+    assert codec.decode_bundle(encoded, validate=validate) == bundle
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x01" * (codec.BUNDLE_MIN_LENGTH - 1),
+        b"\x01" * (codec.BUNDLE_MIN_LENGTH + 1),
+        b"\x02" * codec.BUNDLE_MIN_LENGTH,
+    ],
+)
+def test_malformed_bundles_rejected(data: bytes):
+    with pytest.raises(ValueError):
+        codec.decode_bundle(data)
+
+
+@given(
+    signature=st.binary(min_size=64, max_size=64),
+    keys=st.lists(st.binary(min_size=32, max_size=32)).map(b"".join),
+)
+def test_one_time_keys_round_trip(signature: bytes, keys: bytes):
+    encoded = codec.encode_one_time_keys(signature, keys)
+    assert len(encoded) == 1 + 64 + len(keys)
+    assert codec.decode_one_time_keys(encoded) == (signature, keys)
+
+
+@pytest.mark.parametrize(
+    "data", [b"\x01" * 64, b"\x02" * 65, b"\x01" * 66, b"\x01" * (65 + 33)]
+)
+def test_malformed_one_time_keys_rejected(data: bytes):
+    with pytest.raises(ValueError):
+        codec.decode_one_time_keys(data)
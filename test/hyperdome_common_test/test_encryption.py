@@ -21,7 +21,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import timedelta
 import secrets
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from hyperdome.common import codec, merkle
 import hyperdome.common.encryption as enc
+from hyperdome.common.schemas import IntroductionMessage
 import pytest
 from hypothesis import given, assume, settings
 import hypothesis.strategies as st
@@ -41,7 +46,9 @@ def pre_exchanged_users() -> UserPair:
             enc.Encoding.Raw, enc.PublicFormat.Raw
         )
     )
-    ot_key = enc.PubKeyBytes(secrets.choice(key_bundle.one_time_keys))
+    index = secrets.randbelow(len(key_bundle.one_time_keys))
+    ot_key = enc.PubKeyBytes(key_bundle.one_time_keys[index])
+    tree = merkle.MerkleTree(key_bundle.one_time_keys)
     eph_key = enc.PubKeyBytes(
         guest.public_key.public_bytes(enc.Encoding.Raw, enc.PublicFormat.Raw)
     )
@@ -55,6 +62,10 @@ def pre_exchanged_users() -> UserPair:
             pre_key_signature=key_bundle.pre_key_signature,
             signed_pre_key=key_bundle.signed_pre_key,
             pub_signing_key=pub_signing_key,
+            one_time_key_index=index,
+            one_time_keys_count=len(tree),
+            one_time_keys_signature=key_bundle.one_time_keys_signature,
+            one_time_key_proof=tree.proof(index),
         )
     )
 
@@ -177,3 +188,118 @@ def test_x25519_from_ed25519(key_bytes: bytes):
     assert pbk_x1.public_bytes(Encoding.Raw, PublicFormat.Raw) == pbk_x2.public_bytes(
         Encoding.Raw, PublicFormat.Raw
     )
+
+
+def test_one_time_keys_upload():
+    keyring = enc.CounselorKeyring()
+    published = keyring.pre_key_bundle.one_time_keys
+    assert len(published) == 100
+    signature, keys = codec.decode_one_time_keys(keyring.one_time_keys_upload(10))
+    new_keys = [keys[start : start + 32] for start in range(0, len(keys), 32)]
+    # the signature commits to the new keys appended to those published
+    tree = merkle.MerkleTree(published + new_keys)
+    keyring.public_signing_key.verify(signature, merkle.commitment(110, tree.root))
+    assert len(new_keys) == 10
+    assert set(new_keys) < set(keyring._one_time_key_pairs)
+    assert len(keyring.pre_key_bundle.one_time_keys) == 110
+
+
+def test_one_time_keys_join_tree_once_uploaded():
+    keyring = enc.CounselorKeyring()
+    published = keyring.pre_key_bundle.one_time_keys
+
+    def upload(count: int) -> tuple[bytes, list[bytes], bytes]:
+        upload = keyring.one_time_keys_upload(count)
+        signature, keys = codec.decode_one_time_keys(upload)
+        return (
+            upload,
+            [keys[start : start + 32] for start in range(0, len(keys), 32)],
+            signature,
+        )
+
+    # a lost upload's keys aren't committed to by the next one
+    upload(10)
+    accepted, keys, signature = upload(5)
+    tree = merkle.MerkleTree(published + keys)
+    keyring.public_signing_key.verify(signature, merkle.commitment(105, tree.root))
+
+    keyring.one_time_keys_uploaded(accepted)
+    _, more_keys, signature = upload(5)
+    tree.extend(more_keys)
+    keyring.public_signing_key.verify(signature, merkle.commitment(110, tree.root))
+
+
+def test_key_pool_waits_for_keys():
+    pool = enc.OneTimeKeyPool(5)
+    taken = pool.take(12)
+    assert len({key for key, _ in taken}) == 12
+    assert all(
+        private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw) == key
+        for key, private in taken
+    )
+
+
+def test_bundle_signatures_memoized():
+    keyring = enc.CounselorKeyring(one_time_keys=10)
+    bundle = keyring.pre_key_bundle
+    assert keyring.one_time_keys_signature is keyring.one_time_keys_signature
+    assert keyring.pre_key_signature is keyring.pre_key_signature
+
+    guest = enc.GuestKeyring()
+    keyring.exchange(
+        IntroductionMessage(
+            ephemeral_key=guest.public_key.public_bytes(Encoding.Raw, PublicFormat.Raw),
+            one_time_key=bundle.one_time_keys[0],
+        )
+    )
+    remaining = keyring.pre_key_bundle
+    assert remaining.one_time_keys == bundle.one_time_keys[1:]
+    tree = merkle.MerkleTree(remaining.one_time_keys)
+    keyring.public_signing_key.verify(
+        remaining.one_time_keys_signature, merkle.commitment(len(tree), tree.root)
+    )
+
+
+def test_guest_checks_one_time_key():
+    counselor = enc.CounselorKeyring(one_time_keys=5)
+    published = counselor.pre_key_bundle
+    tree = merkle.MerkleTree(published.one_time_keys)
+    bundle = enc.KeyExchangeBundle(
+        pub_signing_key=counselor.identity_key_bytes,
+        signed_pre_key=published.signed_pre_key,
+        pre_key_signature=published.pre_key_signature,
+        one_time_key=published.one_time_keys[2],
+        one_time_key_index=2,
+        one_time_keys_count=5,
+        one_time_keys_signature=published.one_time_keys_signature,
+        one_time_key_proof=tree.proof(2),
+    )
+    enc.GuestKeyring().exchange(bundle)
+
+    forged = bundle.copy(update={"one_time_key": published.one_time_keys[3]})
+    with pytest.raises(InvalidSignature):
+        enc.GuestKeyring().exchange(forged)
+    truncated = bundle.copy(update={"one_time_key_proof": tree.proof(2)[1:]})
+    with pytest.raises(ValueError):
+        enc.GuestKeyring().exchange(truncated)
+
+
+@given(
+    key_material=st.binary(min_size=32, max_size=32),
+    window=st.integers(1, 10),
+)
+@settings(max_examples=20)
+def test_ratchet_matches_hkdf(key_material: bytes, window: int):
+    ratchet = enc.KeyRatchet(key_material, window)
+    kdf_key = key_material
+    for counter in range(1, 25):
+        new_key_bytes = enc.HKDF(
+            enc.hashes.BLAKE2b(64),
+            64,
+            enc.RATCHET_SALT,
+            enc.RATCHET_INFO,
+            enc.default_backend(),
+        ).derive(kdf_key)
+        kdf_key = new_key_bytes[32:]
+        assert ratchet.counter == counter
+        assert ratchet.key == new_key_bytes[:32]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from hypothesis import given
+import hypothesis.strategies as st
+import pytest
+
+from hyperdome.common import merkle
+
+
+def reference_root(keys: list[bytes]) -> bytes:
+    # the recursive definition from RFC 9162
+    if len(keys) == 1:
+        return merkle.leaf_hash(keys[0])
+    split = 1 << ((len(keys) - 1).bit_length() - 1)
+    return merkle.node_hash(reference_root(keys[:split]), reference_root(keys[split:]))
+
+
+keys = st.lists(st.binary(min_size=32, max_size=32), min_size=1, max_size=70)
+
+
+@given(keys=keys)
+def test_appends_match_whole_tree(keys: list[bytes]):
+    tree = merkle.MerkleTree()
+    for count, key in enumerate(keys, 1):
+        tree.append(key)
+        assert tree.root == reference_root(keys[:count])
+
+
+@given(keys=keys, data=st.data())
+def test_inclusion_proofs(keys: list[bytes], data: st.DataObject):
+    tree = merkle.MerkleTree(keys)
+    index = data.draw(st.integers(0, len(keys) - 1))
+    proof = tree.proof(index)
+    assert len(proof) <= (len(keys) - 1).bit_length()
+    assert merkle.root_from_proof(keys[index], index, len(keys), proof) == tree.root
+
+    other = bytes(32) if keys[index] != bytes(32) else bytes([1]) * 32
+    assert merkle.root_from_proof(other, index, len(keys), proof) != tree.root
+    if len(keys) > 1:
+        wrong_index = (index + 1) % len(keys)
+        try:
+            root = merkle.root_from_proof(keys[index], wrong_index, len(keys), proof)
+        except ValueError:
+            pass
+        else:
+            assert root != tree.root or keys[index] == keys[wrong_index]
+
+
+@pytest.mark.parametrize("size", [1, 5, 8])
+def test_malformed_proofs_rejected(size: int):
+    keys = [bytes([n]) * 32 for n in range(size)]
+    proof = merkle.MerkleTree(keys).proof(0)
+    with pytest.raises(ValueError):
+        merkle.root_from_proof(keys[0], 0, size, proof + [bytes(32)])
+    if proof:
+        with pytest.raises(ValueError):
+            merkle.root_from_proof(keys[0], 0, size, proof[:-1])
+    with pytest.raises(ValueError):
+        merkle.root_from_proof(keys[0], size, size, proof)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+from datetime import timedelta
+
+from click.testing import CliRunner
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import cryptography.hazmat.primitives.serialization as serial
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.orm import sessionmaker
+
+from hyperdome.server import database, models
+from hyperdome.server.scripts.cli import admin
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'hyperdome_server.db'}")
+    SessionLocal = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", SessionLocal)
+    monkeypatch.setattr(models.counselor_keys, "stamp", tmp_path / "changed")
+    monkeypatch.setattr(models.counselor_keys, "stamp_interval", 0)
+    yield SessionLocal()
+    engine.dispose()
+
+
+def test_generate_codes(db, tmp_path):
+    result = CliRunner().invoke(admin, ["generate", "--count", "3"])
+    assert result.exit_code == 0
+    codes = result.output.split()
+    assert len(set(codes)) == 3
+    stored = db.query(models.CounselorSignUp).all()
+    assert sorted(code.passphrase for code in stored) == sorted(codes)
+    assert all(code.expires is None for code in stored)
+
+    indexes = inspect(db.bind).get_indexes("counselor_signup_tokens")
+    assert {"name": "ix_counselor_signup_tokens_passphrase"}.items() <= indexes[
+        0
+    ].items()
+
+
+def test_generate_codes_to_file_with_expiry(db, tmp_path):
+    output = tmp_path / "codes.txt"
+    result = CliRunner().invoke(
+        admin, ["generate", "-n", "50", "--expires", "24", "-o", str(output)]
+    )
+    assert result.exit_code == 0
+    assert "50 sign-up codes written" in result.output
+    assert len(output.read_text().split()) == 50
+
+    expires = {code.expires for code in db.query(models.CounselorSignUp)}
+    (expiry,) = expires
+    assert timedelta(hours=23) < expiry - models.utcnow() <= timedelta(hours=24)
+
+
+def new_key() -> str:
+    raw = (
+        Ed25519PrivateKey.generate()
+        .public_key()
+        .public_bytes(serial.Encoding.Raw, serial.PublicFormat.Raw)
+    )
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def test_bulk_add_from_csv(db, tmp_path):
+    keys = [new_key() for _ in range(10_000)]
+    roster = tmp_path / "roster.csv"
+    roster.write_text(
+        "name,key\n"
+        + "".join(f"counselor-{number},{key}\n" for number, key in enumerate(keys))
+        + "broken,not-a-key\n"
+        + f"counselor-0,{new_key()}\n"
+    )
+
+    result = CliRunner().invoke(admin, ["add", "--csv", str(roster)])
+
+    assert result.exit_code == 1
+    assert "10000 counselors added" in result.stdout
+    assert f"{roster}:10002" in result.stderr
+    assert "10002 processed: 10000 changed, 1 skipped, 1 invalid" in result.stderr
+    assert db.query(models.Counselor).count() == 10_000
+
+
+def test_add_and_remove(db, tmp_path):
+    key_file = tmp_path / "alice.pub"
+    key_file.write_text(new_key())
+    bob_key = new_key()
+    result = CliRunner().invoke(
+        admin, ["add", "-i", str(key_file), f"bob={bob_key}", "carol=" + new_key()]
+    )
+    assert result.exit_code == 0
+    assert {c.name for c in db.query(models.Counselor)} == {"alice", "bob", "carol"}
+
+    result = CliRunner().invoke(
+        admin, ["remove", "--yes", "-f", str(key_file), "-k", bob_key, "nobody"]
+    )
+    assert result.exit_code == 0
+    assert "2 counselors removed" in result.output
+    assert [c.name for c in db.query(models.Counselor)] == ["carol"]
+
+
+def test_changes_reach_running_servers(db):
+    # another process only learns of changes through the stamp file
+    server_keys = models.KeyCache(stamp=models.counselor_keys.stamp, stamp_interval=0)
+    server_keys.put("alice", Ed25519PrivateKey.generate().public_key())
+    assert server_keys.get("alice") is not None
+
+    assert CliRunner().invoke(admin, ["remove", "--yes", "alice"]).exit_code == 0
+    assert server_keys.get("alice") is None
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from hypothesis import given
+import hypothesis.strategies as st
+import pytest
+
+from hyperdome.server.matching import (
+    STRATEGIES,
+    LeastLoadedPool,
+    LeastRecentlyAssignedPool,
+    RoundRobinPool,
+)
+
+counselor_ids = st.sampled_from([f"counselor-{i}" for i in range(8)])
+operations = st.lists(
+    st.tuples(
+        st.sampled_from(["add", "discard", "forget", "choose", "release"]),
+        counselor_ids,
+    )
+)
+
+
+@pytest.mark.parametrize("pool_type", STRATEGIES.values())
+@given(operations=operations)
+def test_pool_matches_set(pool_type, operations):
+    pool = pool_type()
+    expected: set[str] = set()
+    for operation, counselor_id in operations:
+        if operation == "add":
+            pool.add(counselor_id)
+            expected.add(counselor_id)
+        elif operation in ("discard", "forget"):
+            getattr(pool, operation)(counselor_id)
+            expected.discard(counselor_id)
+        elif operation == "release":
+            pool.release(counselor_id)
+        elif expected:
+            assert pool.choose() in expected
+        else:
+            with pytest.raises(IndexError):
+                pool.choose()
+        assert len(pool) == len(expected)
+        assert all(counselor_id in pool for counselor_id in expected)
+
+
+def test_round_robin_order():
+    pool = RoundRobinPool()
+    [pool.add(counselor_id) for counselor_id in "abc"]
+    assert [pool.choose() for _ in range(6)] == list("abcabc")
+
+
+def test_least_recently_assigned_prefers_new():
+    pool = LeastRecentlyAssignedPool()
+    [pool.add(counselor_id) for counselor_id in "ab"]
+    assert pool.choose() == "b"
+    pool.add("c")
+    assert [pool.choose() for _ in range(3)] == list("cab")
+
+
+def test_least_recently_assigned_keeps_place_after_release():
+    pool = LeastRecentlyAssignedPool()
+    [pool.add(counselor_id) for counselor_id in "abc"]
+    assert pool.choose() == "c"
+    # c is full until their chat ends
+    pool.discard("c")
+    assert pool.choose() == "b"
+    pool.add("c")
+    assert [pool.choose() for _ in range(3)] == list("acb")
+
+
+@given(operations=operations)
+def test_least_loaded_chooses_minimum(operations):
+    pool = LeastLoadedPool()
+    loads: dict[str, int] = {}
+    for operation, counselor_id in operations:
+        if operation == "add" and counselor_id not in loads:
+            pool.add(counselor_id)
+            loads[counselor_id] = 0
+        elif operation == "discard":
+            pool.discard(counselor_id)
+            loads.pop(counselor_id, None)
+        elif operation == "release" and counselor_id in loads:
+            pool.release(counselor_id)
+            loads[counselor_id] = max(loads[counselor_id] - 1, 0)
+        elif operation == "choose" and loads:
+            chosen = pool.choose()
+            assert loads[chosen] == min(loads.values())
+            loads[chosen] += 1
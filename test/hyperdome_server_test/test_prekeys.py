@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import secrets
+
+import pytest
+
+from hyperdome.server.prekeys import OneTimeKeys
+
+
+def test_one_time_keys_popped_once():
+    keys = [secrets.token_bytes(32) for _ in range(100)]
+    one_time_keys = OneTimeKeys(keys)
+    assert len(one_time_keys) == 100
+
+    popped = [one_time_keys.pop_random() for _ in range(100)]
+    assert sorted(popped) == sorted(keys)
+    assert popped != keys
+    assert len(one_time_keys) == 0
+    with pytest.raises(IndexError):
+        one_time_keys.pop_random()
+
+    one_time_keys.extend(keys[:1])
+    assert one_time_keys.pop_random() == keys[0]
+
+
+def test_one_time_keys_checked():
+    with pytest.raises(ValueError):
+        OneTimeKeys([b"short"])
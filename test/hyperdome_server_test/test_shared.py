@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from pathlib import Path
+import threading
+import time
+
+from fastapi.testclient import TestClient
+import pytest
+
+from hyperdome.server.mailbox import MailboxFull
+from hyperdome.server import shared
+from hyperdome.server.shared import SharedBackend
+import hyperdome.server.web as web
+
+COUNSELOR_KEY = "counselor-key"
+GUEST_KEY = "guest-key"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def state_db(tmp_path: Path) -> Path:
+    path = tmp_path / "state.db"
+    SharedBackend.create(path, max_chat_messages=3)
+    return path
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch, state_db: Path):
+    monkeypatch.setenv(web.STATE_DB_ENV, str(state_db))
+    monkeypatch.setattr(web, "router", web.router)
+    with TestClient(web.app) as test_client:
+        yield test_client
+
+
+def test_http_message_round_trip(client: TestClient):
+    assert isinstance(web.router, SharedBackend)
+    counselor_id = web.router.add_counselor(COUNSELOR_KEY)
+    response = client.post(
+        "/request_counselor", data={"guest_id": "guest", "pub_key": GUEST_KEY}
+    )
+    chat = response.json()["chat_id"]
+    (new_guest,) = client.get(f"/poll_connected_guest/{counselor_id}").json()
+    assert new_guest == {"guest_key": GUEST_KEY, "chat_id": chat}
+
+    client.post("/send_message", data={"message": "hello", "user_id": chat})
+    client.post("/send_message", data={"message": "again", "user_id": chat})
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json() == {
+        "chat_status": "CHAT_ACTIVE",
+        "messages": ["hello", "again"],
+        "binary": [],
+        "more": False,
+    }
+
+    client.post("/counseling_complete", data={"user_id": GUEST_KEY})
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json()["chat_status"] == "NO_CHAT"
+    assert web.router.online == 1
+
+
+def test_full_mailbox_queues_nothing(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.add_counselor(COUNSELOR_KEY)
+    backend.match_guest(GUEST_KEY)
+    backend.send(GUEST_KEY, "1", "2")
+    with pytest.raises(MailboxFull):
+        backend.send(GUEST_KEY, "3", "4")
+    assert backend.mailbox(GUEST_KEY).drain() == ["1", "2"]
+
+
+@pytest.mark.anyio
+async def test_message_wakes_other_worker(state_db: Path):
+    worker_a = SharedBackend(state_db)
+    worker_b = SharedBackend(state_db)
+    worker_a.add_counselor(COUNSELOR_KEY)
+    assert worker_b.match_guest(GUEST_KEY)[0] == COUNSELOR_KEY
+
+    mailbox = worker_a.mailbox(GUEST_KEY)
+    waiter = asyncio.create_task(mailbox.wait(10))
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    worker_b.send_to_partner(worker_b.wait_for_counselor(GUEST_KEY).chat_id, "hello")
+    assert await asyncio.wait_for(waiter, 1)
+    assert mailbox.drain() == ["hello"]
+
+
+@pytest.mark.anyio
+async def test_only_waited_on_changes_notify(state_db: Path):
+    worker_a = SharedBackend(state_db)
+    worker_b = SharedBackend(state_db)
+    worker_a.add_counselor(COUNSELOR_KEY)
+    chat_id = worker_a.match_guest(GUEST_KEY)[1]
+
+    changed = worker_a.notifier.watch()
+    waiter = asyncio.create_task(worker_a.notifier.wait(changed, 10))
+    worker_a.touch(GUEST_KEY)
+    worker_b.touch(chat_id)
+    worker_b.pop_guests("nobody")
+    await asyncio.sleep(0.2)
+    assert not waiter.done()
+    worker_b.send(GUEST_KEY, "hello")
+    assert await asyncio.wait_for(waiter, 1)
+
+
+@pytest.mark.anyio
+async def test_run_off_event_loop(state_db: Path):
+    backend = SharedBackend(state_db)
+    assert await backend.run(threading.get_ident) != threading.get_ident()
+    counselor_id = await backend.run(backend.add_counselor, COUNSELOR_KEY)
+    assert await backend.run(backend.pop_guests, counselor_id) == []
+
+
+@pytest.mark.parametrize(
+    "strategy, expected",
+    [
+        ("round_robin", "abab"),
+        ("least_recently_assigned", "baba"),
+        ("least_loaded", "abab"),
+    ],
+)
+def test_matching_strategy(tmp_path: Path, strategy: str, expected: str):
+    backend = SharedBackend.create(tmp_path / "state.db", matching_strategy=strategy)
+    for counselor in "ab":
+        backend.add_counselor(counselor, capacity=2)
+    matched = "".join(backend.match_guest(f"guest-{i}")[0] for i in range(4))
+    assert matched == expected
+    # workers opening the database match the same way
+    assert SharedBackend(tmp_path / "state.db").matching_strategy == strategy
+
+
+def test_random_matching_uses_secrets(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    backend = SharedBackend.create(tmp_path / "state.db", matching_strategy="random")
+    for counselor in "abc":
+        backend.add_counselor(counselor)
+    chosen = []
+
+    def choice(eligible: list):
+        chosen.append(len(eligible))
+        return eligible[-1]
+
+    monkeypatch.setattr(shared.secrets, "choice", choice)
+    matched = "".join(backend.match_guest(f"guest-{i}")[0] for i in range(3))
+    # each guest is matched with one of the counselors still free
+    assert chosen == [3, 2, 1]
+    assert sorted(matched) == ["a", "b", "c"]
+    assert backend.match_guest("guest-3") == ("", "")
+
+
+def test_unknown_matching_strategy(tmp_path: Path):
+    with pytest.raises(ValueError):
+        SharedBackend.create(tmp_path / "state.db", matching_strategy="nearest")
+
+
+@pytest.mark.anyio
+async def test_waiting_guest_matched_by_other_worker(state_db: Path):
+    worker_a = SharedBackend(state_db)
+    worker_b = SharedBackend(state_db)
+    first = worker_a.wait_for_counselor("first")
+    second = worker_a.wait_for_counselor("second")
+    assert (worker_a.position(first), worker_a.position(second)) == (1, 2)
+
+    waiter = asyncio.create_task(first.wait(10))
+    await asyncio.sleep(0.05)
+    counselor_id = worker_b.add_counselor(COUNSELOR_KEY)
+    assert await asyncio.wait_for(waiter, 1)
+    assert first.counselor_key == COUNSELOR_KEY
+    assert worker_a.position(worker_a.wait_for_counselor("second")) == 1
+    assert worker_b.pop_guests(counselor_id) == [
+        {"guest_key": "first", "chat_id": first.chat_id}
+    ]
+
+
+def test_idle_sessions_reaped(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.add_counselor(COUNSELOR_KEY, capacity=2)
+    backend.match_guest(GUEST_KEY)
+    backend.new_guest_id()
+    chat_id = backend.wait_for_counselor(GUEST_KEY).chat_id
+    backend.connect(GUEST_KEY)
+    backend.connect(chat_id)
+    assert backend.reap() == {}
+
+    backend.session_ttl = 0
+    assert backend.reap() == {"guest_id": 1}
+    backend.disconnect(GUEST_KEY)
+    backend.disconnect(chat_id)
+    assert backend.reap() == {"counselor": 1, "chat": 1}
+    assert not backend.has_session(GUEST_KEY)
+
+
+def test_chatting_counselor_not_reaped(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.add_counselor(COUNSELOR_KEY)
+    backend.match_guest(GUEST_KEY)
+    backend.session_ttl = 0.1
+    time.sleep(0.15)
+    backend.send(GUEST_KEY, "hi")
+    backend.mailbox(GUEST_KEY)
+    assert backend.reap() == {}
+    backend.close_chat(GUEST_KEY)
+    assert backend.online == 1
+
+
+def test_counselor_ends_uncollected_match(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.wait_for_counselor(GUEST_KEY)
+    counselor_id = backend.add_counselor(COUNSELOR_KEY)
+    (new_guest,) = backend.pop_guests(counselor_id)
+    backend.close_chat(new_guest["chat_id"])
+    assert not backend.has_session(GUEST_KEY)
+    chat_id = backend.wait_for_counselor(GUEST_KEY).chat_id
+    assert chat_id != new_guest["chat_id"]
+    assert backend.partner(GUEST_KEY) == chat_id
+
+
+def test_bounded_drain(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.add_counselor(COUNSELOR_KEY)
+    backend.match_guest(GUEST_KEY)
+    backend.send(GUEST_KEY, "aaaa", "bb", "cc")
+    mailbox = backend.mailbox(GUEST_KEY)
+    assert mailbox.drain(max_bytes=2) == ["aaaa"]
+    assert mailbox.drain(max_messages=1) == ["bb"]
+    assert len(mailbox) == 1
+    assert mailbox.drain() == ["cc"]
+    assert backend.queued_bytes == 0
+
+
+def test_binary_frames_kept(state_db: Path):
+    backend = SharedBackend(state_db)
+    backend.add_counselor(COUNSELOR_KEY)
+    chat_id = backend.match_guest(GUEST_KEY)[1]
+    backend.send_to_partner(chat_id, b"\x01\x03\x02")
+    backend.send_to_partner(chat_id, "text")
+    assert backend.queued_bytes == 7
+    assert backend.mailbox(GUEST_KEY).drain() == [b"\x01\x03\x02", "text"]
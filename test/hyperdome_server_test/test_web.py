@@ -0,0 +1,994 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperdome
+
+Copyright (C) 2023 Skyelar Craver <scravers@protonmail.com>
+                   and Steven Pitts <makusu2@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from datetime import timedelta
+from pathlib import Path
+import time
+
+import base64
+
+from cryptography.hazmat.primitives.asymmetric.ed448 import Ed448PrivateKey
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+import cryptography.hazmat.primitives.serialization as serial
+from fastapi.testclient import TestClient
+from httpx import AsyncClient
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, StaticPool
+
+from hyperdome.common import codec
+from hyperdome.common.encryption import CounselorKeyring, GuestKeyring
+from hyperdome.common.schemas import (
+    ChatContent,
+    ChatContentType,
+    EncryptedMessage,
+    IntroductionMessage,
+    StatusMessage,
+    StatusType,
+)
+from hyperdome.server import metrics, models
+from hyperdome.server.database import (
+    get_async_db,
+    make_async_engine,
+    make_async_session,
+    make_engine,
+)
+from hyperdome.server.limits import RateLimiter
+from hyperdome.server.prekeys import PreKeyStore
+from hyperdome.server.router import ChatRouter
+import hyperdome.server.web as web
+
+COUNSELOR_KEY = "counselor-key"
+GUEST_KEY = "guest-key"
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter())
+    monkeypatch.setattr(web, "pre_keys", PreKeyStore())
+    for name in (
+        "message_limits",
+        "poll_limits",
+        "session_limits",
+        "guest_id_limits",
+        "bundle_limits",
+    ):
+        limiter = getattr(web, name)
+        monkeypatch.setattr(web, name, RateLimiter(limiter.rate, limiter.burst))
+    with TestClient(web.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def db_path(tmp_path) -> Path:
+    return tmp_path / "hyperdome_server.db"
+
+
+@pytest.fixture
+def db(db_path: Path):
+    engine = make_engine(f"sqlite:///{db_path}")
+    models.create_models(engine)
+    session = sessionmaker(bind=engine)()
+    # connections can't be shared between the event loops of each test client
+    async_engine = make_async_engine(
+        f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool
+    )
+    AsyncSession = make_async_session(async_engine)
+
+    async def get_test_db():
+        async with AsyncSession() as async_session:
+            yield async_session
+
+    web.app.dependency_overrides[get_async_db] = get_test_db
+    yield session
+    web.app.dependency_overrides.clear()
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def counselor_key(db) -> Ed25519PrivateKey:
+    key = Ed25519PrivateKey.generate()
+    db.add(models.Counselor(name="counselor", key=raw_public_key(key)))
+    db.commit()
+    return key
+
+
+def raw_public_key(key: Ed25519PrivateKey) -> bytes:
+    return key.public_key().public_bytes(serial.Encoding.Raw, serial.PublicFormat.Raw)
+
+
+@pytest.fixture
+def chat(client: TestClient) -> str:
+    """
+    open a chat between a counselor and guest, returning the counselor's chat id
+    """
+    counselor_id = web.router.add_counselor(COUNSELOR_KEY)
+    response = client.post(
+        "/request_counselor", data={"guest_id": "guest", "pub_key": GUEST_KEY}
+    )
+    match = response.json()
+    assert match["counselor_key"] == COUNSELOR_KEY
+    (new_guest,) = client.get(f"/poll_connected_guest/{counselor_id}").json()
+    assert new_guest == {"guest_key": GUEST_KEY, "chat_id": match["chat_id"]}
+    return match["chat_id"]
+
+
+def test_no_counselor_available(client: TestClient):
+    response = client.post(
+        "/request_counselor", data={"guest_id": "guest", "pub_key": GUEST_KEY}
+    )
+    assert response.json() == {"counselor_key": "", "chat_id": ""}
+
+
+def test_request_counselor_keeps_line(client: TestClient):
+    for guest in ("first", "second"):
+        response = client.post(
+            "/request_counselor", data={"guest_id": guest, "pub_key": guest}
+        )
+        assert response.json()["counselor_key"] == ""
+    assert web.router.queued_guests == 2
+
+    web.router.add_counselor(COUNSELOR_KEY)
+    # the counselor went to the guest who asked first, not whoever asks next
+    response = client.post(
+        "/request_counselor", data={"guest_id": "second", "pub_key": "second"}
+    )
+    assert response.json()["counselor_key"] == ""
+    response = client.post(
+        "/request_counselor", data={"guest_id": "first", "pub_key": "first"}
+    )
+    assert response.json()["counselor_key"] == COUNSELOR_KEY
+    assert web.router.queued_guests == 1
+
+
+def test_counselor_signin(client: TestClient, counselor_key: Ed25519PrivateKey):
+    signature = base64.urlsafe_b64encode(
+        counselor_key.sign(COUNSELOR_KEY.encode())
+    ).decode()
+    response = client.post(
+        "/counselor_signin",
+        data={
+            "username": "counselor",
+            "pub_key": COUNSELOR_KEY,
+            "signature": signature,
+        },
+    )
+    assert response.status_code == 200
+    assert web.router.online == 1
+
+    response = client.post(
+        "/counselor_signin",
+        data={"username": "counselor", "pub_key": GUEST_KEY, "signature": signature},
+    )
+    assert response.status_code == 401
+
+
+def sign_in(client: TestClient, key: Ed25519PrivateKey | Ed448PrivateKey) -> int:
+    signature = base64.urlsafe_b64encode(key.sign(COUNSELOR_KEY.encode())).decode()
+    response = client.post(
+        "/counselor_signin",
+        data={
+            "username": "counselor",
+            "pub_key": COUNSELOR_KEY,
+            "signature": signature,
+        },
+    )
+    return response.status_code
+
+
+def test_counselor_key_cached(
+    client: TestClient,
+    db,
+    counselor_key: Ed25519PrivateKey,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    assert sign_in(client, counselor_key) == 200
+
+    async def no_query(*args):
+        raise AssertionError("database queried for a cached key")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(AsyncSession, "scalar", no_query)
+        assert sign_in(client, counselor_key) == 200
+
+
+def test_counselor_key_invalidated(
+    client: TestClient, db, counselor_key: Ed25519PrivateKey
+):
+    assert sign_in(client, counselor_key) == 200
+
+    new_key = Ed25519PrivateKey.generate()
+    counselor = db.query(models.Counselor).filter_by(name="counselor").one()
+    counselor.key = raw_public_key(new_key)
+    db.commit()
+    assert sign_in(client, counselor_key) == 401
+    assert sign_in(client, new_key) == 200
+
+    db.query(models.Counselor).delete()
+    db.commit()
+    assert sign_in(client, new_key) == 404
+
+
+def test_counselor_signup(client: TestClient, db):
+    db.add(models.CounselorSignUp(passphrase="code"))
+    db.commit()
+    key = Ed25519PrivateKey.generate()
+
+    def sign_up(pub_key: str):
+        signature = base64.urlsafe_b64encode(key.sign(b"code")).decode()
+        return client.post(
+            "/counselor_signup",
+            data={
+                "username": "counselor",
+                "pub_key": pub_key,
+                "signup_code": "code",
+                "signature": signature,
+            },
+        )
+
+    assert sign_up("not a key").status_code == 400
+    assert sign_up(base64.urlsafe_b64encode(raw_public_key(key)).decode()).json() == (
+        "Good"
+    )
+    assert db.query(models.Counselor).one().key == raw_public_key(key)
+    assert sign_in(client, key) == 200
+
+
+def test_expired_signup_code(client: TestClient, db):
+    expired = models.utcnow() - timedelta(minutes=1)
+    db.add(models.CounselorSignUp(passphrase="code", expires=expired))
+    db.commit()
+    key = Ed25519PrivateKey.generate()
+    response = client.post(
+        "/counselor_signup",
+        data={
+            "username": "counselor",
+            "pub_key": base64.urlsafe_b64encode(raw_public_key(key)).decode(),
+            "signup_code": "code",
+            "signature": base64.urlsafe_b64encode(key.sign(b"code")).decode(),
+        },
+    )
+    assert response.status_code == 404
+
+
+def legacy_pem(key: Ed25519PrivateKey | Ed448PrivateKey) -> str:
+    return (
+        key.public_key()
+        .public_bytes(serial.Encoding.PEM, serial.PublicFormat.SubjectPublicKeyInfo)
+        .decode()
+    )
+
+
+def test_legacy_counselor_reenrolls(client: TestClient, db):
+    old_key = Ed448PrivateKey.generate()
+    db.add(models.Counselor(name="counselor", legacy_key=legacy_pem(old_key)))
+    db.add(models.CounselorSignUp(passphrase="code"))
+    db.commit()
+    assert sign_in(client, old_key) == 200
+
+    new_key = Ed25519PrivateKey.generate()
+    client.post(
+        "/counselor_signup",
+        data={
+            "username": "counselor",
+            "pub_key": base64.urlsafe_b64encode(raw_public_key(new_key)).decode(),
+            "signup_code": "code",
+            "signature": base64.urlsafe_b64encode(new_key.sign(b"code")).decode(),
+        },
+    )
+    assert sign_in(client, old_key) == 401
+    assert sign_in(client, new_key) == 200
+
+
+def test_counselor_migration():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE counselors (id INTEGER PRIMARY KEY, "
+                "name VARCHAR(100) NOT NULL UNIQUE, "
+                "key_bytes VARCHAR(64) NOT NULL UNIQUE)"
+            )
+        )
+        ed25519_key = Ed25519PrivateKey.generate()
+        ed448_pem = legacy_pem(Ed448PrivateKey.generate())
+        for name, pem in (("new", legacy_pem(ed25519_key)), ("old", ed448_pem)):
+            connection.execute(
+                text("INSERT INTO counselors (name, key_bytes) VALUES (:name, :pem)"),
+                {"name": name, "pem": pem},
+            )
+
+    models.create_models(engine)
+    models.create_models(engine)
+
+    session = sessionmaker(bind=engine)()
+    new, old = session.query(models.Counselor).order_by(models.Counselor.name)
+    assert (new.key, new.legacy_key) == (raw_public_key(ed25519_key), None)
+    assert (old.key, old.legacy_key) == (None, ed448_pem)
+    session.add(models.Counselor(name="another", key=bytes(32)))
+    session.commit()
+
+
+def test_sqlite_pragmas(db):
+    assert db.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+    assert db.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+
+
+def test_http_message_round_trip(client: TestClient, chat: str):
+    client.post("/send_message", data={"message": "hello", "user_id": chat})
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json() == {
+        "chat_status": "CHAT_ACTIVE",
+        "messages": ["hello"],
+        "binary": [],
+        "more": False,
+    }
+
+
+def test_websocket_push_and_relay(client: TestClient, chat: str):
+    with client.websocket_connect(f"/chat/{chat}") as counselor:
+        with client.websocket_connect(f"/chat/{GUEST_KEY}") as guest:
+            client.post("/send_message", data={"message": "pushed", "user_id": chat})
+            assert counselor.receive_text() == "pushed"
+
+            counselor.send_text("relayed")
+            assert guest.receive_text() == "relayed"
+
+            client.post("/counseling_complete", data={"user_id": GUEST_KEY})
+            for socket in (guest, counselor):
+                frame = ChatContent.parse_raw(socket.receive_text())
+                assert frame.type == ChatContentType.STATUS
+                assert frame.content.status == StatusType.DISCONNECT
+
+
+def test_websocket_relays_binary_frames(client: TestClient, chat: str):
+    message = ChatContent(
+        type=ChatContentType.ENCRYPTED_MESSAGE,
+        content=EncryptedMessage(sequence=0, nonce=bytes(12), ciphertext=b"hello"),
+    )
+    frame = codec.encode(message)
+    with client.websocket_connect(f"/chat/{chat}") as counselor:
+        with client.websocket_connect(f"/chat/{GUEST_KEY}") as guest:
+            counselor.send_bytes(frame)
+            assert codec.decode(guest.receive_bytes()) == message
+
+    # binary frames still reach clients that fell back to polling
+    web.router.send_to_partner(chat, frame)
+    web.router.send_to_partner(chat, "text")
+    response = client.get(f"/collect_messages/{GUEST_KEY}")
+    assert response.json()["messages"] == [base64.b64encode(frame).decode(), "text"]
+    assert response.json()["binary"] == [0]
+
+
+def test_peers_cannot_send_status_frames(client: TestClient, chat: str):
+    status = ChatContent(
+        type=ChatContentType.STATUS,
+        content=StatusMessage(status=StatusType.DISCONNECT),
+    )
+    response = client.post(
+        "/send_message", data={"message": status.json(), "user_id": chat}
+    )
+    assert response.status_code == 422
+    with client.websocket_connect(f"/chat/{chat}") as counselor:
+        with client.websocket_connect(f"/chat/{GUEST_KEY}") as guest:
+            counselor.send_text(status.json())
+            counselor.send_bytes(codec.encode(status))
+            counselor.send_text('{"not": "a status"}')
+            assert guest.receive_text() == '{"not": "a status"}'
+
+
+def test_counseling_complete_ends_both_sides(client: TestClient, chat: str):
+    client.post("/counseling_complete", data={"user_id": GUEST_KEY})
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json()["chat_status"] == "NO_CHAT"
+
+
+def test_websocket_rejects_unknown_chat(client: TestClient):
+    with pytest.raises(Exception):
+        with client.websocket_connect("/chat/nobody") as socket:
+            socket.receive_text()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def async_client(client: TestClient):
+    async with AsyncClient(app=web.app, base_url="http://hyperdome") as async_client:
+        yield async_client
+
+
+@pytest.mark.anyio
+async def test_long_poll_times_out(async_client: AsyncClient, chat: str):
+    response = await async_client.get(
+        f"/collect_messages/{chat}", params={"wait": 0.05}
+    )
+    assert response.json() == {
+        "chat_status": "CHAT_ACTIVE",
+        "messages": [],
+        "binary": [],
+        "more": False,
+    }
+
+
+@pytest.mark.anyio
+async def test_long_poll_wakes_on_message(async_client: AsyncClient, chat: str):
+    async def send_later():
+        await asyncio.sleep(0.05)
+        await async_client.post(
+            "/send_message", data={"message": "hello", "user_id": chat}
+        )
+
+    start = time.monotonic()
+    response, _ = await asyncio.gather(
+        async_client.get(f"/collect_messages/{chat}", params={"wait": 10}),
+        send_later(),
+    )
+    assert response.json() == {
+        "chat_status": "CHAT_ACTIVE",
+        "messages": ["hello"],
+        "binary": [],
+        "more": False,
+    }
+    assert time.monotonic() - start < 5
+
+
+@pytest.mark.anyio
+async def test_long_poll_wakes_on_chat_end(async_client: AsyncClient, chat: str):
+    async def end_later():
+        await asyncio.sleep(0.05)
+        await async_client.post("/counseling_complete", data={"user_id": GUEST_KEY})
+
+    response, _ = await asyncio.gather(
+        async_client.get(f"/collect_messages/{chat}", params={"wait": 10}),
+        end_later(),
+    )
+    assert response.json()["chat_status"] == "NO_CHAT"
+
+
+def test_waiting_room_positions(client: TestClient):
+    def check_in(guest_key: str):
+        response = client.post("/waiting_room", data={"pub_key": guest_key}).json()
+        return response["counselor_key"], response["position"]
+
+    assert check_in("first") == ("", 1)
+    assert check_in("second") == ("", 2)
+    assert check_in("third") == ("", 3)
+    assert check_in("first") == ("", 1)
+
+    client.post("/counseling_complete", data={"user_id": "second"})
+    assert check_in("third") == ("", 2)
+
+    web.router.add_counselor(COUNSELOR_KEY)
+    assert check_in("first") == (COUNSELOR_KEY, 0)
+    assert check_in("third") == ("", 1)
+
+
+def test_counselor_ends_uncollected_match(client: TestClient):
+    client.post("/waiting_room", data={"pub_key": GUEST_KEY})
+    counselor_id = web.router.add_counselor(COUNSELOR_KEY)
+    (new_guest,) = web.router.pop_guests(counselor_id)
+    client.post("/counseling_complete", data={"user_id": new_guest["chat_id"]})
+    assert not web.router.has_session(GUEST_KEY)
+
+    # asking again starts over, with a chat that's actually open
+    response = client.post("/waiting_room", data={"pub_key": GUEST_KEY}).json()
+    assert response["chat_id"] != new_guest["chat_id"]
+    client.post("/send_message", data={"message": "hi", "user_id": response["chat_id"]})
+    assert client.get(f"/collect_messages/{response['chat_id']}").json()[
+        "messages"
+    ] == ["hi"]
+
+
+@pytest.mark.anyio
+async def test_waiting_room_wakes_on_counselor(async_client: AsyncClient):
+    counselor_ids = []
+
+    async def sign_in_later():
+        await asyncio.sleep(0.05)
+        counselor_ids.append(web.router.add_counselor(COUNSELOR_KEY))
+
+    response, _ = await asyncio.gather(
+        async_client.post(
+            "/waiting_room", data={"pub_key": GUEST_KEY}, params={"wait": 10}
+        ),
+        sign_in_later(),
+    )
+    assert response.json()["counselor_key"] == COUNSELOR_KEY
+    (new_guest,) = web.router.pop_guests(counselor_ids[0])
+    assert new_guest == {"guest_key": GUEST_KEY, "chat_id": response.json()["chat_id"]}
+
+
+def test_counselor_capacity(client: TestClient):
+    counselor_id = web.router.add_counselor(COUNSELOR_KEY, capacity=2)
+    guests = ("first", "second", "third")
+    for guest_key in guests:
+        client.post("/waiting_room", data={"pub_key": guest_key})
+
+    new_guests = client.get(f"/poll_connected_guest/{counselor_id}").json()
+    assert [guest["guest_key"] for guest in new_guests] == ["first", "second"]
+    assert web.router.online == 0
+
+    client.post("/counseling_complete", data={"user_id": new_guests[0]["chat_id"]})
+    (new_guest,) = client.get(f"/poll_connected_guest/{counselor_id}").json()
+    assert new_guest["guest_key"] == "third"
+    assert client.get(f"/poll_connected_guest/{counselor_id}").json() == []
+
+    client.post("/counseling_complete", data={"user_id": "second"})
+    assert web.router.online == 1
+
+
+def test_full_mailbox_backpressure(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter(max_chat_messages=2))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+
+    def send():
+        return client.post(
+            "/send_message", data={"message": "hi", "user_id": GUEST_KEY}
+        )
+
+    assert send().status_code == 200
+    assert send().status_code == 200
+    response = send()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(web.BACKPRESSURE_RETRY_SECONDS)
+
+    client.get(f"/collect_messages/{GUEST_KEY}")
+    assert send().status_code == 200
+
+
+def test_message_budget(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter(message_budget=10))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+
+    def send(message: str):
+        return client.post(
+            "/send_message", data={"message": message, "user_id": GUEST_KEY}
+        )
+
+    assert send("x" * 10).status_code == 200
+    assert send("x").status_code == 503
+    client.post("/counseling_complete", data={"user_id": GUEST_KEY})
+    assert web.router.message_budget.used == 0
+
+
+def test_oversized_messages_refused(client: TestClient, chat: str):
+    message = "x" * (web.MAX_MESSAGE_BYTES + 1)
+    response = client.post("/send_message", data={"message": message, "user_id": chat})
+    assert response.status_code == 413
+
+    message = "x" * (web.MAX_REQUEST_BYTES + 1)
+    response = client.post("/send_message", data={"message": message, "user_id": chat})
+    assert response.status_code == 413
+    assert response.text == "request body too large"
+
+
+def test_malformed_content_length_refused(client: TestClient, chat: str):
+    response = client.post(
+        "/send_message",
+        content=b"message=hi&user_id=chat",
+        headers={
+            "content-type": "application/x-www-form-urlencoded",
+            "content-length": "lots",
+        },
+    )
+    assert response.status_code == 400
+
+
+def test_websocket_backpressure(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter(max_chat_messages=1))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+
+    with client.websocket_connect(f"/chat/{GUEST_KEY}") as guest:
+        guest.send_text("first")
+        guest.send_text("second")
+        frame = ChatContent.parse_raw(guest.receive_text())
+        assert frame.content.status == StatusType.QUEUE_FULL
+
+
+def test_idle_sessions_reaped(client: TestClient, chat: str):
+    guest_id = client.get("/generate_guest_id").json()
+    assert web.router.reap() == {}
+
+    web.router.activity.ttl = 0
+    assert web.router.reap() == {"counselor": 1, "chat": 1, "guest_id": 1}
+    assert web.router.online == 0
+    assert guest_id not in web.router.guest_ids
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json()["chat_status"] == "NO_CHAT"
+    assert not web.router.chats and not web.router.partners
+    assert len(web.router.activity) == 0
+
+
+def test_connected_sessions_not_reaped(client: TestClient, chat: str):
+    web.router.activity.ttl = 0
+    with client.websocket_connect(f"/chat/{chat}"):
+        with client.websocket_connect(f"/chat/{GUEST_KEY}"):
+            assert web.router.reap() == {}
+            assert chat in web.router.chats
+
+
+def test_chatting_counselor_not_reaped(client: TestClient, chat: str):
+    web.router.activity.ttl = 0.1
+    time.sleep(0.15)
+    client.post("/send_message", data={"message": "hi", "user_id": GUEST_KEY})
+    client.get(f"/collect_messages/{GUEST_KEY}")
+    assert web.router.reap() == {}
+    client.post("/counseling_complete", data={"user_id": chat})
+    assert web.router.online == 1
+
+
+def test_batch_send(client: TestClient, chat: str):
+    response = client.post(
+        "/send_messages", json={"messages": ["one", "two", "three"], "user_id": chat}
+    )
+    assert response.status_code == 200
+    response = client.get(f"/collect_messages/{chat}")
+    assert response.json()["messages"] == ["one", "two", "three"]
+
+
+def test_batch_send_all_or_nothing(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter(max_chat_messages=2))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+    response = client.post(
+        "/send_messages", json={"messages": ["1", "2", "3"], "user_id": GUEST_KEY}
+    )
+    assert response.status_code == 429
+    assert len(web.router.mailbox(GUEST_KEY)) == 0
+
+    response = client.post(
+        "/send_messages",
+        json={"messages": ["1"] * (web.MAX_BATCH_MESSAGES + 1), "user_id": GUEST_KEY},
+    )
+    assert response.status_code == 422
+
+
+def test_request_metrics(client: TestClient, chat: str):
+    route = {"route": "/collect_messages/{user_id}", "method": "GET"}
+    requests = metrics.REQUESTS.value(status="200", **route)
+    observed = metrics.REQUEST_LATENCY.count(**route)
+    client.get(f"/collect_messages/{chat}")
+    assert metrics.REQUESTS.value(status="200", **route) == requests + 1
+    assert metrics.REQUEST_LATENCY.count(**route) == observed + 1
+
+    rendered = metrics.render()
+    assert "hyperdome_active_chats 1" in rendered
+    assert "hyperdome_counselors_available 0" in rendered
+    assert f'hyperdome_requests_total{{route="{route["route"]}"' in rendered
+    assert chat not in rendered
+
+
+@pytest.mark.anyio
+async def test_metrics_served_locally():
+    server = await metrics.serve_metrics(0)
+    host, port = server.sockets[0].getsockname()[:2]
+    assert host == "127.0.0.1"
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    server.close()
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"# TYPE hyperdome_request_duration_seconds histogram" in response
+
+
+def test_collect_messages_bounded(client: TestClient, chat: str):
+    messages = ["line one\nline two", "b" * 10, "c", "d"]
+    client.post("/send_messages", json={"messages": messages, "user_id": chat})
+
+    response = client.get(f"/collect_messages/{chat}", params={"max_messages": 1})
+    assert response.json()["messages"] == messages[:1]
+    assert response.json()["more"]
+
+    # a message over max_bytes is still returned on its own rather than stuck
+    response = client.get(f"/collect_messages/{chat}", params={"max_bytes": 5})
+    assert response.json()["messages"] == messages[1:2]
+
+    response = client.get(f"/collect_messages/{chat}", params={"max_bytes": 5})
+    assert response.json() == {
+        "chat_status": "CHAT_ACTIVE",
+        "messages": messages[2:],
+        "binary": [],
+        "more": False,
+    }
+    assert web.router.queued_bytes == 0
+
+
+def test_rate_limited_sessions(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "message_limits", RateLimiter(rate=0.5, burst=2))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+
+    def send(user_id: str):
+        return client.post("/send_message", data={"message": "hi", "user_id": user_id})
+
+    assert send(GUEST_KEY).status_code == 200
+    assert send(GUEST_KEY).status_code == 200
+    response = send(GUEST_KEY)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    # other sessions have their own allowance
+    assert send("another").status_code != 429
+
+
+def test_sends_limited_by_sender(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "message_limits", RateLimiter(rate=0.5, burst=2))
+    web.router.add_counselor(COUNSELOR_KEY)
+    chat_id = web.router.match_guest(GUEST_KEY)[1]
+
+    def send(user_id: str):
+        return client.post("/send_message", data={"message": "hi", "user_id": user_id})
+
+    with client.websocket_connect(f"/chat/{chat_id}") as counselor:
+        with client.websocket_connect(f"/chat/{GUEST_KEY}") as guest:
+            for _ in range(2):
+                counselor.send_text("hi")
+                assert guest.receive_text() == "hi"
+    # the counselor's HTTP sends share the allowance their socket used up
+    assert send(GUEST_KEY).status_code == 429
+    # while the guest still has their own
+    assert send(chat_id).status_code == 200
+
+
+def test_batches_cost_a_token_a_message(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(web, "message_limits", RateLimiter(rate=0.5, burst=3))
+    web.router.add_counselor(COUNSELOR_KEY)
+    web.router.match_guest(GUEST_KEY)
+
+    def send(*messages: str):
+        return client.post(
+            "/send_messages", json={"messages": messages, "user_id": GUEST_KEY}
+        )
+
+    assert send("one", "two").status_code == 200
+    assert send("three", "four").status_code == 429
+    assert send("three").status_code == 200
+    # batches larger than the burst still go through once the bucket is full
+    monkeypatch.setattr(web, "message_limits", RateLimiter(rate=0.5, burst=3))
+    assert send(*"abcde").status_code == 200
+
+
+def test_rate_limiter_refills():
+    limiter = RateLimiter(rate=1000, burst=1, max_keys=2)
+    assert limiter.acquire("a") == 0
+    assert 0 < limiter.acquire("a") <= 0.001
+    time.sleep(0.002)
+    assert limiter.acquire("a") == 0
+
+    limiter.acquire("b")
+    limiter.acquire("c")
+    assert list(limiter._buckets) == ["b", "c"]
+
+
+def test_active_chat_ceiling(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "router", ChatRouter(max_active_chats=1))
+    web.router.add_counselor(COUNSELOR_KEY, capacity=2)
+
+    def check_in(guest_key: str):
+        return client.post("/waiting_room", data={"pub_key": guest_key}).json()
+
+    assert check_in("first")["counselor_key"] == COUNSELOR_KEY
+    assert check_in("second") == {"counselor_key": "", "chat_id": "", "position": 1}
+
+    client.post("/counseling_complete", data={"user_id": "first"})
+    assert check_in("second")["counselor_key"] == COUNSELOR_KEY
+
+
+def test_waiting_room_full(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web, "MAX_QUEUED_GUESTS", 2)
+    for guest_key in ("first", "second"):
+        client.post("/waiting_room", data={"pub_key": guest_key})
+
+    response = client.post("/waiting_room", data={"pub_key": "third"})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    # guests already in line keep their place
+    assert client.post("/waiting_room", data={"pub_key": "first"}).status_code == 200
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def publish(client: TestClient, keyring: CounselorKeyring):
+    bundle = keyring.pre_key_bundle
+    identity = raw_public_key(keyring._private_signing_key)
+    return client.post(
+        f"/pre_keys/{b64(identity)}",
+        data={
+            "signed_pre_key": b64(bundle.signed_pre_key),
+            "pre_key_signature": b64(bundle.pre_key_signature),
+            "one_time_keys": [b64(key) for key in bundle.one_time_keys],
+            "one_time_keys_signature": b64(bundle.one_time_keys_signature),
+        },
+    )
+
+
+@pytest.fixture
+def keyring(db) -> CounselorKeyring:
+    keyring = CounselorKeyring()
+    identity = raw_public_key(keyring._private_signing_key)
+    db.add(models.Counselor(name="counselor", key=identity))
+    db.commit()
+    return keyring
+
+
+@pytest.fixture
+def baseline_keyring(db_path: Path) -> CounselorKeyring:
+    """
+    a counselor enrolled in a database from before raw keys or pre keys,
+    requested before db so it's there to be upgraded
+    """
+    keyring = CounselorKeyring()
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE counselors (id INTEGER PRIMARY KEY, "
+                "name VARCHAR(100) NOT NULL UNIQUE, "
+                "key_bytes VARCHAR(64) NOT NULL UNIQUE)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO counselors (name, key_bytes) VALUES (:name, :pem)"),
+            {"name": "counselor", "pem": legacy_pem(keyring._private_signing_key)},
+        )
+    engine.dispose()
+    return keyring
+
+
+def test_upgraded_database_takes_pre_keys(
+    client: TestClient, baseline_keyring: CounselorKeyring, db
+):
+    assert db.execute(text("PRAGMA foreign_keys")).scalar() == 1
+    assert publish(client, baseline_keyring).json() == 100
+    identity = b64(raw_public_key(baseline_keyring._private_signing_key))
+    assert client.get(f"/pre_key_bundle/{identity}").status_code == 200
+
+
+def test_pre_key_bundles(
+    client: TestClient, keyring: CounselorKeyring, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(web, "bundle_limits", RateLimiter(1000, 1000))
+    assert publish(client, keyring).json() == 100
+    identity = b64(raw_public_key(keyring._private_signing_key))
+
+    response = client.get(f"/pre_key_bundle/{identity}")
+    bundle = codec.decode_bundle(response.content)
+    guest = GuestKeyring()
+    guest.exchange(bundle)
+    keyring.exchange(
+        IntroductionMessage(
+            ephemeral_key=guest.public_key.public_bytes(
+                serial.Encoding.Raw, serial.PublicFormat.Raw
+            ),
+            one_time_key=bundle.one_time_key,
+        )
+    )
+    assert keyring.decrypt_message(guest.encrypt_message(b"hello")) == b"hello"
+
+    # restarting doesn't lose keys or hand any out twice
+    web.pre_keys = PreKeyStore()
+    one_time_keys = {bundle.one_time_key}
+    for _ in range(99):
+        content = client.get(f"/pre_key_bundle/{identity}").content
+        one_time_keys.add(codec.decode_bundle(content).one_time_key)
+    assert len(one_time_keys) == 100
+    assert client.get(f"/pre_key_bundle/{identity}").status_code == 404
+
+
+def test_pre_keys_replaced(client: TestClient, db, keyring: CounselorKeyring):
+    publish(client, keyring)
+    keyring._pre_key = X25519PrivateKey.generate()
+    keyring._one_time_key_pairs.clear()
+    keyring._generate_one_time_keys()
+    publish(client, keyring)
+    assert db.query(models.OneTimeKey).count() == 100
+    assert {key.key for key in db.query(models.OneTimeKey)} == set(
+        keyring._one_time_key_pairs
+    )
+
+
+def test_pre_keys_must_be_signed(client: TestClient, keyring: CounselorKeyring):
+    impostor = CounselorKeyring()
+    impostor._private_signing_key = Ed25519PrivateKey.generate()
+    identity = b64(raw_public_key(keyring._private_signing_key))
+    bundle = impostor.pre_key_bundle
+    response = client.post(
+        f"/pre_keys/{identity}",
+        data={
+            "signed_pre_key": b64(bundle.signed_pre_key),
+            "pre_key_signature": b64(bundle.pre_key_signature),
+        },
+    )
+    assert response.status_code == 401
+    assert client.get(f"/pre_key_bundle/{identity}").status_code == 404
+
+
+def test_one_time_keys_replenished(
+    client: TestClient, keyring: CounselorKeyring, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(web, "bundle_limits", RateLimiter(1000, 1000))
+    identity = b64(keyring.identity_key_bytes)
+    # keys can only be added to a signed pre key
+    upload = keyring.one_time_keys_upload(10)
+    response = client.post(f"/pre_keys/{identity}/one_time_keys", content=upload)
+    assert response.status_code == 409
+
+    assert publish(client, keyring).json() == 10
+    for _ in range(10):
+        client.get(f"/pre_key_bundle/{identity}")
+    assert client.get(f"/pre_keys/{identity}").json() == 0
+    upload = keyring.one_time_keys_upload(50)
+    response = client.post(f"/pre_keys/{identity}/one_time_keys", content=upload)
+    assert response.json() == 50
+
+    # guests can check keys added since publishing, also after a restart
+    for _ in range(2):
+        bundle = codec.decode_bundle(client.get(f"/pre_key_bundle/{identity}").content)
+        assert bundle.one_time_key in keyring._one_time_key_pairs
+        assert bundle.one_time_keys_count == 60
+        GuestKeyring().exchange(bundle)
+        web.pre_keys = PreKeyStore()
+    assert client.get(f"/pre_keys/{identity}").json() == 48
+
+
+def test_one_time_key_upload_after_lost_upload(
+    client: TestClient, keyring: CounselorKeyring
+):
+    identity = b64(keyring.identity_key_bytes)
+    publish(client, keyring)
+    keyring.one_time_keys_upload(10)
+    for count in (5, 5):
+        upload = keyring.one_time_keys_upload(count)
+        response = client.post(f"/pre_keys/{identity}/one_time_keys", content=upload)
+        assert response.status_code == 200
+        keyring.one_time_keys_uploaded(upload)
+    assert response.json() == 110
+
+
+def test_one_time_key_uploads_checked(client: TestClient, keyring: CounselorKeyring):
+    identity = b64(keyring.identity_key_bytes)
+    publish(client, keyring)
+    signature, keys = codec.decode_one_time_keys(keyring.one_time_keys_upload(10))
+
+    forged = codec.encode_one_time_keys(signature, keys[::-1])
+    response = client.post(f"/pre_keys/{identity}/one_time_keys", content=forged)
+    assert response.status_code == 401
+    response = client.post(f"/pre_keys/{identity}/one_time_keys", content=b"\x01")
+    assert response.status_code == 400
+    stranger = b64(CounselorKeyring().identity_key_bytes)
+    response = client.get(f"/pre_keys/{stranger}")
+    assert response.status_code == 404
+    assert client.get(f"/pre_keys/{identity}").json() == 100